@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the Document hot paths.
+
+Run from the top of the repository::
+
+    python -m benchmarks.bench                          # against the in-memory backend
+    python -m benchmarks.bench --mongod mongodb://localhost:27017
+    python -m benchmarks.bench --save baseline.json     # keep the results as a baseline
+    python -m benchmarks.bench --compare baseline.json  # flag what got slower since
+
+By default the database is `notanormous.inmemory`, so the numbers are the client-side CPU cost of
+Notanormous alone. With `--mongod` they include the round trips. `--compare` exits with status 1 if
+any benchmark is more than `--threshold` slower than in the baseline. Only compare results from the
+same machine and backend.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import gc
+import json
+import platform
+import sys
+import timeit
+
+from notanormous.document import Document, _make_documents
+from notanormous.identity import identity_map
+from notanormous.inmemory import InMemoryClient
+
+from benchmarks.schemas import BenchCoord, BenchThing, make_thing
+
+__all__ = [
+    'BENCHMARKS',
+    'benchmark',
+    'compare',
+    'run',
+]
+
+
+BENCHMARKS = []  # (name, number of operations per round, setup function)
+
+
+def benchmark(name, number):
+    """
+    Registers a benchmark. The decorated function is called with the scale and returns a function
+    running one operation.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, number, setup))
+        return setup
+    return register
+
+
+def _scaled(n, scale):
+    return max(1, int(n * scale))
+
+
+@benchmark('init', 200)
+def bench_init(scale):
+    n = _scaled(20, scale)
+    return lambda: make_thing(embedded=n)
+
+
+@benchmark('to_mongodb', 200)
+def bench_to_mongodb(scale):
+    thing = make_thing(embedded=_scaled(20, scale))
+    return thing.to_mongodb
+
+
+@benchmark('from_mongodb', 200)
+def bench_from_mongodb(scale):
+    data = make_thing(embedded=_scaled(20, scale)).to_mongodb()
+    data['_id'] = 1
+    return lambda: BenchThing()._from_mongodb(data)
+
+
+@benchmark('new_from_mongodb', 200)
+def bench_new_from_mongodb(scale):
+    data = make_thing(embedded=_scaled(20, scale)).to_mongodb()
+    data['_id'] = 1
+    def op():
+        # a fresh identity map, or we'd get the first one back every time:
+        with identity_map():
+            BenchThing.new_from_mongodb(data)
+    return op
+
+
+@benchmark('is_valid', 500)
+def bench_is_valid(scale):
+    return make_thing(embedded=_scaled(20, scale)).is_valid
+
+
+@benchmark('make_documents', 3)
+def bench_make_documents(scale):
+    n = _scaled(10000, scale)
+    coll = BenchCoord._collection()
+    coll.remove()
+    for i in range(1, n + 1):
+        coll.insert({'_id': i, 'x': i, 'y': i, '_data': {'_classname': 'BenchCoord', '_version': 1}})
+    def op():
+        with identity_map():
+            _make_documents(BenchCoord.find())
+    return op
+
+
+@benchmark('get_id_refs', 50)
+def bench_get_id_refs(scale):
+    n = _scaled(200, scale)
+    coll = BenchCoord._collection()
+    coll.remove()
+    for i in range(1, n + 1):
+        coll.insert({'_id': i, 'x': i, 'y': i, '_data': {'_classname': 'BenchCoord', '_version': 1}})
+    thing = make_thing(embedded=2, coord_ids=range(1, n + 1))
+    def op():
+        with identity_map():
+            thing._get_id_refs('coord_ids')
+    return op
+
+
+@benchmark('paginate_deep', 20)
+def bench_paginate_deep(scale):
+    n = _scaled(10000, scale)
+    coll = BenchCoord._collection()
+    coll.remove()
+    for i in range(1, n + 1):
+        coll.insert({'_id': i, 'x': i % 10, 'y': i, '_data': {'_classname': 'BenchCoord', '_version': 1}})
+    # a page near the end:
+    with identity_map():
+        token = BenchCoord.paginate({'_id': {'$gte': n - 100}}, page_size=20).next
+    def op():
+        with identity_map():
+            BenchCoord.paginate(page_size=20, after=token)
+    return op
+
+
+@benchmark('save_insert', 100)
+def bench_save_insert(scale):
+    BenchThing._collection().remove()
+    n = _scaled(20, scale)
+    def op():
+        with identity_map():
+            make_thing(embedded=n).save()
+    return op
+
+
+@benchmark('save_update', 100)
+def bench_save_update(scale):
+    BenchThing._collection().remove()
+    thing = make_thing(embedded=_scaled(20, scale)).save()
+    def op():
+        thing.score += 1
+        thing.save()
+    return op
+
+
+def measure(op, number, repeat):
+    """Returns the seconds per operation of each of `repeat` rounds of `number` operations."""
+    timings = []
+    for i in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = timeit.default_timer()
+            for j in xrange(number):
+                op()
+            timings.append((timeit.default_timer() - start) / number)
+        finally:
+            gc.enable()
+    return timings
+
+
+def run(db, repeat=5, scale=1.0, only=None, out=sys.stdout):
+    """
+    Runs the benchmarks against `db`, returning {name: {'best': seconds, 'median': seconds, 'number': n}}.
+    """
+    Document._db = db
+    results = dict()
+    for name, number, setup in BENCHMARKS:
+        if only and not any(part in name for part in only):
+            continue
+        op = setup(scale)
+        op()  # warm up
+        timings = sorted(measure(op, number, repeat))
+        results[name] = dict(best=timings[0], median=timings[len(timings) // 2], number=number)
+        print("{0:<20} {1:>12.1f} us {2:>12.1f} us".format(name, timings[0] * 1e6, results[name]['median'] * 1e6),
+              file=out)
+    return results
+
+
+def compare(results, baseline, threshold=0.2, out=sys.stdout):
+    """
+    Prints how `results` differ from `baseline` (best times), returning the names of benchmarks more than
+    `threshold` (a fraction) slower.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            print("{0:<20} new".format(name), file=out)
+            continue
+        ratio = results[name]['best'] / baseline[name]['best']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        print("{0:<20} {1:>8.2f}x {2}".format(name, ratio, flag), file=out)
+    return regressions
+
+
+def _database(args):
+    if not args.mongod:
+        return InMemoryClient()[args.database], 'memory'
+    import pymongo
+    client = pymongo.MongoClient(args.mongod)
+    client.drop_database(args.database)
+    return client[args.database], 'mongod'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Notanormous Document hot paths.")
+    parser.add_argument('--mongod', metavar='URI', help="use a real mongod rather than the in-memory backend")
+    parser.add_argument('--database', default='notanormous_benchmarks',
+                        help="database to use, it is dropped first (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5, help="rounds per benchmark (default: %(default)s)")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies the data sizes (default: %(default)s)")
+    parser.add_argument('--only', nargs='*', metavar='NAME', help="run only benchmarks with these in their names")
+    parser.add_argument('--save', metavar='PATH', help="write the results to a JSON file")
+    parser.add_argument('--compare', metavar='PATH', help="compare with a JSON file written by --save")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="how much slower counts as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+    db, backend = _database(args)
+    print("{0:<20} {1:>15} {2:>15}".format('benchmark', 'best', 'median'))
+    results = run(db, repeat=args.repeat, scale=args.scale, only=args.only)
+    if args.save:
+        meta = dict(backend=backend, scale=args.scale, repeat=args.repeat, python=platform.python_version(),
+                    platform=platform.platform(), date=datetime.datetime.utcnow().isoformat())
+        with open(args.save, 'w') as f:
+            json.dump(dict(meta=meta, results=results), f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['meta']['backend'] != backend or baseline['meta']['scale'] != args.scale:
+            print("Warning: the baseline was made with backend {0} at scale {1}.".format(
+                baseline['meta']['backend'], baseline['meta']['scale']))
+        print()
+        if compare(results, baseline['results'], threshold=args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load tests: many clients at once, each running a mix of requests as fast as it can.
+
+Run from the top of the repository::
+
+    python -m benchmarks.load                                    # in-memory backend, threads
+    python -m benchmarks.load --mongod mongodb://localhost:27017 --concurrency 1 10 100 500
+    python -m benchmarks.load --mongod mongodb://localhost:27017 --processes 4 --concurrency 500
+    python -m benchmarks.load --mix read_by_id=60,traverse=20,list=15,save=5 --things 100000
+
+Each request is one of:
+
+* 'read_by_id': `get_by_id` of a random BenchThing
+* 'traverse': the same, then its `coord` reference list (one query for all of them)
+* 'list': a page of BenchThings in `_id` order from a random place
+* 'save': a BenchThing loaded, an item appended to its embedded list, and saved
+* 'insert': a new BenchThing saved, which contends for the next serial `_id`
+
+in the proportions of `--mix`, a name from `MIXES` or weights like the above. The data is `--things`
+BenchThings with `--embedded` items in each embedded list, referring to `--refs` of `--coords`
+BenchCoords each (see `benchmarks.schemas`).
+
+For each level of `--concurrency`, that many clients run for `--duration` seconds, as threads in this
+process or spread over `--processes` processes, each with its own connection pool. The report has the
+throughput, the latency percentiles overall and per request, and the errors. For the identity map, with
+`--identity request` (the default, what a web app should do) each request gets its own map and the
+report has the Documents each request held; with `--identity process` everything shares the
+process-wide map, and the report has how many Documents it held at the end and their footprint (see
+`notanormous.footprint`). Against a mongod, the report has the server's open connections before the
+level and at its peak, and the client's pool size.
+
+The in-memory backend can't be shared between processes, so `--processes` needs `--mongod`.
+"""
+
+from __future__ import print_function
+
+import argparse
+from collections import defaultdict
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import timeit
+
+from notanormous.document import Document, clear_open_documents
+from notanormous.identity import identity_map
+from notanormous.inmemory import InMemoryClient
+
+from benchmarks.schemas import BenchCoord, BenchEmbed, BenchThing, make_thing
+
+__all__ = [
+    'MIXES',
+    'OPERATIONS',
+    'Workload',
+    'populate',
+    'run_level',
+]
+
+
+OPERATIONS = dict()  # name -> function(workload, rng)
+
+MIXES = {
+    'read-heavy': dict(read_by_id=60, traverse=20, list=15, save=5),
+    'balanced': dict(read_by_id=35, traverse=20, list=20, save=20, insert=5),
+    'write-heavy': dict(read_by_id=20, traverse=10, list=10, save=40, insert=20),
+}
+
+clock = timeit.default_timer
+
+
+def operation(name):
+    def register(func):
+        OPERATIONS[name] = func
+        return func
+    return register
+
+
+class Workload(object):
+    """The shape of the data, which the requests need to pick what to ask for."""
+    def __init__(self, things=10000, coords=1000, refs=10, embedded=20, words=50, page_size=20):
+        self.things = things
+        self.coords = coords
+        self.refs = refs
+        self.embedded = embedded
+        self.words = words
+        self.page_size = page_size
+
+
+@operation('read_by_id')
+def read_by_id(w, rng):
+    return BenchThing.get_by_id(rng.randint(1, w.things))
+
+
+@operation('traverse')
+def traverse(w, rng):
+    thing = BenchThing.get_by_id(rng.randint(1, w.things))
+    return sum(coord.x for coord in thing.coord)
+
+
+@operation('list')
+def list_page(w, rng):
+    start = rng.randint(1, w.things)
+    return list(BenchThing.find({'_id': {'$gte': start}}).sort('_id', 1).limit(w.page_size).documents())
+
+
+@operation('save')
+def save(w, rng):
+    thing = BenchThing.get_by_id(rng.randint(1, w.things))
+    thing.manythings.append(BenchEmbed(thing1=u'appended', thing2=u'by the load test'))
+    # don't let the documents grow without bounds:
+    if len(thing.manythings) > w.embedded * 2:
+        del thing.manythings[:len(thing.manythings) - w.embedded]
+    thing.score += 1
+    thing.save()
+
+
+@operation('insert')
+def insert(w, rng):
+    coord_ids = [rng.randint(1, w.coords) for i in range(w.refs)]
+    make_thing(embedded=w.embedded, words=w.words, coord_ids=coord_ids).save()
+
+
+def populate(db, w, out=sys.stdout):
+    """Replaces the BenchThings and BenchCoords in `db` with `w`'s."""
+    Document._db = db
+    BenchCoord._collection().remove()
+    BenchThing._collection().remove()
+    rng = random.Random(0)
+    batch = []
+    for i in range(1, w.coords + 1):
+        batch.append({'_id': i, 'x': i, 'y': i * 2, '_data': {'_classname': 'BenchCoord', '_version': 1}})
+        if len(batch) == 1000:
+            BenchCoord._collection().insert(batch)
+            batch = []
+    if batch:
+        BenchCoord._collection().insert(batch)
+    batch = []
+    for i in range(1, w.things + 1):
+        with identity_map():
+            thing = make_thing(embedded=w.embedded, words=w.words,
+                               coord_ids=[rng.randint(1, w.coords) for j in range(w.refs)])
+            thing.score = float(i)
+            data = thing.to_mongodb()
+        data['_id'] = i
+        batch.append(data)
+        if len(batch) == 500:
+            BenchThing._collection().insert(batch)
+            batch = []
+    if batch:
+        BenchThing._collection().insert(batch)
+    print("Loaded {0} BenchThings and {1} BenchCoords.".format(w.things, w.coords), file=out)
+
+
+class _Client(object):
+    """What one client did: latencies and errors per request, and the Documents each request held."""
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.held = []
+        self.error_types = defaultdict(int)
+
+
+def _client(w, mix, identity, duration, seed, go, result):
+    rng = random.Random(seed)
+    names = sorted(mix)
+    total = float(sum(mix.values()))
+    cumulative = []
+    running = 0.0
+    for name in names:
+        running += mix[name] / total
+        cumulative.append(running)
+    go.wait()
+    deadline = clock() + duration
+    while clock() < deadline:
+        r = rng.random()
+        name = names[-1]
+        for n, bound in zip(names, cumulative):
+            if r < bound:
+                name = n
+                break
+        op = OPERATIONS[name]
+        start = clock()
+        try:
+            if identity == 'request':
+                with identity_map() as imap:
+                    op(w, rng)
+                    seconds = clock() - start
+                    result.held.append(len(imap))
+            else:
+                op(w, rng)
+                seconds = clock() - start
+        except Exception, msg:
+            result.errors[name] += 1
+            result.error_types[msg.__class__.__name__] += 1
+            continue
+        result.latencies[name].append(seconds)
+
+
+def _run_threads(w, mix, identity, threads, duration, seed):
+    """Runs `threads` clients in this process, returning their merged results and the time taken."""
+    go = threading.Event()
+    results = [_Client() for i in range(threads)]
+    workers = [threading.Thread(target=_client, args=(w, mix, identity, duration, seed + i, go, results[i]))
+               for i in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    start = clock()
+    go.set()
+    for worker in workers:
+        worker.join()
+    elapsed = clock() - start
+    merged = _Client()
+    for result in results:
+        for name, latencies in result.latencies.iteritems():
+            merged.latencies[name].extend(latencies)
+        for name, count in result.errors.iteritems():
+            merged.errors[name] += count
+        for name, count in result.error_types.iteritems():
+            merged.error_types[name] += count
+        merged.held.extend(result.held)
+    return merged, elapsed
+
+
+def _process_main(task):
+    """Runs in a worker process: connects, runs its share of the clients, returns plain dicts."""
+    uri, database, w, mix, identity, threads, duration, seed = task
+    import pymongo
+    Document._db = pymongo.MongoClient(uri)[database]
+    result, elapsed = _run_threads(w, mix, identity, threads, duration, seed)
+    return (dict(result.latencies), dict(result.errors), dict(result.error_types), result.held, elapsed,
+            _open_documents(identity))
+
+
+def _open_documents(identity):
+    """(Documents in the process-wide map, their estimated bytes), if requests share it."""
+    if identity == 'request':
+        return 0, 0
+    from notanormous import footprint
+    from notanormous.identity import DEFAULT_IDENTITY_MAP
+    snap = footprint.snapshot(DEFAULT_IDENTITY_MAP, sample=200)
+    return snap.count, snap.total
+
+
+def percentile(values, p):
+    """The `p`th percentile (0-100) of sorted `values`, None if there are none."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def _summary(latencies):
+    latencies = sorted(latencies)
+    return dict(count=len(latencies), p50=percentile(latencies, 50), p90=percentile(latencies, 90),
+                p99=percentile(latencies, 99), max=latencies[-1] if latencies else None)
+
+
+class _ConnectionWatcher(object):
+    """Samples the server's open connections while a level runs."""
+    def __init__(self, db, interval=0.2):
+        self.db = db
+        self.interval = interval
+        self.before = self.peak = self._current()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _current(self):
+        try:
+            return self.db.command('serverStatus')['connections']['current']
+        except Exception:
+            return None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            current = self._current()
+            if current is not None and current > self.peak:
+                self.peak = current
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.before, self.peak
+
+
+def run_level(db, w, mix, concurrency, duration=10.0, processes=0, identity='request', uri=None, seed=0):
+    """
+    Runs one level of `concurrency` clients for `duration` seconds, returning a dict of what happened,
+    see the module docstring.
+    """
+    Document._db = db
+    if identity == 'process':
+        clear_open_documents()
+    watcher = _ConnectionWatcher(db) if uri else None
+    if processes:
+        shares = [concurrency // processes + (1 if i < concurrency % processes else 0) for i in range(processes)]
+        tasks = [(uri, db.name, w, mix, identity, threads, duration, seed + i * concurrency)
+                 for i, threads in enumerate(shares) if threads]
+        pool = multiprocessing.Pool(len(tasks))
+        try:
+            outcomes = pool.map(_process_main, tasks)
+        finally:
+            pool.terminate()
+            pool.join()
+        result = _Client()
+        open_docs = [0, 0]
+        for latencies, errors, error_types, held, process_elapsed, (documents, nbytes) in outcomes:
+            for name, values in latencies.iteritems():
+                result.latencies[name].extend(values)
+            for name, count in errors.iteritems():
+                result.errors[name] += count
+            for name, count in error_types.iteritems():
+                result.error_types[name] += count
+            result.held.extend(held)
+            open_docs[0] += documents
+            open_docs[1] += nbytes
+        # the processes take a while to start, what counts is how long they ran:
+        elapsed = max(outcome[4] for outcome in outcomes)
+    else:
+        result, elapsed = _run_threads(w, mix, identity, concurrency, duration, seed)
+        open_docs = _open_documents(identity)
+    connections = watcher.stop() if watcher else (None, None)
+    everything = [seconds for latencies in result.latencies.values() for seconds in latencies]
+    ops = len(everything)
+    held = result.held
+    pool_size = None
+    if uri:
+        client = getattr(db, 'client', None) or db.connection
+        pool_size = getattr(client, 'max_pool_size', None)
+    return dict(
+        concurrency=concurrency,
+        processes=processes,
+        seconds=elapsed,
+        ops=ops,
+        throughput=ops / elapsed if elapsed else 0.0,
+        errors=sum(result.errors.values()),
+        error_types=dict(result.error_types),
+        latency=_summary(everything),
+        operations=dict((name, dict(_summary(latencies), errors=result.errors.get(name, 0)))
+                        for name, latencies in result.latencies.iteritems()),
+        held_per_request=dict(mean=float(sum(held)) / len(held) if held else None, max=max(held) if held else None),
+        open_documents=dict(count=open_docs[0], bytes=open_docs[1]),
+        connections=dict(before=connections[0], peak=connections[1],
+                         pool_size=pool_size),
+    )
+
+
+def _ms(seconds):
+    if seconds is None:
+        return '-'
+    return '{0:.2f}'.format(seconds * 1000)
+
+
+def report(levels, identity, out=sys.stdout):
+    """Prints the results of `run_level` for each level."""
+    print("{0:>11} {1:>10} {2:>9} {3:>9} {4:>9} {5:>9} {6:>7} {7:>14} {8:>12}".format(
+        'concurrency', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'errors',
+        'docs/request' if identity == 'request' else 'open docs', 'connections'), file=out)
+    for level in levels:
+        latency = level['latency']
+        if identity == 'request':
+            held = level['held_per_request']
+            documents = '-' if held['mean'] is None else '{0:.1f} (max {1})'.format(held['mean'], held['max'])
+        else:
+            documents = '{0} ({1:.0f} KB)'.format(level['open_documents']['count'],
+                                                  level['open_documents']['bytes'] / 1024.0)
+        c = level['connections']
+        connections = '-' if c['before'] is None else '{0} -> {1}'.format(c['before'], c['peak'])
+        print("{0:>11} {1:>10.1f} {2:>9} {3:>9} {4:>9} {5:>9} {6:>7} {7:>14} {8:>12}".format(
+            level['concurrency'], level['throughput'], _ms(latency['p50']), _ms(latency['p90']),
+            _ms(latency['p99']), _ms(latency['max']), level['errors'], documents, connections), file=out)
+        for name, s in sorted(level['operations'].iteritems()):
+            print("{0:>11} {1:>10} {2:>9} {3:>9} {4:>9} {5:>9} {6:>7}".format(
+                name, s['count'], _ms(s['p50']), _ms(s['p90']), _ms(s['p99']), _ms(s['max']), s['errors']),
+                file=out)
+        if level['error_types']:
+            print("{0:>11} {1}".format('', ', '.join('{0} x{1}'.format(name, count) for name, count
+                                                     in sorted(level['error_types'].iteritems()))), file=out)
+    pool_sizes = set(level['connections']['pool_size'] for level in levels) - set([None])
+    if pool_sizes:
+        print("Client connection pool size: {0}".format(', '.join(str(size) for size in pool_sizes)), file=out)
+
+
+def parse_mix(text):
+    """A name from `MIXES`, or 'name=weight,...', as {name: weight}."""
+    if text in MIXES:
+        return MIXES[text]
+    mix = dict()
+    for part in text.split(','):
+        name, sep, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS or not sep:
+            raise ValueError("Not a mix: {0!r}. Use one of {1}, or weights of {2}.".format(
+                text, ', '.join(sorted(MIXES)), ', '.join(sorted(OPERATIONS))))
+        mix[name] = float(weight)
+    if not sum(mix.values()) > 0:
+        raise ValueError("The weights of the mix add up to nothing: {0!r}.".format(text))
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test Notanormous with many concurrent clients.")
+    parser.add_argument('--mongod', metavar='URI', help="use a real mongod rather than the in-memory backend")
+    parser.add_argument('--database', default='notanormous_load',
+                        help="database to use, its benchmark collections are replaced (default: %(default)s)")
+    parser.add_argument('--mix', default='read-heavy',
+                        help="one of {0}, or weights like read_by_id=60,save=5 (default: %(default)s)".format(
+                            ', '.join(sorted(MIXES))))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50],
+                        help="numbers of clients to run, one level each (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per level (default: %(default)s)")
+    parser.add_argument('--processes', type=int, default=0,
+                        help="spread the clients over this many processes, needs --mongod (default: threads only)")
+    parser.add_argument('--identity', choices=('request', 'process'), default='request',
+                        help="an identity map per request, or the process-wide one (default: %(default)s)")
+    parser.add_argument('--things', type=int, default=10000, help="BenchThings to load (default: %(default)s)")
+    parser.add_argument('--coords', type=int, default=1000, help="BenchCoords to load (default: %(default)s)")
+    parser.add_argument('--refs', type=int, default=10, help="BenchCoords per BenchThing (default: %(default)s)")
+    parser.add_argument('--embedded', type=int, default=20,
+                        help="items in each embedded list (default: %(default)s)")
+    parser.add_argument('--words', type=int, default=50, help="words per BenchThing (default: %(default)s)")
+    parser.add_argument('--no-load', action='store_true', help="use the data already in --database")
+    parser.add_argument('--json', metavar='PATH', help="write the results to a JSON file")
+    args = parser.parse_args(argv)
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError, msg:
+        parser.error(str(msg))
+    if args.processes and not args.mongod:
+        parser.error("--processes needs --mongod, other processes can't see the in-memory backend.")
+    if args.mongod:
+        import pymongo
+        db = pymongo.MongoClient(args.mongod)[args.database]
+    else:
+        db = InMemoryClient()[args.database]
+    w = Workload(things=args.things, coords=args.coords, refs=args.refs, embedded=args.embedded, words=args.words)
+    if not args.no_load:
+        populate(db, w)
+    print("Mix: {0}".format(', '.join('{0}={1:g}'.format(name, weight) for name, weight in sorted(mix.items()))))
+    levels = []
+    for concurrency in args.concurrency:
+        levels.append(run_level(db, w, mix, concurrency, duration=args.duration, processes=args.processes,
+                                identity=args.identity, uri=args.mongod))
+    print()
+    report(levels, args.identity)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(mix=mix, workload=w.__dict__, identity=args.identity, levels=levels), f, indent=2,
+                      sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Document classes for the benchmarks, shaped like the `Something`, `Coord` and `EmbedMe` test classes but
+with realistic amounts of data in them.
+"""
+
+import datetime
+
+from notanormous.document import Document
+from notanormous.fields import *
+
+__all__ = [
+    'BenchCoord',
+    'BenchEmbed',
+    'BenchPoint',
+    'BenchThing',
+    'make_thing',
+]
+
+
+class BenchEmbed(Document):
+    thing1             = StringField(required=True)
+    thing2             = StringField(max_length=16)
+    __embed_only__     = True
+
+
+class BenchPoint(Document):
+    x                  = IntegerField()
+    y                  = IntegerField()
+    __embed_only__     = True
+
+
+class BenchCoord(Document):
+    x                  = IntegerField()
+    y                  = IntegerField()
+    __serial_index__   = True
+
+
+class BenchThing(Document):
+    name               = StringField()
+    choicy             = StringField(choices=((u'a', u'A'), (u'b', u'B')))
+    things             = EmbeddedDocumentField(BenchEmbed)
+    manythings         = ListField(EmbeddedDocumentField(BenchEmbed))
+    points             = ListField(EmbeddedDocumentField(BenchPoint))
+    coord_ids          = ListField(ObjectIdField('BenchCoord', related_name=False))
+    words              = ListField(StringField)
+    score              = FloatField()
+    active             = BooleanField()
+    created            = DateTimeField(auto_now_add=True)
+    mod                = DateTimeField(auto_now=True)
+    __serial_index__   = True
+    __stored_properties__ = ['word_count']
+
+    @property
+    def word_count(self):
+        return len(self.words or [])
+
+
+def make_thing(embedded=20, words=50, coord_ids=()):
+    """A BenchThing with `embedded` items in each embedded list and `words` words."""
+    thing = BenchThing(
+        name=u'benchmark thing',
+        choicy=u'a',
+        things=BenchEmbed(thing1=u'first', thing2=u'second'),
+        manythings=[BenchEmbed(thing1=u'item {0}'.format(i), thing2=u'x' * (i % 16)) for i in range(embedded)],
+        points=[BenchPoint(x=i, y=i * 2) for i in range(embedded)],
+        coord_ids=list(coord_ids),
+        words=[u'word{0}'.format(i) for i in range(words)],
+        score=1.5,
+        active=True,
+    )
+    thing['extra'] = {'source': u'benchmark', 'when': datetime.datetime(2020, 1, 1)}
+    return thing
@@ -4,7 +4,7 @@
 Notanormous
 """
 
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE
 from bson.objectid import ObjectId
 from bson.dbref import DBRef
 from fields import *
@@ -12,4 +12,7 @@ from document import *
 from document import _make_document as make_document, _make_documents as make_documents
 from util import make_embeddable, clean_output, cached_property
 from notanormous.exceptions import ValidationError, FieldTypeError
+from notanormous.schema import json_schema, apply_json_schema, apply_json_schemas
+from notanormous.identity import IdentityMap, identity_map, current_identity_map
+from notanormous.connection import bind, read_preference
 
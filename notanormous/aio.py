@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous versions of the Document methods which talk to MongoDB: `asave`, `adelete`, `arefresh`,
+`aget_by_id`, `afind`, and `aref` for reference properties.
+
+pymongo blocks, so these run the ordinary synchronous methods in a bounded thread pool. Validation,
+serialization and the identity map are the very same code as for the synchronous API, we just don't
+block the caller while it runs.
+
+Each call returns a `concurrent.futures.Future`, or, when called from inside a running asyncio event loop,
+an asyncio future you can `await`. The cursor returned by `afind` supports `async for`.
+
+Needs `concurrent.futures`, which on Python 2 means installing the `futures` package
+(`pip install Notanormous[async]`).
+"""
+
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    Future = ThreadPoolExecutor = None
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+import threading
+
+from notanormous.connection import bind_read_preference
+from notanormous.identity import bind_identity_map
+
+__all__ = [
+    'AsyncDocumentCursor',
+    'configure',
+    'shutdown',
+    'submit',
+]
+
+StopAsyncIteration = getattr(builtins, 'StopAsyncIteration', StopIteration)
+
+DEFAULT_MAX_WORKERS = 10
+
+_executor = None
+_executor_lock = threading.Lock()
+_max_workers = DEFAULT_MAX_WORKERS
+
+
+def configure(max_workers=DEFAULT_MAX_WORKERS, executor=None):
+    """
+    Sets the size of the thread pool, or the executor to use instead of our own. Any executor with a
+    `concurrent.futures` style `submit` will do. Call this before the first async call, otherwise the
+    old pool is shut down (after it finishes what it's doing).
+    """
+    global _executor, _max_workers
+    with _executor_lock:
+        old = _executor
+        _executor = executor
+        _max_workers = max_workers
+    if old is not None and old is not executor:
+        old.shutdown(wait=False)
+
+
+def shutdown(wait=True):
+    global _executor
+    with _executor_lock:
+        executor = _executor
+        _executor = None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        if ThreadPoolExecutor is None:
+            raise ImportError("The async API needs concurrent.futures. On Python 2, pip install futures.")
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=_max_workers)
+    return _executor
+
+
+def _running_loop():
+    if asyncio is None:
+        return None
+    get_running_loop = getattr(asyncio, 'get_running_loop', None)
+    if get_running_loop is not None:
+        try:
+            return get_running_loop()
+        except RuntimeError:
+            return None
+    loop = asyncio.get_event_loop()
+    if loop.is_running():
+        return loop
+    return None
+
+
+def _wrap(future):
+    loop = _running_loop()
+    if loop is None:
+        return future
+    return asyncio.wrap_future(future, loop=loop)
+
+
+def _done(result=None, exception=None):
+    future = Future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return _wrap(future)
+
+
+def submit(fn, *args, **kw):
+    """
+    Runs `fn(*args, **kw)` in the pool, returning a future (awaitable under asyncio) for the result.
+    It runs with the caller's identity map (see `notanormous.identity`) and `read_preference` block.
+    """
+    return _wrap(get_executor().submit(bind_identity_map(bind_read_preference(fn)), *args, **kw))
+
+
+class AsyncDocumentCursor(object):
+    """
+    Wraps a `DocumentCursor` so it can be consumed without blocking. Documents are fetched in batches of
+    `batch_size` in the pool.
+
+    Under asyncio::
+
+        async for doc in Something.afind({'name': 'spam'}):
+            ...
+
+    or without it, `to_list().result()` or `next_batch().result()`.
+    """
+    def __init__(self, cursor, batch_size=100):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self._buffer = []
+        self._exhausted = False
+
+    def _fetch(self, size):
+        items = []
+        for item in self.cursor:
+            items.append(item)
+            if size and len(items) >= size:
+                break
+        return items
+
+    def next_batch(self):
+        """
+        A future for the next list of up to `batch_size` Documents. The list is empty once the cursor is
+        used up.
+        """
+        if self._buffer:
+            batch, self._buffer = self._buffer, []
+            return _done(batch)
+        if self._exhausted:
+            return _done([])
+        return submit(self._fetch, self.batch_size)
+
+    def to_list(self, length=None):
+        """
+        A future for a list of the (remaining) Documents, or at most `length` of them.
+        """
+        buffered, self._buffer = self._buffer, []
+        if length is not None and len(buffered) >= length:
+            self._buffer = buffered[length:]
+            return _done(buffered[:length])
+        def fetch():
+            size = None
+            if length is not None:
+                size = length - len(buffered)
+            return buffered + self._fetch(size)
+        return submit(fetch)
+
+    def __aiter__(self):
+        return self
+
+    def _next(self):
+        if not self._buffer:
+            self._buffer = self._fetch(self.batch_size)
+        if not self._buffer:
+            self._exhausted = True
+            raise StopAsyncIteration
+        return self._buffer.pop(0)
+
+    def __anext__(self):
+        if self._buffer:
+            return _done(self._buffer.pop(0))
+        if self._exhausted:
+            return _done(exception=StopAsyncIteration())
+        return submit(self._next)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+Columnar export of query results into NumPy arrays, see `DocumentCursor.to_columns`.
+
+Results are read as raw dicts straight from pymongo and written into preallocated arrays, no Documents
+are made. Each column's dtype comes from its Field:
+
+* `IntegerField`: int64
+* `ObjectIdField`: int64 for `_id`s and references of `__serial_index__` classes, else object (ObjectIds)
+* `FloatField`: float64
+* `DateTimeField`: datetime64[ms], which is as precise as MongoDB dates are
+* `DateField`: datetime64[D]
+* `BooleanField`: bool
+* anything else: object
+
+Missing values become NaN in float columns and NaT in date columns. Integer and boolean columns can't
+hold them, so give such columns another dtype, e.g. `dtypes={'x': 'float64'}`.
+
+Needs NumPy (`pip install Notanormous[numpy]`).
+"""
+
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from notanormous.fields import BooleanField, DateField, DateTimeField, EmbeddedDocumentField, FloatField, \
+    IntegerField, ObjectIdField
+
+__all__ = [
+    'column_dtype',
+    'to_columns',
+]
+
+
+DTYPES = [
+    (DateTimeField, 'datetime64[ms]'),
+    (DateField, 'datetime64[D]'),
+    (IntegerField, 'int64'),
+    (FloatField, 'float64'),
+    (BooleanField, 'bool'),
+]
+
+INITIAL_SIZE = 1024
+
+
+def _field_at(document_class, path):
+    """
+    The Field for a dotted `path`, looking inside embedded Documents, and the Document class it is
+    on. The field is None if there isn't one.
+    """
+    names = path.split('.')
+    field = None
+    for i, name in enumerate(names):
+        field = document_class._fields.get(name, None)
+        if field is None:
+            return document_class, None
+        if i < len(names) - 1:
+            if not isinstance(field, EmbeddedDocumentField):
+                return document_class, None
+            document_class = field.get_target_class()
+            if isinstance(document_class, basestring):
+                from notanormous.document import DOCUMENT_MAP
+                document_class = DOCUMENT_MAP[document_class]
+    return document_class, field
+
+
+def column_dtype(document_class, path):
+    """The NumPy dtype for the field at `path` of `document_class`."""
+    document_class, field = _field_at(document_class, path)
+    if isinstance(field, ObjectIdField):
+        # only serial ids fit in an int64, anything else is most likely an ObjectId:
+        if path.split('.')[-1] == '_id':
+            target = document_class
+        else:
+            target = field.get_target_class()
+        if getattr(target, '__serial_index__', False):
+            return 'int64'
+        return 'object'
+    for field_class, dtype in DTYPES:
+        if isinstance(field, field_class):
+            return dtype
+    return 'object'
+
+
+def _value_at(item, names):
+    for name in names:
+        if not isinstance(item, dict):
+            return None
+        item = item.get(name, None)
+    return item
+
+
+def to_columns(document_class, items, fields, dtypes=None, size=None):
+    """
+    Fills a NumPy array per field from `items`, raw dicts as from pymongo. Returns an OrderedDict of
+    field -> array.
+
+    :param dtypes: dict of field -> dtype, for columns where the Field's dtype won't do.
+    :param size: how many items to expect, if known, so the arrays are allocated only once.
+    """
+    if numpy is None:
+        raise ImportError("to_columns needs NumPy, pip install numpy.")
+    dtypes = dtypes or dict()
+    fields = list(fields)
+    paths = [field.split('.') for field in fields]
+    capacity = size or INITIAL_SIZE
+    columns = [numpy.empty(capacity, dtype=dtypes.get(field, None) or column_dtype(document_class, field))
+               for field in fields]
+    missing = []
+    for column in columns:
+        kind = column.dtype.kind
+        if kind == 'f':
+            missing.append(numpy.nan)
+        elif kind == 'M':
+            missing.append(numpy.datetime64('NaT'))
+        elif kind == 'O':
+            missing.append(None)
+        else:
+            missing.append(ValueError)
+    n = 0
+    for item in items:
+        if n == capacity:
+            capacity *= 2
+            for i, column in enumerate(columns):
+                columns[i] = numpy.resize(column, capacity)
+        for i, names in enumerate(paths):
+            value = _value_at(item, names)
+            if value is None:
+                value = missing[i]
+                if value is ValueError:
+                    raise ValueError("{0} is missing from {1}, and a {2} column can't say so. Pass dtypes="
+                                     "{{{3!r}: 'float64'}} or 'object'.".format(fields[i], item.get('_id', item),
+                                                                             columns[i].dtype, fields[i]))
+            columns[i][n] = value
+        n += 1
+    if n < capacity:
+        # don't keep the spare room alive:
+        columns = [column[:n].copy() for column in columns]
+    return OrderedDict(zip(fields, columns))
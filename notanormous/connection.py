@@ -1,18 +1,220 @@
+"""
+Which database each Document class uses, and where its reads go.
+
+`setup_all(db)` gives every class the same database. Classes whose collections live elsewhere, e.g. on
+another cluster, can be bound to their own database with `bind` (or the `bindings` of `setup_all`).
+
+A database is a pymongo Database, or anything with the same interface: `Document._collection()` is the
+collection attribute of the database, and Notanormous only calls pymongo methods on that. An
+in-process one, for tests and benchmarks, is `notanormous.inmemory.InMemoryClient()['name']`.
+
+Reads go wherever the client's read preference sends them, normally the primary, unless a read
+preference is given, from most to least specific:
+
+* per query: `find(..., read_preference='secondaryPreferred')`, `get_by_id(..., read_preference=...)`
+* per block: everything read inside `with read_preference('secondary'):`, including references
+* per class: `__read_preference__ = 'secondaryPreferred'` or `bind(cls, read_preference=...)`
+
+A read preference is one of the mode names 'primary', 'primaryPreferred', 'secondary',
+'secondaryPreferred' and 'nearest', or a pymongo `ReadPreference`. Writes always go to the primary.
+
+Routing listeners, added with `add_routing_listener`, are called as
+`listener(document_class, operation, mode)` for every read, `mode` being the mode name or None for the
+client's default.
+"""
+
+from contextlib import contextmanager
+import threading
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+from pymongo.read_preferences import ReadPreference
+
 connection = None
 
 options = {
-    
+
+}
+
+MODES = {
+    'primary': 'PRIMARY',
+    'primaryPreferred': 'PRIMARY_PREFERRED',
+    'secondary': 'SECONDARY',
+    'secondaryPreferred': 'SECONDARY_PREFERRED',
+    'nearest': 'NEAREST',
 }
 
-def setup_all(db):
+ROUTING_LISTENERS = []
+
+UNBOUND_READ_PREFERENCES = dict()  # class -> its own __read_preference__ before `bind` changed it
+_INHERITED = object()  # it had none of its own
+
+
+def setup_all(db, bindings=None):
+    """
+    :param db: the database for every Document class.
+    :param bindings: dict of Document class (or class name) -> database, for classes which use
+        another one.
+    """
     from notanormous.document import DOCUMENTS, Document
     Document._db = db
-    
+    for cls, cls_db in (bindings or {}).iteritems():
+        bind(cls, cls_db)
+
     # for cls in DOCUMENTS:
     #     cls._s(db)
-    
-    
 
 
+def bind(document_class, db=None, read_preference=None):
+    """
+    Makes `document_class` use `db` rather than the database given to `setup_all`, and/or read with
+    `read_preference` by default.
+    """
+    if isinstance(document_class, basestring):
+        from notanormous.document import DOCUMENT_MAP
+        document_class = DOCUMENT_MAP[document_class]
+    if db is not None:
+        document_class._db = db
+        document_class._indexes_created = False
+    if read_preference is not None:
+        mode_name(read_preference)  # fail now rather than at the first read
+        UNBOUND_READ_PREFERENCES.setdefault(document_class,
+                                            document_class.__dict__.get('__read_preference__', _INHERITED))
+        document_class.__read_preference__ = read_preference
+
+
+def unbind(document_class):
+    """
+    Goes back to the database given to `setup_all`, and to the read preference the class had before
+    `bind`.
+    """
+    if isinstance(document_class, basestring):
+        from notanormous.document import DOCUMENT_MAP
+        document_class = DOCUMENT_MAP[document_class]
+    if '_db' in document_class.__dict__:
+        del document_class._db
+        document_class._indexes_created = False
+    if document_class in UNBOUND_READ_PREFERENCES:
+        previous = UNBOUND_READ_PREFERENCES.pop(document_class)
+        if previous is not _INHERITED:
+            document_class.__read_preference__ = previous
+        elif '__read_preference__' in document_class.__dict__:
+            del document_class.__read_preference__
+
+
+def mode_name(read_preference):
+    """The mode name of `read_preference`, e.g. 'secondaryPreferred'."""
+    if read_preference is None:
+        return None
+    if isinstance(read_preference, basestring):
+        if read_preference not in MODES:
+            raise ValueError("Unknown read preference {0!r}, use one of {1}.".format(
+                read_preference, ', '.join(sorted(MODES))))
+        return read_preference
+    for name, const in MODES.iteritems():
+        if getattr(ReadPreference, const) == read_preference:
+            return name
+    # pymongo 3 read preferences with tag sets etc. know their own name:
+    return getattr(read_preference, 'mongos_mode', None) or repr(read_preference)
+
+
+def pymongo_read_preference(read_preference):
+    if isinstance(read_preference, basestring):
+        mode_name(read_preference)
+        return getattr(ReadPreference, MODES[read_preference])
+    return read_preference
+
+
+def with_read_preference(collection, read_preference):
+    """Returns `collection` reading with `read_preference`."""
+    pref = pymongo_read_preference(read_preference)
+    if hasattr(collection, 'with_options'):
+        return collection.with_options(read_preference=pref)
+    # pymongo 2 makes a new Collection object on every attribute access, so this is ours to change:
+    collection.read_preference = pref
+    return collection
+
+
+if contextvars is not None:
+    _current = contextvars.ContextVar('notanormous_read_preference', default=None)
+
+    def _get_scoped():
+        return _current.get()
+
+    def _set_scoped(value):
+        return _current.set(value)
+
+    def _reset_scoped(token):
+        _current.reset(token)
+else:
+    _local = threading.local()
+
+    def _get_scoped():
+        return getattr(_local, 'read_preference', None)
+
+    def _set_scoped(value):
+        previous = _get_scoped()
+        _local.read_preference = value
+        return previous
+
+    def _reset_scoped(previous):
+        _local.read_preference = previous
+
+
+@contextmanager
+def read_preference(pref):
+    """
+    Every read inside the `with` block uses `pref`, unless given one of its own.
+    """
+    mode_name(pref)
+    token = _set_scoped(pref)
+    try:
+        yield pref
+    finally:
+        _reset_scoped(token)
+
+
+def bind_read_preference(fn):
+    """
+    Returns `fn` wrapped to run with the caller's `read_preference` block, if in one, wherever it's
+    called from. Use this when handing work to another thread.
+    """
+    pref = _get_scoped()
+    if pref is None:
+        return fn
+    def bound(*args, **kw):
+        token = _set_scoped(pref)
+        try:
+            return fn(*args, **kw)
+        finally:
+            _reset_scoped(token)
+    return bound
+
+
+def current_read_preference(document_class, pref=None):
+    """
+    The read preference for a read of `document_class`: `pref` if given, else the block's, else the
+    class's.
+    """
+    if pref is None:
+        pref = _get_scoped()
+    if pref is None:
+        pref = document_class.__read_preference__
+    return pref
+
+
+def add_routing_listener(listener):
+    if listener not in ROUTING_LISTENERS:
+        ROUTING_LISTENERS.append(listener)
+
+
+def remove_routing_listener(listener):
+    if listener in ROUTING_LISTENERS:
+        ROUTING_LISTENERS.remove(listener)
+
 
-    
\ No newline at end of file
+def routed(document_class, operation, pref):
+    for listener in list(ROUTING_LISTENERS):
+        listener(document_class, operation, mode_name(pref))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+__all__ = ['DocumentCursor']
+
+
+class DocumentCursor(object):
+    """
+    Wraps the Cursor returned by pymongo for a Document class's collection.
+
+    By default it behaves just like the pymongo Cursor, you get raw dicts when you iterate over it, and
+    `sort`, `limit`, `skip`, etc. still chain. Call `documents()` to get Documents instead. Documents
+    are created lazily, one batch at a time as pymongo fetches them, and any which are already open
+    (in the current identity map) are returned as-is rather than being loaded again.
+    """
+    def __init__(self, document_class, cursor, hydrate=False):
+        self.document_class = document_class
+        self.cursor = cursor
+        self.hydrate = hydrate
+
+    def __getattr__(self, key):
+        if key == 'cursor':
+            raise AttributeError(key)
+        attr = getattr(self.cursor, key)
+        if not callable(attr):
+            return attr
+        def chained(*args, **kw):
+            result = attr(*args, **kw)
+            # keep chaining through us:
+            if result is self.cursor:
+                return self
+            if isinstance(result, self.cursor.__class__):
+                return DocumentCursor(self.document_class, result, hydrate=self.hydrate)
+            return result
+        return chained
+
+    def documents(self):
+        """
+        Iterate over Documents rather than raw dicts from here on.
+        """
+        self.hydrate = True
+        return self
+
+    def to_columns(self, fields, dtypes=None):
+        """
+        Reads the (remaining) results into one NumPy array per field, without making any Documents.
+        Returns an OrderedDict of field -> array, dtypes coming from the Fields (see
+        `notanormous.columns`)::
+
+            cols = Coord.find({'x': {'$gt': 0}}, fields=['x', 'y']).to_columns(['x', 'y'])
+            lengths = numpy.hypot(cols['x'], cols['y'])
+
+        Fields may be dotted paths into embedded Documents. Pass `fields` to `find` as well, so only
+        those are sent over the wire.
+        """
+        from notanormous.columns import to_columns
+        size = None
+        count = getattr(self.cursor, 'count', None)
+        if count is not None:
+            size = count(True)
+        return to_columns(self.document_class, self.cursor, fields, dtypes=dtypes, size=size)
+
+    def _make_document(self, item):
+        from notanormous.document import _make_document
+        return _make_document(item)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        item = self.cursor.next()
+        if self.hydrate:
+            return self._make_document(item)
+        return item
+    __next__ = next
+
+    def __getitem__(self, index):
+        result = self.cursor[index]
+        if isinstance(index, slice):
+            return self
+        if self.hydrate:
+            return self._make_document(result)
+        return result
+
+    def __repr__(self):
+        return "<DocumentCursor of {0}>".format(self.document_class.__name__)
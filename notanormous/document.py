@@ -3,93 +3,144 @@
 from __future__ import print_function
 
 from collections import OrderedDict
+import copy
 import datetime
 from pprint import pformat
 
+from bson import BSON
 from bson.objectid import ObjectId
 from bson.dbref import DBRef
 import pymongo
 from pymongo.cursor import Cursor
-from pymongo.errors import OperationFailure
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
-from notanormous.fields import Field, EmbeddedDocumentField, ObjectIdField, \
-    DBRefField, ListField, OrderedDictField
+from notanormous import instrument, migration, nplusone, profiling
+from notanormous.connection import current_read_preference, mode_name, routed, with_read_preference
+from notanormous.cursor import DocumentCursor
+from notanormous.fields import Field, DateTimeField, EmbeddedDocumentField, ObjectIdField, \
+    DBRefField, ListField, LocationField, OrderedDictField, StringField, WebURLField, geojson_point
 from notanormous.exceptions import ValidationError
+from notanormous.identity import OPEN_DOCUMENTS, current_identity_map
+from notanormous.urlcheck import verify_fields
 from notanormous.util import make_embeddable
 
 
 __all__ = [
     'Document',
+    'DocumentCursor',
     'DocumentMapSingleton',
     'EmbedOnlyAbuse',
     'ILLEGAL_FIELD_NAMES',
     'NoConnectionError',
+    'ReverseReference',
     '_make_document',
     '_make_documents',
 ]
 
 ILLEGAL_FIELD_NAMES = [
+    'adelete',
+    'afind',
+    'aget_by_id',
+    'aref',
+    'arefresh',
+    'asave',
     'collection',
+    'export',
     'fields_to_load',
     'find',
+    'flush_writes',
     'get_by_id',
+    'import_',
     'is_valid',
+    'near',
     'new_from_mongodb',
+    'paginate',
+    'parallel_scan',
     'pre_save',
+    'prefetch',
+    'refresh_many',
     'save',
     'save_prep',
+    'search',
+    'search_score',
     'to_mongodb',
+    'validate_many',
+    'validation_errors',
+    'within',
     '_collection',
     '_container',
     '_data',
     '_dirty',
     '_fields',
+    '_validators',
+    '_verified_urls',
     '_make_document',
     '_make_documents',
+    '_read_collection',
+    '_save_behind',
     '_set_db',
     '__index__',
+    '__index_references__',
+    '__read_preference__',
     '__stored_properties__',
+    '__write_behind__',
 ]
 
-OPEN_DOCUMENTS = dict()
 DOCUMENTS = []
 COLLECTION_MAP = dict()  # mapping of collection name to class
 DOCUMENT_MAP = {}  # mapping of Document classnames to their respective class
 INDEXES_MADE = []  # list of indexes created so we don't repeat ourselves "classname.spec" where
 # spec is a str of what came in on __index__
+REFRESH_BATCH = 1000  # most _ids in one $in query of refresh_many
+MAX_ID_ATTEMPTS = 20  # how many times save tries to get a new _id when others are saving at the same time
+PENDING_REVERSE_REFERENCES = dict()  # target classname -> [(accessor name, ReverseReference), ...] for
+# classes which haven't been defined yet
 
 
+# The open Documents live in the current identity map, see `notanormous.identity`. Outside of any
+# `identity_map()` block that's the process-wide OPEN_DOCUMENTS.
+
 def update_open_documents(doc):
     if doc.__class__.__embed_only__:
         return doc
-    clsname = doc.__class__.__name__
     if not doc._id:
         return doc
-    OPEN_DOCUMENTS[clsname][doc._id] = doc
-    return doc
+    if profiling.active:
+        start = profiling.clock()
+        doc = current_identity_map().add(doc)
+        profiling.record('identity', doc.__class__, None, start)
+        return doc
+    return current_identity_map().add(doc)
 
 
 def clear_open_documents(clsnames=None, mapping=None):
+    """
+    Forgets the open Documents of `clsnames` (default: all classes), or if given a `mapping` of
+    {classname: [_id, ...]}, just those.
+    """
+    imap = current_identity_map()
+    if mapping:
+        for clsname, ids in mapping.iteritems():
+            for _id in ids:
+                imap.discard(clsname, _id)
+        return
     if not clsnames:
         clsnames = DOCUMENT_MAP.keys()
-    for clsname in clsnames:
-        if DOCUMENT_MAP[clsname].__embed_only__:
-            continue
-        for _id, doc in OPEN_DOCUMENTS[clsname].iteritems():
-            if not mapping:
-                del doc
-            if mapping and clsname in mapping and _id in mapping[clsname]:
-                del doc
-        if not mapping:
-            OPEN_DOCUMENTS[clsname] = dict()
+    imap.clear([clsname for clsname in clsnames if not DOCUMENT_MAP[clsname].__embed_only__])
 
 
 def get_open_document(clsname, _id):
-    if clsname not in OPEN_DOCUMENTS:
-        return None
-    if _id in OPEN_DOCUMENTS[clsname]:
-        return OPEN_DOCUMENTS[clsname][_id]
-    return None
+    """
+    :param clsname: a Document class, or its name.
+    """
+    if not isinstance(clsname, basestring):
+        clsname = clsname.__name__
+    if profiling.active:
+        start = profiling.clock()
+        doc = current_identity_map().get(clsname, _id)
+        profiling.record('identity', DOCUMENT_MAP[clsname], None, start)
+        return doc
+    return current_identity_map().get(clsname, _id)
 
 
 def _make_documents(result):
@@ -102,7 +153,10 @@ def _make_documents(result):
     :param result: may be a single result, cursor, or list.
     """
     global DOCUMENT_MAP
-    is_cursor = isinstance(result, Cursor)
+    if isinstance(result, DocumentCursor):
+        result = result.cursor
+    # pymongo's Cursor, or anything else which iterates like one:
+    is_cursor = isinstance(result, Cursor) or (not isinstance(result, (list, dict)) and hasattr(result, 'next'))
     if is_cursor:
         result = list(result)
     if not isinstance(result, list):
@@ -131,8 +185,9 @@ def _make_document(item):
     except KeyError:
         raise ValueError("You tried to make_documents from an improperly saved or otherwise unusable result. "
                          "(It did not contain a _classname I recognize.)")
-    if item['_id'] in OPEN_DOCUMENTS[item['_data']['_classname']]:
-        return OPEN_DOCUMENTS[item['_data']['_classname']][item['_id']]
+    doc = get_open_document(clsname, item['_id'])
+    if doc is not None:
+        return doc
     doc = cls.new_from_mongodb(item)
     doc = update_open_documents(doc)
     return doc
@@ -175,12 +230,95 @@ def id_getter(field_spec, target_class):
 
 def get_reference_by_id(target_class, id_):
     try:
-        r = _make_documents(target_class._collection().find_one({'_id': id_}))
+        r = _make_documents(target_class._read_collection('reference').find_one({'_id': id_}))
     except Exception, msg:
         return None
     return r[0]
 
 
+def _modification_fields(cls):
+    """The `auto_now` DateTimeFields of `cls`, which change on every save."""
+    return sorted(name for name, field in cls._fields.iteritems()
+                  if isinstance(field, DateTimeField) and field.auto_now)
+
+
+def _modification_stamp(values, field_names):
+    """
+    What `refresh_many(skip_unchanged=True)` compares, from a Document or a dict from MongoDB. Times are
+    cut to milliseconds, like MongoDB stores them.
+    """
+    if isinstance(values, Document):
+        stamp = [getattr(values, name, None) for name in field_names]
+        version = values._data.get('_version', None)
+    else:
+        stamp = [values.get(name, None) for name in field_names]
+        version = values.get('_data', {}).get('_version', None)
+    stamp = [value.replace(microsecond=value.microsecond // 1000 * 1000, tzinfo=None)
+             if isinstance(value, datetime.datetime) else value for value in stamp]
+    return tuple(stamp) + (version,)
+
+
+def _reference_field(field):
+    """
+    Returns the ObjectIdField or DBRefField behind `field`, which may be a ListField of them, or None.
+    """
+    if isinstance(field, (ObjectIdField, DBRefField)):
+        return field
+    if isinstance(field, ListField) and isinstance(getattr(field, 'field', None), (ObjectIdField, DBRefField)):
+        return field.field
+    return None
+
+
+class ReverseReference(object):
+    """
+    The reverse side of a reference field, e.g. `author.book_set` for `Book.author_id`. These are
+    generated on the target class for you by `DocumentMeta`.
+    
+    Accessing it returns a `DocumentCursor` of the Documents which refer to this one. Index the
+    reference field (`index=True` or `__index_references__`) or this will be a collection scan.
+    
+    The name is `<classname>_set` unless the field gives a `related_name`. When more than one field of
+    a class refers to the same target class, it's `<classname>_set_by_<field name>` instead.
+    """
+    def __init__(self, document_class, field_name, field):
+        self.document_class = document_class
+        self.field_name = field_name
+        self.field = field
+        self.name = None
+
+    def query(self, obj):
+        if isinstance(_reference_field(self.field), DBRefField):
+            return {self.field_name: obj.dbref}
+        return {self.field_name: obj._id}
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        # nothing can refer to an unsaved Document, but callers may still chain cursor methods:
+        if not obj._id:
+            return self.document_class.find({'_id': {'$in': []}}).documents()
+        if nplusone.active:
+            nplusone.resolving(owner, self.name, reverse=self)
+        return self.document_class.find(self.query(obj)).documents()
+
+
+def _attach_reverse_reference(target_class, prop_name, reverse):
+    existing = target_class.__dict__.get(prop_name, None)
+    if prop_name in target_class._fields or (existing is not None and not isinstance(existing, ReverseReference)):
+        raise ValueError("Cannot add reverse reference {0}.{1} for {2}.{3}, that name is taken. "
+                         "Use related_name to pick another.".format(target_class.__name__, prop_name,
+                                                                    reverse.document_class.__name__,
+                                                                    reverse.field_name))
+    if isinstance(existing, ReverseReference) and \
+            (existing.document_class.__name__, existing.field_name) != \
+            (reverse.document_class.__name__, reverse.field_name):
+        raise ValueError("{0}.{1} is already the reverse reference for {2}.{3}. Use related_name on {4}.{5}.".format(
+            target_class.__name__, prop_name, existing.document_class.__name__, existing.field_name,
+            reverse.document_class.__name__, reverse.field_name))
+    reverse.name = prop_name
+    setattr(target_class, prop_name, reverse)
+
+
 class DocumentMeta(type):
     def __init__(cls, name, bases, ns):
         # copy fields to class:
@@ -198,6 +336,8 @@ class DocumentMeta(type):
             COLLECTION_MAP[cls.__collection__] = cls
         fields = dict()
         properties = []
+        references = []
+        cls._reference_properties = dict()  # property name -> reference field name, for `prefetch`
         for field_name, field_spec in ns.iteritems():
             if isinstance(field_spec, Field) or \
                     (hasattr(field_spec.__class__, '__bases__') and Field in field_spec.__class__.__bases__):
@@ -210,6 +350,9 @@ class DocumentMeta(type):
                 if field_name in ILLEGAL_FIELD_NAMES:
                     raise ValueError("You cannot have a field named {0}".format(field_name))
                 cls._fields[field_name] = field_spec
+                ref_field = _reference_field(field_spec)
+                if ref_field is not None and ref_field.document_class and ref_field.related_name is not False:
+                    references.append((field_name, field_spec, ref_field))
             # create automatic ObjectId and DBRef lookup properties:
             if isinstance(field_spec, ObjectIdField) and field_spec.document_class:
                 ending = None
@@ -234,6 +377,7 @@ class DocumentMeta(type):
 
                     properties.append((prop_name, property(getter_factory(field_name),
                                                            setter_factory(field_name))))
+                    cls._reference_properties[prop_name] = field_name
             if isinstance(field_spec, ListField) and (
                         hasattr(field_spec, 'field') and isinstance(field_spec.field, (ObjectIdField, DBRefField))):
                 ending = None
@@ -264,9 +408,65 @@ class DocumentMeta(type):
                     return getter
 
                 properties.append((prop_name, property(getter_factory(field_name), setter_factory(field_name)) ))
+                cls._reference_properties[prop_name] = field_name
         # now attach those properties:
         for prop_name, prop in properties:
             setattr(cls, prop_name, prop)
+        # and the reverse references on the classes we refer to, and from classes defined before us:
+        if name != 'Document' and not cls.__embed_only__:
+            _make_reverse_references(cls, references)
+        for prop_name, reverse in PENDING_REVERSE_REFERENCES.pop(name, []):
+            _attach_reverse_reference(cls, prop_name, reverse)
+        _compile_validators(cls)
+
+
+def _compile_validators(cls):
+    """
+    Compiles the checks `is_valid` runs for each field, see `Field.compile_validator`. Fields which
+    accept anything are left out.
+    """
+    validators = []
+    verified_urls = []
+    for field_name in sorted(cls._fields):
+        field = cls._fields[field_name]
+        check = field.compile_validator()
+        if check is not None:
+            validators.append((field_name, check))
+        if isinstance(field, WebURLField) and field.verify is True:
+            verified_urls.append((field_name, field))
+    cls._validators = validators
+    cls._verified_urls = verified_urls
+
+
+def _make_reverse_references(cls, references):
+    """
+    Creates a `ReverseReference` on each class referred to by `references`, a list of
+    (field name, field, reference field) for `cls`. Classes which don't exist yet get theirs when
+    they are defined.
+    """
+    targets = dict()
+    for field_name, field_spec, ref_field in references:
+        if ref_field.related_name:
+            continue
+        target = ref_field.document_class
+        if not isinstance(target, basestring):
+            target = target.__name__
+        targets[target] = targets.get(target, 0) + 1
+    for field_name, field_spec, ref_field in references:
+        target = ref_field.document_class
+        if not isinstance(target, basestring):
+            target = target.__name__
+        prop_name = ref_field.related_name
+        if not prop_name:
+            prop_name = cls.__name__.lower() + '_set'
+            # more than one field refers to the same class, so say which one:
+            if targets[target] > 1:
+                prop_name += '_by_' + field_name
+        reverse = ReverseReference(cls, field_name, field_spec)
+        if target in DOCUMENT_MAP:
+            _attach_reverse_reference(DOCUMENT_MAP[target], prop_name, reverse)
+        else:
+            PENDING_REVERSE_REFERENCES.setdefault(target, []).append((prop_name, reverse))
 
 
 class Document(object):
@@ -289,7 +489,16 @@ class Document(object):
         access directly from pymongo for searching, etc.
     
     :param __index__: list of fields to index. Use a list to make a multi-field index.
+    :param __index_references__: if `True`, index every `ObjectIdField` and `DBRefField` (and `ListField`
+        of them) unless the field says `index=False`. Default is `False`, so only reference fields
+        declared with `index=True` are indexed. Reverse references such as `author.book_set` query on
+        these fields, so you probably want them indexed.
     :param __unique__: list of fields index with `unique=True`
+    :param __text_language__: default language of the text index made for `searchable` StringFields.
+    :param __write_behind__: `True`, or a dict of `notanormous.writebehind.WriteBehindQueue` options, to
+        queue `save(safe=False)` and write in bulk from a background thread. See `notanormous.writebehind`.
+    :param __read_preference__: where reads of this class go by default, e.g. 'secondaryPreferred' for
+        reporting data. See `notanormous.connection`.
     :param __embed_only__: indicates a document which should only be embedded and never have a
         collection created for it. You can use __index__ and __unique__ with an
         embedded document.
@@ -301,12 +510,16 @@ class Document(object):
     __metaclass__ = DocumentMeta
     __stored_properties__ = []
     __index__ = []
+    __index_references__ = False
     __unique__ = []
+    __text_language__ = 'english'
     __index_desc__ = []
     __embed_only__ = False
     __auto_create__ = False
     __version__ = 1
     __serial_index__ = False
+    __write_behind__ = False
+    __read_preference__ = None
     _db = None
     _indexes_created = False
     _collection = None
@@ -314,6 +527,9 @@ class Document(object):
     _container = None
     _cache = None
     _data = {}
+    _validators = []
+    _verified_urls = []
+    search_score = None
 
     def __init__(self, adict=None, **kw):
         if not adict:
@@ -377,10 +593,12 @@ class Document(object):
         field = self._fields[field_name]
         tc = field.get_target_class()
         id_ = getattr(self, field_name)
-        item = get_open_document(tc.__class__.__name__, id_)
+        item = get_open_document(tc, id_)
         if item:
             return item
-        item = tc._collection().find_one({'_id': id_})
+        if nplusone.active:
+            nplusone.resolving(self.__class__, field_name)
+        item = tc._read_collection('reference').find_one({'_id': id_})
         if not item:
             return None
         return tc.new_from_mongodb(item)
@@ -419,7 +637,10 @@ class Document(object):
                     found_refs.append(ref)
             for ref in found_refs:
                 refs_to_find.remove(ref)
-            found.extend(_make_documents(list(field_class._collection().find({'_id': {'$in': refs_to_find}}))))
+            if refs_to_find and nplusone.active:
+                nplusone.resolving(self.__class__, field_name)
+            found.extend(_make_documents(list(field_class._read_collection('reference').find(
+                {'_id': {'$in': refs_to_find}}))))
             sorted_items = sort_dicts_by_id_list(found, refs)
             return sorted_items
         # @TODO: fixup this to use OPEN_DOCUMENTS too.
@@ -437,8 +658,11 @@ class Document(object):
                     found_refs.append(dbref)
             for found_ref in found_refs:
                 refs_to_find.remove(found_ref)
+            if refs_to_find and nplusone.active:
+                nplusone.resolving(self.__class__, field_name)
             for dbref in refs_to_find:
-                item = self._db.dereference(dbref)
+                # the referred class may live in another database:
+                item = COLLECTION_MAP[dbref.collection]._read_collection('reference').find_one({'_id': dbref.id})
                 if not item:
                     continue
                 found_refs.append(_make_document(item))
@@ -455,12 +679,34 @@ class Document(object):
 
 
     @classmethod
-    def _collection(cls):
+    def _collection(cls, operation=None):
+        """
+        The collection of this class. With `operation`, e.g. 'save', and instrumentation enabled, it
+        records the commands sent through it (see `notanormous.instrument`).
+        """
         if cls.__embed_only__:
             raise EmbedOnlyAbuse("Class {0} is embed-only, it has no collection.".format(cls.__name__))
         if not cls._db:
             raise Exception("cannot have the _collection without a _db")
-        return getattr(cls._db, cls.__collection__)
+        coll = getattr(cls._db, cls.__collection__)
+        if operation is not None and instrument.enabled:
+            return instrument.instrumented(cls, coll, operation)
+        return coll
+
+    @classmethod
+    def _read_collection(cls, operation, read_preference=None):
+        """
+        The collection to read from for `operation`, using the read preference which applies (see
+        `notanormous.connection`).
+        """
+        pref = current_read_preference(cls, read_preference)
+        coll = cls._collection()
+        if pref is not None:
+            coll = with_read_preference(coll, pref)
+        routed(cls, operation, pref)
+        if instrument.enabled:
+            return instrument.instrumented(cls, coll, operation, mode_name(pref))
+        return coll
 
 
     @staticmethod
@@ -491,7 +737,7 @@ class Document(object):
                 target_class = field.get_target_class()
                 if isinstance(target_class, basestring):
                     target_class = DOCUMENT_MAP.get(target_class, None)
-                Document._make_indexes(coll, prefix + field_name, target_class.__index__,
+                Document._make_indexes(coll, prefix + field_name, target_class._index_specs(),
                                        target_class._fields, level + 1)
                 continue
             if isinstance(field, ListField) and isinstance(field.field, EmbeddedDocumentField):
@@ -500,10 +746,62 @@ class Document(object):
                     target_class = DOCUMENT_MAP.get(target_class, None)
                 if not target_class:
                     raise Exception("{0}'s Embedded document class does not exist!? WTF?")
-                Document._make_indexes(coll, prefix + field_name, target_class.__index__,
+                Document._make_indexes(coll, prefix + field_name, target_class._index_specs(),
                                        target_class._fields, level + 1)
 
 
+    @classmethod
+    def _index_specs(cls):
+        """
+        The class's `__index__`, plus any reference fields which should be indexed and the 2dsphere
+        indexes for `LocationField(index=True)` fields.
+        """
+        specs = list(cls.__index__)
+        indexed = [spec if isinstance(spec, basestring) else spec[0] for spec in specs]
+        for field_name, field in cls._fields.iteritems():
+            if field_name == '_id' or field_name in indexed:
+                continue
+            if isinstance(field, LocationField):
+                if field.index:
+                    specs.append((field_name, pymongo.GEOSPHERE))
+                continue
+            ref_field = _reference_field(field)
+            if ref_field is None:
+                continue
+            index = field.index
+            if index is None:
+                index = ref_field.index
+            if index is None:
+                index = cls.__index_references__
+            if index:
+                specs.append(field_name)
+        return specs
+
+
+    @classmethod
+    def _text_weights(cls, prefix='', level=1):
+        """
+        Returns a dict of {field path: weight} for all `searchable` StringFields, including those in
+        embedded Documents.
+        """
+        if level > 20:
+            raise Exception("Over 20 levels deep? You need to re-think your document structure, weirdo.")
+        if prefix:
+            prefix += '.'
+        weights = dict()
+        for field_name, field in cls._fields.iteritems():
+            if isinstance(field, ListField):
+                field = field.field
+            if isinstance(field, StringField) and field.searchable:
+                weights[prefix + field_name] = field.search_weight
+            elif isinstance(field, EmbeddedDocumentField):
+                target_class = field.get_target_class()
+                if isinstance(target_class, basestring):
+                    target_class = DOCUMENT_MAP[target_class]
+                weights.update(target_class._text_weights(prefix + field_name, level + 1))
+        return weights
+
+
     @classmethod
     def _drop_indexes(cls):
         if cls.__embed_only__:
@@ -523,7 +821,14 @@ class Document(object):
         if cls.__embed_only__:
             return
         coll = cls._collection()
-        Document._make_indexes(coll, '', cls.__index__, cls._fields)
+        Document._make_indexes(coll, '', cls._index_specs(), cls._fields)
+        # MongoDB allows one text index per collection, so all the searchable fields go in it:
+        weights = cls._text_weights()
+        if weights:
+            coll.create_index([(path, 'text') for path in sorted(weights)], weights=weights,
+                              name=cls.__collection__ + '_text', default_language=cls.__text_language__,
+                              # don't let a field which happens to be called `language` pick the language:
+                              language_override='_text_language')
         cls._indexes_created = True
 
     @classmethod
@@ -583,37 +888,171 @@ class Document(object):
     @classmethod
     def find(cls, *pargs, **kargs):
         """
-        Convenience method, just returns pymongo's `find` for the collection, which
-        will return a pymongo Cursor object.
+        Convenience method, just returns pymongo's `find` for the collection, wrapped in a
+        `DocumentCursor`.
         
-        You must still run the results through `make_documents` if you want full-featured Documents.
-        Otherwise, you get the same as using pymongo directly.
+        Iterating gives you the same raw dicts as using pymongo directly. Call `documents()` on the
+        cursor (or run the results through `make_documents`) if you want full-featured Documents.
+        
+        Takes a `read_preference` keyword argument, see `notanormous.connection`.
         """
-        return cls._collection().find(*pargs, **kargs)
+        coll = cls._read_collection('find', kargs.pop('read_preference', None))
+        return DocumentCursor(cls, coll.find(*pargs, **kargs))
+
+
+    @classmethod
+    def paginate(cls, query=None, order_by=None, page_size=20, after=None, read_preference=None):
+        """
+        One page of the Documents matching `query`, sorted by `order_by`, as a `Page`. Pass its `next`
+        token as `after` for the page after it. Each page costs about the same however deep it is, see
+        `notanormous.pagination`.
+        
+        :param order_by: a key, '-key' for descending, (key, direction), or a list of those. `_id` is
+            added to break ties.
+        """
+        from notanormous.pagination import paginate
+        return paginate(cls, query, order_by=order_by, page_size=page_size, after=after,
+                        read_preference=read_preference)
 
 
     # @classmethod
     # def find(cls, query, sort=None, fields=None, raw=False):
 
+
+    @classmethod
+    def _location_field(cls, field_name=None):
+        if field_name:
+            if not isinstance(cls._fields.get(field_name, None), LocationField):
+                raise ValueError("{0}.{1} is not a LocationField.".format(cls.__name__, field_name))
+            return field_name
+        names = [name for name, field in cls._fields.iteritems() if isinstance(field, LocationField)]
+        if len(names) != 1:
+            raise ValueError("{0} has {1} LocationFields, tell me which one to use.".format(
+                cls.__name__, len(names)))
+        return names[0]
+
+    @classmethod
+    def near(cls, point, max_distance=None, min_distance=None, query=None, field=None, limit=None):
+        """
+        Returns a `DocumentCursor` of Documents near `point`, nearest first. The server does the sorting,
+        using the 2dsphere index on `field`, so the field needs `index=True`.
+        
+        :param point: anything a `LocationField` accepts.
+        :param max_distance: in meters.
+        :param min_distance: in meters.
+        :param query: any other criteria, as you'd give to `find`.
+        :param field: name of the LocationField. Optional if the class has only one.
+        """
+        field = cls._location_field(field)
+        near = {'$geometry': geojson_point(point)}
+        if max_distance is not None:
+            near['$maxDistance'] = max_distance
+        if min_distance is not None:
+            near['$minDistance'] = min_distance
+        spec = dict(query or {})
+        spec[field] = {'$near': near}
+        cursor = cls.find(spec)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor.documents()
+
+    @classmethod
+    def within(cls, geometry, query=None, field=None):
+        """
+        Returns a `DocumentCursor` of Documents whose location is within `geometry`, a GeoJSON Polygon or
+        MultiPolygon. These come back in no particular order, use `near` with `max_distance` for
+        "within this radius, nearest first".
+        
+        :param query: any other criteria, as you'd give to `find`.
+        :param field: name of the LocationField. Optional if the class has only one.
+        """
+        field = cls._location_field(field)
+        spec = dict(query or {})
+        spec[field] = {'$geoWithin': {'$geometry': geometry}}
+        return cls.find(spec).documents()
+
+    @classmethod
+    def parallel_scan(cls, func, workers=None, chunk=1000, **kw):
+        """
+        Applies `func` to every Document of this class, split into ranges of `chunk` serial `_id`s which
+        are processed by `workers` processes. See `notanormous.parallel.parallel_scan` for the options
+        (query, reducer, write_back, progress, checkpoint).
+        """
+        from notanormous.parallel import parallel_scan
+        return parallel_scan(cls, func, workers=workers, chunk=chunk, **kw)
+
+
+    @classmethod
+    def export(cls, path, query=None, format='bson', compress=True):
+        """
+        Streams the stored documents (matching `query`) to a file, as 'bson' or 'jsonl', gzipped unless
+        `compress` is `False`. Returns how many were written. See `notanormous.transfer`.
+        """
+        from notanormous.transfer import export
+        return export(cls, path, query=query, format=format, compress=compress)
+
+    @classmethod
+    def import_(cls, path, batch=1000, format=None, workers=None):
+        """
+        Bulk inserts the documents from a file made by `export`, `batch` at a time, in `workers` threads
+        if given. Returns how many were inserted.
+        """
+        from notanormous.transfer import import_
+        return import_(cls, path, batch=batch, format=format, workers=workers)
+
+
+    @classmethod
+    def search(cls, terms, limit=None, query=None, language=None):
+        """
+        Full text search over the `searchable` StringFields, using the text index. Returns a list of
+        Documents, best match first, each with its relevance in `search_score`.
+        
+        :param terms: words to search for, see MongoDB's `$text` operator for phrases and negation.
+        :param query: any other criteria, as you'd give to `find`.
+        :param language: the language of `terms`, if not the class's `__text_language__`.
+        """
+        text = {'$search': terms}
+        if language:
+            text['$language'] = language
+        spec = dict(query or {})
+        spec['$text'] = text
+        score = {'$meta': 'textScore'}
+        cursor = cls._read_collection('search').find(spec, fields={'_search_score': score}).sort([('_search_score', score)])
+        if limit:
+            cursor = cursor.limit(limit)
+        docs = []
+        for item in cursor:
+            search_score = item.pop('_search_score', None)
+            doc = _make_document(item)
+            object.__setattr__(doc, 'search_score', search_score)
+            docs.append(doc)
+        return docs
+
+
     @classmethod
     def fields_to_load(cls):
         """
         Returns a list of field names suitable to load for most cases, leaving out stored properties.
         
-        To be specific, it excludes all stored properties, and then includes `_data`.
+        To be specific, it excludes all stored properties, and then includes `_data`. Classes with
+        migrations (see `notanormous.migration`) load everything, None, as the migrations may need
+        fields the class no longer has.
         """
+        if cls.__name__ in migration.MIGRATIONS:
+            return None
         fields = cls._fields.keys()
         fields.extend(['_data'])
         return fields
 
 
     @classmethod
-    def get_by_id(cls, some_id, raw=False):
+    def get_by_id(cls, some_id, raw=False, read_preference=None):
         if not isinstance(some_id, (int, long)):
             some_id = int(some_id)
-        if some_id in OPEN_DOCUMENTS[cls.__name__]:
-            return OPEN_DOCUMENTS[cls.__name__][some_id]
-        coll = cls._collection()
+        doc = get_open_document(cls.__name__, some_id)
+        if doc is not None:
+            return doc
+        coll = cls._read_collection('get_by_id', read_preference)
         fields = cls.fields_to_load()
         item = coll.find_one({'_id': some_id}, fields=fields)
         if raw:
@@ -721,17 +1160,117 @@ class Document(object):
         return self._id
 
     def is_valid(self):
-        for field_name, field_def in self._fields.iteritems():
-            field_value = getattr(self, field_name, None)
-            if isinstance(field_def, EmbeddedDocumentField):
-                # if field_def.required is True:
-                return field_def.is_valid(field_value)
-            if not field_def.is_valid(field_value):
-                raise ValueError("For field {0} of class {1}, value {2} is not valid.".format(
-                    field_name, self.__class__.__name__,
-                    repr(getattr(self, field_name, None))))
+        """
+        Checks every field, including those of embedded Documents. Raises a ValidationError (which is a
+        ValueError) listing everything that's wrong, otherwise returns True.
+        """
+        errors = self.validation_errors()
+        if errors:
+            raise ValidationError(_validation_message(self.__class__, errors), errors)
         return True
 
+    def validation_errors(self):
+        """
+        Returns a list of (field path, message) for every field which isn't valid, in one pass over the
+        validators compiled for the class.
+        """
+        errors = []
+        values = object.__getattribute__(self, '__dict__')
+        profile = profiling.active
+        if profile:
+            started = profiling.clock()
+        verified_urls = self.__class__._verified_urls
+        if len(verified_urls) > 1:
+            # check the URLs all at once rather than one field at a time:
+            verify_fields([(field, values.get(field_name, None)) for field_name, field in verified_urls])
+        for field_name, check in self.__class__._validators:
+            if profile:
+                start = profiling.clock()
+                error = check(values.get(field_name, None))
+                profiling.record('validate', self.__class__, field_name, start)
+            else:
+                error = check(values.get(field_name, None))
+            if error is None:
+                continue
+            if isinstance(error, list):
+                errors.extend((u'{0}.{1}'.format(field_name, path), message) for path, message in error)
+            else:
+                errors.append((field_name, error))
+        if profile:
+            profiling.record('validate', self.__class__, None, started)
+        return errors
+
+    @classmethod
+    def validate_many(cls, items):
+        """
+        Validates many Documents, or raw dicts as they would be stored in MongoDB, in one go, e.g. before
+        a bulk insert.
+        
+        Returns a list of (position, errors) for those which aren't valid, errors being a list of
+        (field path, message) as from `validation_errors`. So an empty list means they are all fine.
+        """
+        failures = []
+        for i, item in enumerate(items):
+            if isinstance(item, Document):
+                errors = item.validation_errors()
+            else:
+                errors = cls._raw_validation_errors(item)
+            if errors:
+                failures.append((i, errors))
+        return failures
+
+    @classmethod
+    def _raw_validation_errors(cls, data, level=1):
+        if level > 20:
+            raise Exception("Over 20 levels deep? You need to re-think your document structure, weirdo.")
+        errors = []
+        for field_name, check in cls._validators:
+            field = cls._fields[field_name]
+            if field_name in data:
+                value = data[field_name]
+            else:
+                value = field.default
+                if callable(value):
+                    value = None
+            embedded_class = None
+            if isinstance(field, EmbeddedDocumentField):
+                embedded_class = field.get_target_class()
+            elif isinstance(field, ListField) and isinstance(field.field, EmbeddedDocumentField):
+                embedded_class = field.field.get_target_class()
+            if embedded_class is None:
+                try:
+                    value = field.from_mongodb(value)
+                except Exception, msg:
+                    # a raw value of the wrong type can break the conversion before the check sees it:
+                    errors.append((field_name, u"could not convert a {0}: {1}".format(value.__class__.__name__,
+                                                                                       msg)))
+                    continue
+                error = check(value)
+                if error is not None:
+                    errors.append((field_name, error))
+                continue
+            if isinstance(embedded_class, basestring):
+                embedded_class = DOCUMENT_MAP[embedded_class]
+            if isinstance(field, ListField):
+                if not isinstance(value, list):
+                    errors.append((field_name, u"expected a list, got a {0}.".format(value.__class__.__name__)))
+                    continue
+                items = [(u'{0}.{1}'.format(field_name, i), item) for i, item in enumerate(value)]
+            else:
+                if value is None:
+                    if field.required:
+                        errors.append((field_name, u"expected an embedded Document, got None."))
+                    continue
+                items = [(field_name, value)]
+            for path, item in items:
+                if not isinstance(item, dict):
+                    errors.append((path, u"expected an embedded Document, got a {0}.".format(
+                        item.__class__.__name__)))
+                    continue
+                errors.extend((u'{0}.{1}'.format(path, sub_path), message) for sub_path, message in
+                              embedded_class._raw_validation_errors(item, level + 1))
+        return errors
+
 
     def pre_output(self):
         """
@@ -740,34 +1279,90 @@ class Document(object):
 
     def to_mongodb(self):
         """Output a single dict with all fields and arbitrary data merged."""
+        profile = profiling.active
+        if profile:
+            start = profiling.clock()
         self.pre_output()
+        d = self._field_output(redefault=True)
+        for prop in self.__class__.__stored_properties__:
+            d[prop] = getattr(self, prop, None)
+        if profile:
+            profiling.record('encode', self.__class__, None, start)
+        return d
+
+    def _field_output(self, redefault=False):
+        """
+        The fields, `_id` and `_data` as they'd be stored, without stored properties. `redefault`
+        updates auto_now style fields.
+        """
         d = dict()
+        profile = profiling.active
         for key, field in self._fields.iteritems():
+            if profile:
+                start = profiling.clock()
             orig_value = getattr(self, key, None)
             value = field.to_mongodb(orig_value)
             if value != orig_value:
                 # now we can infer that the field's converter is overridden and we are done with
                 # this field.
                 d[key] = value
-                continue
-            value = to_mongo_output(field, value, self)
-            d[key] = value
-            if getattr(field, '_redefault', False) and not getattr(self, '_manual_set', False):
-                if callable(field.default):
-                    d[key] = field.default()
-                else:
-                    d[key] = field.default
+            else:
+                value = to_mongo_output(field, value, self)
+                d[key] = value
+                if redefault and getattr(field, '_redefault', False) and not getattr(self, '_manual_set', False):
+                    if callable(field.default):
+                        d[key] = field.default()
+                    else:
+                        d[key] = field.default
+            if profile:
+                profiling.record('encode', self.__class__, key, start)
+        if profile:
+            start = profiling.clock()
         x = self._data.copy()
         cleanup_dict(x)
         d['_data'] = x
+        if profile:
+            profiling.record('encode', self.__class__, '_data', start)
         d.pop('id', None)
         # remove empty ID:
         if not d.get('_id', None):
             d.pop('_id', None)
-        for prop in self.__class__.__stored_properties__:
-            d[prop] = getattr(self, prop, None)
         return d
 
+    def __reduce__(self):
+        """
+        Pickles a Document as its class name and the BSON of its fields, `_id` and `_data`, leaving
+        behind the Field objects and back-references which would otherwise be dragged along. That makes
+        Documents cheap to send to `multiprocessing` or `concurrent.futures` workers.
+        
+        Unpickled Documents are rebuilt the same way as when loading from MongoDB, but are detached
+        copies: they are not added to the identity map, and don't replace a Document which is already
+        open there. Like saving, this keeps datetimes only to the millisecond, and fails on values BSON
+        can't hold, e.g. sets or Decimals in `_data`. `copy.copy` and `copy.deepcopy` don't go through
+        BSON, see `__deepcopy__`.
+        """
+        return _unpickle_document, (self.__class__.__name__, BSON.encode(self._field_output()), self._dirty)
+
+    def __deepcopy__(self, memo):
+        """
+        A detached copy, like an unpickled one, made from deep copies of the field values, `_id` and
+        `_data` as they are, not as they'd be stored, so nothing is lost or converted.
+        """
+        doc = self.__class__()
+        memo[id(self)] = doc
+        for key in self._fields:
+            object.__setattr__(doc, key, copy.deepcopy(getattr(self, key, None), memo))
+        object.__setattr__(doc, '_data', copy.deepcopy(self._data, memo))
+        object.__setattr__(doc, '_dirty', self._dirty)
+        # an embedded Document copied along with its container belongs to the copy of the container:
+        if self._container is not None and id(self._container) in memo:
+            object.__setattr__(doc, '_container', memo[id(self._container)])
+        return doc
+
+    def __copy__(self):
+        # a shallow copy would share lists and embedded Documents with this one, so it's deep too:
+        return self.__deepcopy__({})
+
 
     def post_save(self):
         """
@@ -787,31 +1382,62 @@ class Document(object):
     def pre_save(data):
         pass
 
-    def save(self, safe=True, skip_refresh_stored_properties=False):
+    def save(self, safe=True, skip_refresh_stored_properties=False, validate=True):
+        """
+        :param validate: set to `False` to skip `is_valid`. Only do that if you trust the data, or the
+            server checks it for you (see `notanormous.schema`).
+        
+        With `__write_behind__` and `safe=False`, the write is only queued. `post_save` still runs right
+        away.
+        """
         if self.__class__.__embed_only__ is True:
             raise EmbedOnlyAbuse("You cannot save a {0} because it is marked embed-only." \
                                  .format(self.__class__.__name__))
         if not self.__class__._db:
             raise NoConnectionError
-        if not self.is_valid():
+        if validate and not self.is_valid():
             raise ValueError("Some field has bad data.")
-        collection = self._collection()
+        collection = self._collection('save')
         output = self.to_mongodb()
         self.__class__.pre_save(output)
+        writer = None
+        if self.__class__.__write_behind__:
+            from notanormous.writebehind import write_behind_queue
+            if not safe:
+                return self._save_behind(write_behind_queue(self.__class__), output)
+            # don't overtake queued writes:
+            writer = write_behind_queue(self.__class__, create=False)
+            if writer is not None:
+                writer.flush()
         if not self._id:
-            found = False
-            i = 1
-            c = collection.find(fields=['_id']).sort('_id', pymongo.DESCENDING).limit(1)
-            if c.count(True) == 1:
-                i = c.next()['_id'] + 1
-            output['_id'] = i
-            try:
-                self._id = collection.insert(output, safe=safe, check_keys=True)
-            except OperationFailure, msg:
-                print("Oops, could not save myself!")
-                raise
+            # another thread or process may take the same _id between finding the last one and
+            # inserting, in which case try again with the next:
+            for attempt in range(MAX_ID_ATTEMPTS):
+                if writer is not None:
+                    # queued inserts have taken _ids the database doesn't know about yet:
+                    i = writer.next_id()
+                else:
+                    i = 1
+                    c = collection.find(fields=['_id']).sort('_id', pymongo.DESCENDING).limit(1)
+                    if c.count(True) == 1:
+                        i = c.next()['_id'] + 1
+                output['_id'] = i
+                try:
+                    self._id = collection.insert(output, safe=safe, check_keys=True)
+                    break
+                except DuplicateKeyError, msg:
+                    # a clash on another unique index won't go away with the next _id:
+                    clash = _id_clash(msg)
+                    if clash is None:
+                        clash = collection.find_one({'_id': i}, fields=['_id']) is not None
+                    if not clash or attempt == MAX_ID_ATTEMPTS - 1:
+                        raise
+                except OperationFailure, msg:
+                    print("Oops, could not save myself!")
+                    raise
         else:
             collection.update({"_id": self._id}, output, multi=False, safe=safe)
+        self._keep_modification_times(output)
         if not skip_refresh_stored_properties:
             try:
                 self.refresh_stored_properties()
@@ -822,6 +1448,37 @@ class Document(object):
         self.post_save()
         return self
 
+    def _save_behind(self, writer, output):
+        # stored properties are already in `output`, so there's nothing to refresh afterwards:
+        if not self._id:
+            self._id = output['_id'] = writer.next_id()
+            writer.put('insert', output)
+        else:
+            writer.put('replace', output)
+        self._keep_modification_times(output)
+        update_open_documents(self)
+        self.post_save()
+        return self
+
+    def _keep_modification_times(self, output):
+        # `to_mongodb` put the new `auto_now` times in `output` only, but `refresh_many(skip_unchanged=True)`
+        # compares the stored ones with ours:
+        for name in _modification_fields(self.__class__):
+            if name in output:
+                object.__setattr__(self, name, output[name])
+
+    @classmethod
+    def flush_writes(cls, timeout=None):
+        """
+        Waits for the queued writes of a `__write_behind__` class. Returns `False` if `timeout` seconds
+        passed first.
+        """
+        from notanormous.writebehind import write_behind_queue
+        writer = write_behind_queue(cls, create=False)
+        if writer is None:
+            return True
+        return writer.flush(timeout)
+
 
     def pre_delete(self):
         pass
@@ -830,7 +1487,9 @@ class Document(object):
         if not self._id:
             raise Exception("I was never saved, you can't delete me!")
         self.pre_delete()
-        self._collection().remove({'_id': self._id})
+        if self.__class__.__write_behind__:
+            self.flush_writes()
+        self._collection('delete').remove({'_id': self._id})
 
     @property
     def dbref(self):
@@ -854,7 +1513,7 @@ class Document(object):
         fields. You are on your own to manage that mess.
         """
         if not coll:
-            coll = self._collection()
+            coll = self._collection('refresh_stored_properties')
         set_values_dict = dict()
         Document._get_stored_props(self, proplist=proplist, set_values_dict=set_values_dict)
         coll.update({'_id': self._id}, {'$set': set_values_dict})
@@ -916,17 +1575,28 @@ class Document(object):
         if not cls.__embed_only__:
             if not "_id" in data:
                 raise ValueError(u"data from mongo should include an _id. data:\n{d}\n".format(d=pformat(data)))
-            try:
-                if data['_id'] in OPEN_DOCUMENTS[clsname]:
-                    return OPEN_DOCUMENTS[clsname][data['_id']]
-            except KeyError, msg:
-                raise
+            doc = get_open_document(clsname, data['_id'])
+            if doc is not None:
+                return doc
+        if profiling.active:
+            start = profiling.clock()
+            doc = cls()
+            # a Document upgraded by a migration is saved at the new version next time:
+            doc._dirty = doc._from_mongodb(data)
+            profiling.record('decode', cls, None, start)
+            return update_open_documents(doc)
         doc = cls()
-        doc._from_mongodb(data)
-        doc._dirty = False
+        doc._dirty = doc._from_mongodb(data)
         return update_open_documents(doc)
 
     def _from_mongodb(self, d):
+        """Loads `d` from MongoDB into this Document. Returns whether a migration upgraded it."""
+        migrated = False
+        if migration.MIGRATIONS:
+            upgraded = migration.upgrade(self.__class__, d)
+            if upgraded is not None:
+                d, migrated = upgraded, True
+        profile = profiling.active
         for key, value in d.iteritems():
             if key in self.__stored_properties__:
                 continue
@@ -934,42 +1604,192 @@ class Document(object):
                 self._data = value
                 continue
             if key in self._fields:
+                if profile:
+                    start = profiling.clock()
                 field_spec = self._fields[key]
                 if isinstance(field_spec, EmbeddedDocumentField):
-                    if not value:
-                        continue
-                    embedded_doc = Document.new_document_from_dict(value, context_info=u'{0}.{1}'.format(
-                        self.__class__.__name__, key))
-                    embedded_doc._container = self
-                    setattr(self, key, embedded_doc)
-                    continue
-                value = field_spec.from_mongodb(value)
-                if isinstance(value, list):
-                    if len(value) > 0:
-                        if hasattr(field_spec, 'field') and isinstance(field_spec.field, EmbeddedDocumentField):
-                            new_list = list()
-                            for item in value:
-                                embedded_doc = Document.new_document_from_dict(item, context_info=u'{0}.{1}'.format(
-                                    self.__class__.__name__, key))
-                                embedded_doc._container = self
-                                new_list.append(embedded_doc)
-                            value = new_list
-                setattr(self, key, value)
+                    if value:
+                        embedded_doc = Document.new_document_from_dict(value, context_info=u'{0}.{1}'.format(
+                            self.__class__.__name__, key))
+                        embedded_doc._container = self
+                        setattr(self, key, embedded_doc)
+                else:
+                    value = field_spec.from_mongodb(value)
+                    if isinstance(value, list):
+                        if len(value) > 0:
+                            if hasattr(field_spec, 'field') and isinstance(field_spec.field, EmbeddedDocumentField):
+                                new_list = list()
+                                for item in value:
+                                    embedded_doc = Document.new_document_from_dict(
+                                        item, context_info=u'{0}.{1}'.format(self.__class__.__name__, key))
+                                    embedded_doc._container = self
+                                    new_list.append(embedded_doc)
+                                value = new_list
+                    setattr(self, key, value)
+                if profile:
+                    profiling.record('decode', self.__class__, key, start)
             else:
                 # anything that is not defined as a field in the class definition goes under `_data`:
                 self._data[key] = value
         if '_id' in d:
             self._id = d['_id']
+        return migrated
 
     def refresh(self):
         if not self._id:
             raise ValueError("Cannot refresh an unsaved Document.")
-        data = self.__class__._collection().find_one({'_id': self._id}, fields=self.__class__.fields_to_load())
+        data = self.__class__._collection('refresh').find_one({'_id': self._id}, fields=self.__class__.fields_to_load())
         if not data:
             raise ValueError("This document must have been deleted out from under you.")
-        self._from_mongodb(data)
+        if self._from_mongodb(data):
+            # so the upgrade is written back on save:
+            self._dirty = True
         update_open_documents(self)
 
+    @staticmethod
+    def refresh_many(docs, skip_unchanged=False):
+        """
+        Refreshes many Documents, possibly of different classes, with one query per class (per
+        `REFRESH_BATCH` Documents) rather than one per Document.
+        
+        :param skip_unchanged: first load only the `auto_now` DateTimeFields and `_version`, and reload
+            just the Documents where those changed. Classes without an `auto_now` field are always
+            reloaded.
+        
+        Returns the Documents which have been deleted from the database. They are dropped from the
+        identity map.
+        """
+        groups = OrderedDict()
+        for doc in docs:
+            if not doc._id:
+                raise ValueError("Cannot refresh an unsaved Document.")
+            groups.setdefault(doc.__class__, OrderedDict())[doc._id] = doc
+        deleted = []
+        for cls, by_id in groups.iteritems():
+            coll = cls._collection('refresh_many')
+            stamp_fields = []
+            if skip_unchanged:
+                stamp_fields = _modification_fields(cls)
+            ids = list(by_id)
+            found = set()
+            for start in xrange(0, len(ids), REFRESH_BATCH):
+                batch = ids[start:start + REFRESH_BATCH]
+                if stamp_fields:
+                    changed = []
+                    for data in coll.find({'_id': {'$in': batch}}, fields=stamp_fields + ['_data._version']):
+                        found.add(data['_id'])
+                        if _modification_stamp(data, stamp_fields) != \
+                                _modification_stamp(by_id[data['_id']], stamp_fields):
+                            changed.append(data['_id'])
+                    batch = changed
+                    if not batch:
+                        continue
+                for data in coll.find({'_id': {'$in': batch}}, fields=cls.fields_to_load()):
+                    found.add(data['_id'])
+                    doc = by_id[data['_id']]
+                    if doc._from_mongodb(data):
+                        doc._dirty = True
+                    update_open_documents(doc)
+            for _id, doc in by_id.iteritems():
+                if _id not in found:
+                    deleted.append(doc)
+            clear_open_documents(mapping={cls.__name__: [doc._id for doc in deleted if doc.__class__ is cls]})
+        return deleted
+
+    @staticmethod
+    def prefetch(docs, *names):
+        """
+        Loads the Documents which the reference properties `names` of `docs` refer to, with one query
+        per class (per `REFRESH_BATCH` ids) rather than one per Document, e.g. before a loop using
+        `book.author`::
+        
+            Document.prefetch(books, 'author', 'editors')
+        
+        They go in the identity map, so the properties find them there rather than querying. Names may
+        be properties ('author') or their fields ('author_id'). Returns the Documents loaded.
+        """
+        wanted = OrderedDict()  # class -> ids
+        for doc in docs:
+            cls = doc.__class__
+            for name in names:
+                field_name = cls._reference_properties.get(name, name)
+                field = _reference_field(cls._fields.get(field_name, None))
+                if field is None:
+                    raise ValueError("{0}.{1} is not a reference.".format(cls.__name__, name))
+                values = getattr(doc, field_name)
+                if not isinstance(values, list):
+                    values = [values]
+                for value in values:
+                    if value is None:
+                        continue
+                    if isinstance(value, DBRef):
+                        target, _id = COLLECTION_MAP[value.collection], value.id
+                    else:
+                        target, _id = field.get_target_class(), value
+                    if get_open_document(target, _id) is None:
+                        wanted.setdefault(target, OrderedDict())[_id] = True
+        loaded = []
+        for target, ids in wanted.iteritems():
+            ids = list(ids)
+            coll = target._read_collection('prefetch')
+            for start in xrange(0, len(ids), REFRESH_BATCH):
+                loaded.extend(_make_documents(list(coll.find({'_id': {'$in': ids[start:start + REFRESH_BATCH]}},
+                                                             fields=target.fields_to_load()))))
+        return loaded
+
+
+    # Asynchronous versions of the above, see `notanormous.aio`. These return futures (awaitable under
+    # asyncio) rather than blocking.
+
+    def asave(self, *args, **kw):
+        """`save` without blocking, the future's result is this Document."""
+        from notanormous import aio
+        return aio.submit(self.save, *args, **kw)
+
+    def adelete(self):
+        """`delete` without blocking."""
+        from notanormous import aio
+        return aio.submit(self.delete)
+
+    def arefresh(self):
+        """`refresh` without blocking."""
+        from notanormous import aio
+        return aio.submit(self.refresh)
+
+    @classmethod
+    def aget_by_id(cls, some_id, raw=False, read_preference=None):
+        """`get_by_id` without blocking."""
+        from notanormous import aio
+        # the pool's threads don't see our read_preference block, so decide here:
+        return aio.submit(cls.get_by_id, some_id, raw=raw,
+                          read_preference=current_read_preference(cls, read_preference))
+
+    @classmethod
+    def afind(cls, *pargs, **kargs):
+        """
+        Like `find`, but returns an `AsyncDocumentCursor` of Documents, which you can `async for` over.
+        """
+        from notanormous import aio
+        return aio.AsyncDocumentCursor(cls.find(*pargs, **kargs).documents())
+
+    def aref(self, name):
+        """
+        A reference property (`book.author`, `book.editors`) or reverse reference (`author.book_set`)
+        without blocking. The future's result is what the property gives, except that a reverse
+        reference gives a list of Documents rather than a cursor.
+        """
+        from notanormous import aio
+        cls = self.__class__
+        reverse = isinstance(getattr(cls, name, None), ReverseReference)
+        if not reverse and name not in cls._reference_properties:
+            raise ValueError("{0}.{1} is not a reference.".format(cls.__name__, name))
+        def resolve():
+            value = getattr(self, name)
+            if reverse:
+                value = list(value)
+            return value
+        return aio.submit(resolve)
+
 
     def __unicode__(self):
         return pformat(self.to_mongodb())
@@ -1027,6 +1847,33 @@ def to_mongo_output(field, value, document):
 class NotGiven(object): pass
 
 
+def _unpickle_document(clsname, data, dirty):
+    doc = DOCUMENT_MAP[clsname]()
+    doc._from_mongodb(BSON(data).decode())
+    doc._dirty = dirty
+    return doc
+
+
+def _id_clash(error):
+    """
+    Whether a DuplicateKeyError is on the `_id_` index, as opposed to another unique index, or None if
+    the message doesn't say which index.
+    """
+    details = getattr(error, 'details', None) or dict()
+    message = details.get('errmsg', None) or details.get('err', None) or str(error)
+    # MongoDB 2.x says "index: db.coll.$_id_ ", 3+ says "index: _id_ ":
+    if '$_id_ ' in message or 'index: _id_ ' in message:
+        return True
+    if 'index: ' in message:
+        return False
+    return None
+
+
+def _validation_message(cls, errors):
+    return u"{0} is not valid: {1}".format(cls.__name__, u'; '.join(
+        u'{0}: {1}'.format(path, message) for path, message in errors))
+
+
 def cleanup_dict(d):
     # @TODO: move to util.py
     """
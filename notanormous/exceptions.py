@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
 
-class ValidationError(Exception):
-    pass
+class ValidationError(ValueError):
+    """
+    :param errors: list of (field path, message) for everything which is wrong, when there is more than one
+        thing to report.
+    """
+    def __init__(self, message='', errors=None):
+        super(ValidationError, self).__init__(message)
+        self.errors = errors or []
 
 
 class FieldTypeError(Exception):
@@ -3,13 +3,13 @@
 from collections import OrderedDict
 import datetime
 from urlparse import urlparse
-from urllib2 import urlopen, URLError
 
 from bson.dbref import DBRef
 from bson.objectid import ObjectId
 
 from notanormous.connection import connection
 from notanormous.exceptions import ValidationError, FieldTypeError
+from notanormous import urlcheck
 
 __all__ = [
     'BooleanField',
@@ -30,6 +30,7 @@ __all__ = [
     'TupleField',
     'ValidationError',
     'WebURLField',
+    'geojson_point',
 ]
 
 
@@ -43,20 +44,81 @@ def simple_validator(ftype):
         return isinstance(value, ftype)
     return valfunc
 
+
+def choice_values(choices):
+    """
+    Returns a frozenset of the values allowed by `choices`, which may be an OrderedDict, or a tuple or list of
+    values or (value, label) pairs.
+    """
+    if isinstance(choices, OrderedDict):
+        return frozenset(choices.keys())
+    if isinstance(choices, (tuple, list)):
+        return frozenset(c[0] if isinstance(c, (tuple, list)) else c for c in choices)
+    raise ValueError("`choices` must be a tuple, list, or OrderedDict. You gave me a {}.".format(
+        choices.__class__.__name__))
+
+
 class Field(object):
+    """
+    :param index: `True` to index this field when the Document's indexes are created, `False` to never
+        index it. The default, `None`, leaves it up to the Document (see `__index_references__`).
+    """
     document = None
     name = None
-    def __init__(self, ftype=None, validator=None, required=False, default=None):
+    index = None
+    def __init__(self, ftype=None, validator=None, required=False, default=None, index=None):
         self.ftype = ftype or 'any'
         self.validator = validator or simple_validator(ftype)
+        # otherwise any value at all is valid:
+        self._checks_values = validator is not None or self.ftype != 'any'
         self.required = required
         self.default = default
+        self.index = index
     
     def is_valid(self, value):
         if not value and not self.required:
             return True
         return self.validator(value)
     
+    def _overrides_is_valid(self, cls):
+        return type(self).is_valid.__func__ is not cls.is_valid.__func__
+    
+    def _is_valid_check(self):
+        """
+        A check which simply calls `is_valid`, for fields which don't have anything more specific.
+        """
+        is_valid = self.is_valid
+        def check(value):
+            try:
+                if is_valid(value):
+                    return None
+            except ValidationError, msg:
+                return unicode(msg)
+            return u"value {0} is not valid.".format(repr(value))
+        return check
+    
+    def compile_validator(self):
+        """
+        Returns a function which checks a value for this field, or None if there is nothing to check.
+        The function returns None if the value is valid, otherwise a message saying what's wrong, or a
+        list of (field path, message) for embedded Documents.
+        
+        Document classes compile these once, when they are defined, see `Document.is_valid`.
+        """
+        if self._overrides_is_valid(Field):
+            return self._is_valid_check()
+        if not self._checks_values:
+            return None
+        validator = self.validator
+        required = self.required
+        def check(value):
+            if not value and not required:
+                return None
+            if validator(value):
+                return None
+            return u"value {0} is not valid.".format(repr(value))
+        return check
+    
     def to_mongodb(self, value):
         return value
     
@@ -75,9 +137,18 @@ class Field(object):
 
 
 class StringField(Field):
-    def __init__(self, max_length=None, choices=None, *args, **kw):
+    """
+    :param searchable: include this field in the Document's text index, see `Document.search`.
+    :param search_weight: how much a match in this field counts relative to the other searchable fields.
+    """
+    def __init__(self, max_length=None, choices=None, searchable=False, search_weight=1, *args, **kw):
         self.max_length = max_length
         self.choices = choices
+        self.choice_values = None
+        if choices:
+            self.choice_values = choice_values(choices)
+        self.searchable = searchable
+        self.search_weight = search_weight
         self.ftype=unicode
         kw.pop('ftype', None)
         if not 'default' in kw:
@@ -89,45 +160,77 @@ class StringField(Field):
             return False
         if self.max_length and len(value) > self.max_length:
             return False
-        if value and self.choices:
-            vals = list()
-            if isinstance(self.choices, OrderedDict):
-                vals = self.choices.keys()
-            elif isinstance(self.choices, (tuple, list)):
-                for choice in self.choices:
-                    if isinstance(choice, (tuple, list)):
-                        vals.append(choice[0])
-                    else:
-                        vals.append(choice)
-            else:
-                raise ValueError("`choices` must be a tuple, list, or OrderedDict. You gave me a {}. (Field {})".format(self.choices.__class__.__name__, self.name))
-            if not value in vals:
-                return False
+        if value and self.choice_values is not None and value not in self.choice_values:
+            return False
         return True
+    
+    def compile_validator(self):
+        if self._overrides_is_valid(StringField):
+            return self._is_valid_check()
+        max_length = self.max_length
+        values = self.choice_values
+        def check(value):
+            if not isinstance(value, basestring):
+                return u"expected a string, got a {0}.".format(value.__class__.__name__)
+            if max_length and len(value) > max_length:
+                return u"longer than {0} characters.".format(max_length)
+            if value and values is not None and value not in values:
+                return u"{0} is not one of the choices.".format(repr(value))
+            return None
+        return check
 
 
 class WebURLField(StringField):
-    def __init__(self, verify=False, *args, **kw):
+    """
+    :param verify: `True` to check that the URL works when validating, or 'deferred' to check it in the
+        background instead, which only rejects URLs already known to be broken. See `notanormous.urlcheck`.
+    :param verify_timeout: seconds to wait for the server, default is the verifier's.
+    :param verifier: a `notanormous.urlcheck.URLVerifier`, default is `urlcheck.default_verifier`.
+    :param on_invalid: called as `on_invalid(url)` when a deferred check finds a broken URL.
+    """
+    def __init__(self, verify=False, verify_timeout=None, verifier=None, on_invalid=None, *args, **kw):
+        if verify not in (True, False, 'deferred'):
+            raise ValueError("verify must be True, False or 'deferred'.")
         self.verify = verify
+        self.verify_timeout = verify_timeout
+        self.verifier = verifier
+        self.on_invalid = on_invalid
         kw['max_length'] = 1024
         super(WebURLField, self).__init__(*args, **kw)
+    
+    def get_verifier(self):
+        return self.verifier or urlcheck.default_verifier
+    
+    def is_well_formed(self, value):
+        parsed = urlparse(value)
+        if parsed.scheme not in ['http', 'https']:
+            return False
+        if '.' not in parsed.netloc:
+            return False
+        return True
+    
     def is_valid(self, value):
         if not self.required and (not value or value == ''):
             return True
         if not StringField.is_valid(self, value):
             return False
         # check basic validity:
-        parsed = urlparse(value)
-        if parsed.scheme not in ['http', 'https']:
-            return False
-        if '.' not in parsed.netloc:
+        if not self.is_well_formed(value):
             return False
+        if self.verify == 'deferred':
+            verifier = self.get_verifier()
+            ok = verifier.cached(value)
+            if ok is None:
+                verifier.check_later(value, self.verify_timeout, self._deferred_result)
+                return True
+            return ok
         if self.verify:
-            try:
-                u = urlopen(value)
-            except URLError:
-                return False
+            return self.get_verifier().check(value, self.verify_timeout)
         return True
+    
+    def _deferred_result(self, url, ok):
+        if not ok and self.on_invalid is not None:
+            self.on_invalid(url)
 
 
 class IntegerField(Field):
@@ -208,8 +311,7 @@ class TimeField(Field):
     Time has to be stored as a datetime, so we use now but replace h, m, s.
     """
     def __init__(self, *args, **kw):
-        self.ftype = datetime.time
-        
+        super(TimeField, self).__init__(ftype=datetime.time, *args, **kw)
     
     def to_mongodb(self, value):
         if value is None:
@@ -227,9 +329,13 @@ class TimeField(Field):
 
 
 class DBRefField(Field):
-    
-    def __init__(self, document_class=None, *args, **kw):
+    """
+    :param related_name: name of the reverse accessor generated on `document_class`. Defaults to
+        `<classname>_set`, use `False` to skip generating one.
+    """
+    def __init__(self, document_class=None, related_name=None, *args, **kw):
         self.document_class = document_class
+        self.related_name = related_name
         super(DBRefField, self).__init__(*args, **kw)
     
     
@@ -260,8 +366,13 @@ class DBRefField(Field):
 
 
 class ObjectIdField(Field):
-    def __init__(self, document_class=None, *args, **kw):
+    """
+    :param related_name: name of the reverse accessor generated on `document_class`. Defaults to
+        `<classname>_set`, use `False` to skip generating one.
+    """
+    def __init__(self, document_class=None, related_name=None, *args, **kw):
         self.document_class = document_class
+        self.related_name = related_name
         super(ObjectIdField, self).__init__(*args, **kw)
     
     def is_valid(self, value):
@@ -327,6 +438,17 @@ class EmbeddedDocumentField(Field):
         if not isinstance(value, Document):
             raise ValidationError("Trying to set an EmbeddedDocumentField to something other than a Document.")
         return True
+    
+    def compile_validator(self):
+        from notanormous.document import Document
+        required = self.required
+        def check(value):
+            if value is None and not required:
+                return None
+            if not isinstance(value, Document):
+                return u"expected an embedded Document, got a {0}.".format(value.__class__.__name__)
+            return value.validation_errors() or None
+        return check
 
 
 class ListField(Field, list):
@@ -377,6 +499,22 @@ class ListField(Field, list):
             raise
         return True
     
+    def compile_validator(self):
+        list_check = self._is_valid_check()
+        if not isinstance(self.field, EmbeddedDocumentField):
+            return list_check
+        from notanormous.document import Document
+        def check(value):
+            error = list_check(value)
+            if error is not None:
+                return error
+            errors = []
+            for i, item in enumerate(value):
+                if isinstance(item, Document):
+                    errors.extend((u'{0}.{1}'.format(i, path), message) for path, message in item.validation_errors())
+            return errors or None
+        return check
+    
 
 class TupleField(Field, tuple):
     def __init__(self, field=None, sorted=False, *args, **kw):
@@ -410,9 +548,42 @@ class DictField(Field, dict):
         return True
 
 
+def geojson_point(value):
+    """
+    Returns `value` as a GeoJSON Point, `{'type': 'Point', 'coordinates': [lon, lat]}`.
+    
+    Accepts a Point, a dict with keys lat and lon, or a (lon, lat) tuple or list. Raises ValueError
+    for anything else, or if the coordinates are out of range.
+    """
+    if isinstance(value, dict):
+        if value.get('type', None) == 'Point':
+            coords = value.get('coordinates', None)
+        elif 'lat' in value and 'lon' in value:
+            coords = (value['lon'], value['lat'])
+        else:
+            raise ValueError("Not a GeoJSON Point or a dict with keys lat and lon: {0}".format(repr(value)))
+    else:
+        coords = value
+    if not isinstance(coords, (list, tuple)) or len(coords) != 2:
+        raise ValueError("Expected a (longitude, latitude) pair, got {0}".format(repr(coords)))
+    for c in coords:
+        if isinstance(c, bool) or not isinstance(c, (int, long, float)):
+            raise ValueError("Coordinates must be numbers, got {0}".format(repr(coords)))
+    lon, lat = coords
+    if not -180 <= lon <= 180 or not -90 <= lat <= 90:
+        raise ValueError("Longitude must be within -180..180 and latitude within -90..90, got {0}".format(
+            repr(coords)))
+    return {'type': 'Point', 'coordinates': [float(lon), float(lat)]}
+
+
 class LocationField(Field, dict):
     """
-    Should be a simple dict with keys lat, lon.
+    A GeoJSON Point, `{'type': 'Point', 'coordinates': [lon, lat]}`. Note that longitude comes first.
+    
+    You may also set it to a dict with keys lat, lon (the old format) or a (lon, lat) tuple, either is
+    converted to a Point when saved, and old {lat, lon} data is converted when loaded.
+    
+    Use `index=True` to give it a 2dsphere index, which `Document.near` and `Document.within` need.
     """
     def __init__(self, field=None, *args, **kw):
         self.field = field
@@ -421,13 +592,28 @@ class LocationField(Field, dict):
             default = None
         super(LocationField, self).__init__(ftype=dict, default=default, *args, **kw)
     
-    def isinstance(self, value):
-        if value is not None and not isinstance(value, dict):
+    def is_valid(self, value):
+        if value is None:
+            return not self.required
+        try:
+            geojson_point(value)
+        except ValueError:
             return False
-        if 'lat' in value and 'lon' in value:
-            if isinstance(value['lat'], (int, float, long)) and isinstance(value['lon'], (int, float, long)):
-                return True
-        return False
+        return True
+    
+    def to_mongodb(self, value):
+        if value is None:
+            return None
+        return geojson_point(value)
+    
+    def from_mongodb(self, value):
+        if value is None:
+            return None
+        try:
+            return geojson_point(value)
+        except ValueError:
+            # leave it for is_valid to complain about
+            return value
 
 class OrderedDictField(Field, OrderedDict):
     """
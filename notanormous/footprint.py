@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""
+How much memory the open Documents take, per class.
+
+    from notanormous import footprint
+    snap = footprint.snapshot()
+    print snap.report()
+
+A snapshot walks the identity map (the process-wide `OPEN_DOCUMENTS` unless inside `identity_map()`)
+and, for each class, counts the Documents and adds up their deep size, as `sys.getsizeof` reports it,
+split into:
+
+* 'fields': the values of the Document's fields, not counting embedded Documents
+* 'data': the `_data` dict
+* 'embedded': embedded Documents, whole
+* 'other': the instance itself and its other attributes, e.g. cached properties
+
+Objects shared between Documents are counted once, for the first Document found holding them. Documents
+cached by reference properties are counted as themselves, not as part of the Document referring to
+them. Sizes are approximate: they leave out allocator overhead and what extension types don't report.
+
+Each snapshot also has the largest Documents measured, and the growth per class since the snapshot
+before it of the same identity map (or `since`).
+
+Measuring every Document means visiting every object they hold. `snapshot(sample=100)` measures at
+most 100 random Documents per class and scales up, which is cheap enough to run periodically, e.g.
+with a `Watcher`.
+"""
+
+from collections import deque
+import heapq
+import random
+import sys
+import threading
+import time
+import weakref
+
+from notanormous.document import Document
+from notanormous.identity import current_identity_map
+
+__all__ = [
+    'Snapshot',
+    'Watcher',
+    'document_size',
+    'snapshot',
+]
+
+
+PARTS = ('fields', 'data', 'embedded', 'other')
+
+_last = weakref.WeakKeyDictionary()  # identity map -> its last Snapshot
+_last_lock = threading.Lock()
+
+# not worth descending into:
+_ATOMIC = (basestring, int, long, float, bool, type(None), type)
+
+
+def _sizeof(obj, seen, documents):
+    """
+    The deep size of `obj`, skipping the ids in `seen` (and adding those it counts). Documents found
+    aren't counted, but appended to `documents`.
+    """
+    size = 0
+    todo = [obj]
+    while todo:
+        o = todo.pop()
+        if id(o) in seen:
+            continue
+        if isinstance(o, Document):
+            documents.append(o)
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, _ATOMIC):
+            continue
+        if isinstance(o, dict):
+            todo.extend(o.iterkeys())
+            todo.extend(o.itervalues())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            todo.extend(o)
+        elif hasattr(o, '__dict__'):
+            todo.append(o.__dict__)
+    return size
+
+
+def document_size(doc, seen=None):
+    """
+    The deep size of `doc` in bytes, as a dict with the `PARTS` and their 'total'. Ids of objects in
+    `seen` are skipped, and the objects counted are added to it.
+    """
+    if seen is None:
+        seen = set()
+    attrs = object.__getattribute__(doc, '__dict__')
+    fields = object.__getattribute__(doc, '_fields')
+    seen.add(id(doc))
+    seen.add(id(attrs))
+    sizes = dict(fields=0, data=0, embedded=0, other=sys.getsizeof(doc) + sys.getsizeof(attrs))
+    embedded = []
+    for key, value in attrs.items():
+        if key == '_data':
+            sizes['data'] += _sizeof(value, seen, embedded)
+        elif key in fields:
+            sizes['fields'] += _sizeof(value, seen, embedded)
+        else:
+            # Documents here are cached references, which count as themselves:
+            sizes['other'] += _sizeof(value, seen, [])
+    for sub in embedded:
+        if id(sub) not in seen:
+            sizes['embedded'] += document_size(sub, seen)['total']
+    sizes['total'] = sum(sizes[part] for part in PARTS)
+    return sizes
+
+
+class Snapshot(object):
+    """
+    The footprint of an identity map at `taken` (a timestamp).
+
+    `classes` is {classname: dict} with 'count' (Documents open), 'measured' (those measured, fewer
+    than 'count' when sampling or when some were already counted inside another Document), the
+    `PARTS`, 'total' and 'average', in bytes. `largest` is a list of
+    (bytes, classname, _id), largest first. `growth` is {classname: dict} with the change in 'count' and
+    'total' since the previous snapshot, or None for the first.
+    """
+    def __init__(self, classes, largest, sampled, taken=None):
+        self.classes = classes
+        self.largest = largest
+        self.sampled = sampled
+        self.taken = taken or time.time()
+        self.growth = None
+
+    @property
+    def total(self):
+        return sum(c['total'] for c in self.classes.itervalues())
+
+    @property
+    def count(self):
+        return sum(c['count'] for c in self.classes.itervalues())
+
+    def compare(self, previous):
+        """{classname: dict(count=change, total=change in bytes)} since `previous`."""
+        growth = dict()
+        for classname in set(self.classes) | set(previous.classes):
+            now = self.classes.get(classname, dict(count=0, total=0))
+            then = previous.classes.get(classname, dict(count=0, total=0))
+            growth[classname] = dict(count=now['count'] - then['count'], total=now['total'] - then['total'])
+        return growth
+
+    def report(self, limit=10):
+        """The `limit` largest classes and Documents, and the fastest growing classes, as text."""
+        lines = ["{0} Documents, {1:.1f} KB{2}.".format(self.count, self.total / 1024.0,
+                                                       ' (estimated)' if self.sampled else ''), ""]
+        lines.append("{0:<30} {1:>10} {2:>12} {3:>12} {4:>12} {5:>12} {6:>12}".format(
+            'Class', 'count', 'total KB', 'fields KB', 'data KB', 'embedded KB', 'avg bytes'))
+        rows = sorted(self.classes.iteritems(), key=lambda item: -item[1]['total'])
+        for classname, c in rows[:limit]:
+            lines.append("{0:<30} {1:>10} {2:>12.1f} {3:>12.1f} {4:>12.1f} {5:>12.1f} {6:>12}".format(
+                classname, c['count'], c['total'] / 1024.0, c['fields'] / 1024.0, c['data'] / 1024.0,
+                c['embedded'] / 1024.0, c['average']))
+        lines.append("")
+        lines.append("{0:<30} {1:<30} {2:>12}".format('Largest', '_id', 'bytes'))
+        for size, classname, _id in self.largest[:limit]:
+            lines.append("{0:<30} {1:<30} {2:>12}".format(classname, str(_id), size))
+        if self.growth is not None:
+            lines.append("")
+            lines.append("{0:<30} {1:>10} {2:>12}".format('Growth', 'count', 'KB'))
+            growth = sorted(self.growth.iteritems(), key=lambda item: -item[1]['total'])
+            for classname, g in growth[:limit]:
+                lines.append("{0:<30} {1:>+10} {2:>+12.1f}".format(classname, g['count'], g['total'] / 1024.0))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return "<Snapshot of {0} Documents, {1} bytes>".format(self.count, self.total)
+
+
+def _measure(imap, sample, largest):
+    seen = set()
+    classes = dict()
+    heap = []
+    sampled = False
+    for classname, docs in imap.documents.items():
+        docs = list(docs.values())
+        count = len(docs)
+        if not count:
+            continue
+        if sample is not None and count > sample:
+            docs = random.sample(docs, sample)
+            sampled = True
+        sums = dict((part, 0) for part in PARTS)
+        measured = 0
+        for doc in docs:
+            if id(doc) in seen:
+                # already counted, embedded in another Document
+                continue
+            measured += 1
+            sizes = document_size(doc, seen)
+            for part in PARTS:
+                sums[part] += sizes[part]
+            entry = (sizes['total'], classname, object.__getattribute__(doc, '_id'))
+            if len(heap) < largest:
+                heapq.heappush(heap, entry)
+            elif largest:
+                heapq.heappushpop(heap, entry)
+        # extrapolate from the Documents actually measured, not those skipped:
+        scale = float(count) / measured if measured else 0.0
+        c = classes[classname] = dict((part, int(sums[part] * scale)) for part in PARTS)
+        c['count'] = count
+        c['measured'] = measured
+        c['total'] = sum(c[part] for part in PARTS)
+        c['average'] = c['total'] // count
+    return Snapshot(classes, sorted(heap, reverse=True), sampled)
+
+
+def snapshot(imap=None, sample=None, largest=10, since=None):
+    """
+    Measures the Documents in `imap` (by default the one in effect here), see the module docstring.
+
+    :param sample: measure at most this many Documents per class, estimating the rest.
+    :param largest: how many of the largest Documents to keep.
+    :param since: the `Snapshot` to compute growth against, by default the last one taken of `imap`.
+    """
+    if imap is None:
+        imap = current_identity_map()
+    snap = _measure(imap, sample, largest)
+    with _last_lock:
+        if since is None:
+            since = _last.get(imap, None)
+        _last[imap] = snap
+    if since is not None:
+        snap.growth = snap.compare(since)
+    return snap
+
+
+class Watcher(object):
+    """
+    Takes a sampled snapshot of the process-wide identity map every `interval` seconds in a background
+    thread, keeping the last `keep` in `history` and calling `callback(snapshot)` if given.
+    """
+    def __init__(self, interval=60, sample=100, callback=None, keep=10):
+        self.interval = interval
+        self.sample = sample
+        self.callback = callback
+        self.history = deque(maxlen=keep)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='notanormous-footprint')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            # kept apart from the snapshots taken with `snapshot`:
+            snap = _measure(current_identity_map(), self.sample, 10)
+            if self.history:
+                snap.growth = snap.compare(self.history[-1])
+            self.history.append(snap)
+            if self.callback is not None:
+                self.callback(snap)
+            self._stop.wait(self.interval)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+Identity maps make sure there is at most one open Document instance per class and `_id`, so loading
+the same document twice gives you the same object.
+
+By default there is one map for the whole process, `OPEN_DOCUMENTS`, shared by every thread. That means
+two requests loading the same document get the same mutable object. Wrap each request (or thread, or
+asyncio task) in `identity_map()` to give it a map of its own::
+
+    with identity_map():
+        doc = Something.get_by_id(1)  # private to this block
+
+When the block ends the map is simply dropped, however many Documents it holds. A map may have a
+`parent` which lookups fall back to. The parent is never written to, so it can be shared read-only
+between scopes, e.g. for reference data loaded once at startup.
+
+Scopes follow `contextvars` where available (Python 3.7+), so each asyncio task has its own, and
+otherwise are per thread.
+"""
+
+from contextlib import contextmanager
+import threading
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+__all__ = [
+    'IdentityMap',
+    'OPEN_DOCUMENTS',
+    'bind_identity_map',
+    'current_identity_map',
+    'identity_map',
+]
+
+
+OPEN_DOCUMENTS = dict()  # classname -> {_id: Document} for the process-wide map
+
+
+class IdentityMap(object):
+    """
+    :param documents: dict of classname -> {_id: Document}.
+    :param parent: an IdentityMap to fall back to for lookups. It is never written to.
+    """
+    def __init__(self, documents=None, parent=None):
+        if documents is None:
+            documents = dict()
+        self.documents = documents
+        self.parent = parent
+
+    def get(self, clsname, _id):
+        docs = self.documents.get(clsname, None)
+        if docs is not None:
+            doc = docs.get(_id, None)
+            if doc is not None:
+                return doc
+        if self.parent is not None:
+            return self.parent.get(clsname, _id)
+        return None
+
+    def add(self, doc):
+        docs = self.documents.get(doc.__class__.__name__, None)
+        if docs is None:
+            docs = self.documents.setdefault(doc.__class__.__name__, dict())
+        docs[doc._id] = doc
+        return doc
+
+    def discard(self, clsname, _id):
+        docs = self.documents.get(clsname, None)
+        if docs is not None:
+            docs.pop(_id, None)
+
+    def clear(self, clsnames=None):
+        if clsnames is None:
+            clsnames = list(self.documents.keys())
+        for clsname in clsnames:
+            if clsname in self.documents:
+                self.documents[clsname] = dict()
+
+    def class_documents(self, clsname):
+        """
+        The {_id: Document} dict for one class in this map, not including the parent's.
+        """
+        return self.documents.get(clsname, {})
+
+    def __len__(self):
+        return sum(len(docs) for docs in self.documents.values())
+
+    def __repr__(self):
+        return "<IdentityMap of {0} Documents>".format(len(self))
+
+
+DEFAULT_IDENTITY_MAP = IdentityMap(OPEN_DOCUMENTS)
+
+
+if contextvars is not None:
+    _current = contextvars.ContextVar('notanormous_identity_map', default=None)
+
+    def _get_scoped():
+        return _current.get()
+
+    @contextmanager
+    def _scoped(imap):
+        token = _current.set(imap)
+        try:
+            yield imap
+        finally:
+            _current.reset(token)
+else:
+    _local = threading.local()
+
+    def _get_scoped():
+        return getattr(_local, 'imap', None)
+
+    @contextmanager
+    def _scoped(imap):
+        previous = getattr(_local, 'imap', None)
+        _local.imap = imap
+        try:
+            yield imap
+        finally:
+            _local.imap = previous
+
+
+def current_identity_map():
+    """
+    The identity map in effect here, which is the process-wide one unless inside `identity_map()`.
+    """
+    imap = _get_scoped()
+    if imap is None:
+        return DEFAULT_IDENTITY_MAP
+    return imap
+
+
+@contextmanager
+def identity_map(parent=None, imap=None):
+    """
+    Use a new identity map (or `imap`) for everything inside the `with` block. Yields the map.
+
+    :param parent: an IdentityMap for lookups to fall back to, never written to. Pass `True` for the
+        process-wide map.
+    """
+    if parent is True:
+        parent = DEFAULT_IDENTITY_MAP
+    if imap is None:
+        imap = IdentityMap(parent=parent)
+    with _scoped(imap):
+        yield imap
+
+
+def bind_identity_map(fn):
+    """
+    Returns `fn` wrapped to run with the caller's identity map, wherever it's called from. Use this when
+    handing work to another thread.
+    """
+    imap = _get_scoped()
+    if imap is None:
+        return fn
+    def bound(*args, **kw):
+        with _scoped(imap):
+            return fn(*args, **kw)
+    return bound
@@ -0,0 +1,1034 @@
+# -*- coding: utf-8 -*-
+
+"""
+An in-process stand-in for MongoDB, so Document classes can run without a `mongod`, e.g. in tests and
+benchmarks::
+
+    from notanormous.inmemory import InMemoryClient
+    Document._db = InMemoryClient()['myapp']
+
+A backend, as far as `Document` is concerned, is anything which looks enough like a pymongo Database:
+collections as attributes or items, and collections and cursors with pymongo's methods. This one
+implements the subset Notanormous uses, in both pymongo 2 (`insert`, `update`, `remove`, `fields=`,
+bulk ops) and pymongo 3 (`insert_one`, `update_many`, `projection=`, ...) spellings:
+
+* find/find_one with the comparison, set, array, element, logical and `$regex` operators, on dotted
+  paths and into arrays like MongoDB does, projections, and sort/skip/limit/count on cursors
+* insert, update with `$set`, `$unset`, `$inc`, `$push`, `$addToSet`, `$pull`, `$pop` and upserts,
+  replace and remove
+* indexes: only `_id` and unique ones matter for behaviour, others are just recorded
+* `Database.dereference` for DBRefs
+
+Everything is copied in and out as it would go through BSON: tuples become lists and datetimes lose
+their sub-millisecond part. Operations on a collection are atomic with respect to each other (there's a
+lock per collection). Not supported: geospatial and `$text` queries, aggregation, `$where`, and
+anything else raising NotImplementedError.
+"""
+
+from collections import OrderedDict
+import datetime
+import re
+import threading
+
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+import pymongo
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+
+__all__ = [
+    'InMemoryClient',
+    'InMemoryCollection',
+    'InMemoryCursor',
+    'InMemoryDatabase',
+]
+
+
+RE_TYPE = type(re.compile(''))
+
+MISSING = object()
+
+
+def _copy(value):
+    """Copies `value` the way a round trip through BSON would."""
+    if isinstance(value, dict):
+        return value.__class__((key, _copy(item)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_copy(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        if value.utcoffset() is not None:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+# Querying
+
+def _lookup(doc, path):
+    """
+    All the values at dotted `path` in `doc`, looking into arrays of embedded documents the way MongoDB
+    does. An empty list means there are none.
+    """
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit():
+                    if int(part) < len(value):
+                        found.append(value[int(part)])
+                else:
+                    found.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+        values = found
+    return values
+
+
+def _type_rank(value):
+    # the order MongoDB sorts different types in:
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, long, float)):
+        return 2
+    if isinstance(value, basestring):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    return 10
+
+
+def _sort_key(value):
+    return _type_rank(value), value
+
+
+def _equal(value, cond):
+    if isinstance(cond, RE_TYPE):
+        return isinstance(value, basestring) and cond.search(value) is not None
+    if _type_rank(value) != _type_rank(cond):
+        return False
+    return value == cond
+
+
+def _eq(values, cond):
+    if not values:
+        return cond is None
+    for value in values:
+        if _equal(value, cond):
+            return True
+        if isinstance(value, list) and any(_equal(item, cond) for item in value):
+            return True
+    return False
+
+
+def _expand(values):
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for item in value:
+                yield item
+
+
+def _compare(values, cond, test):
+    return any(_type_rank(value) == _type_rank(cond) and test(value, cond) for value in _expand(values))
+
+
+def _regex(pattern, options=''):
+    if isinstance(pattern, RE_TYPE):
+        return pattern
+    flags = 0
+    for option, flag in (('i', re.IGNORECASE), ('m', re.MULTILINE), ('s', re.DOTALL), ('x', re.VERBOSE)):
+        if option in options:
+            flags |= flag
+    return re.compile(pattern, flags)
+
+
+def _match_op(values, op, arg, cond):
+    if op == '$eq':
+        return _eq(values, arg)
+    if op == '$ne':
+        return not _eq(values, arg)
+    if op == '$in':
+        return any(_eq(values, item) for item in arg)
+    if op == '$nin':
+        return not any(_eq(values, item) for item in arg)
+    if op == '$gt':
+        return _compare(values, arg, lambda a, b: a > b)
+    if op == '$gte':
+        return _compare(values, arg, lambda a, b: a >= b)
+    if op == '$lt':
+        return _compare(values, arg, lambda a, b: a < b)
+    if op == '$lte':
+        return _compare(values, arg, lambda a, b: a <= b)
+    if op == '$exists':
+        return bool(values) == bool(arg)
+    if op == '$size':
+        return any(isinstance(value, list) and len(value) == arg for value in values)
+    if op == '$all':
+        return all(_eq(values, item) for item in arg)
+    if op == '$elemMatch':
+        for value in values:
+            if not isinstance(value, list):
+                continue
+            for item in value:
+                if isinstance(item, dict) and not _is_operator_dict(arg):
+                    if _matches(item, arg):
+                        return True
+                elif _match_value([item], arg):
+                    return True
+        return False
+    if op == '$regex':
+        pattern = _regex(arg, cond.get('$options', ''))
+        return any(_equal(value, pattern) for value in _expand(values))
+    if op == '$options':
+        return True
+    if op == '$not':
+        if isinstance(arg, RE_TYPE):
+            return not _eq(values, arg)
+        return not _match_value(values, arg)
+    if op == '$type':
+        raise NotImplementedError("$type is not supported by the in-memory backend.")
+    raise NotImplementedError("{0} is not supported by the in-memory backend.".format(op))
+
+
+def _is_operator_dict(cond):
+    return isinstance(cond, dict) and cond and all(key.startswith('$') for key in cond)
+
+
+def _match_value(values, cond):
+    if _is_operator_dict(cond):
+        return all(_match_op(values, op, arg, cond) for op, arg in cond.iteritems())
+    return _eq(values, cond)
+
+
+def _matches(doc, spec):
+    """`True` if `doc` matches the query `spec`."""
+    for key, cond in spec.iteritems():
+        if key == '$and':
+            if not all(_matches(doc, sub) for sub in cond):
+                return False
+        elif key == '$or':
+            if not any(_matches(doc, sub) for sub in cond):
+                return False
+        elif key == '$nor':
+            if any(_matches(doc, sub) for sub in cond):
+                return False
+        elif key.startswith('$'):
+            raise NotImplementedError("{0} is not supported by the in-memory backend.".format(key))
+        elif not _match_value(_lookup(doc, key), cond):
+            return False
+    return True
+
+
+# Projections
+
+def _include(doc, parts):
+    if not parts:
+        return _copy(doc)
+    if isinstance(doc, list):
+        return [_include(item, parts) for item in doc if isinstance(item, dict)]
+    if not isinstance(doc, dict) or parts[0] not in doc:
+        return MISSING
+    return {parts[0]: _include(doc[parts[0]], parts[1:])}
+
+
+def _merge(into, value):
+    for key, item in value.iteritems():
+        if item is MISSING:
+            continue
+        if isinstance(item, dict) and isinstance(into.get(key, None), dict):
+            _merge(into[key], item)
+        else:
+            into[key] = item
+
+
+def _exclude(doc, parts):
+    if isinstance(doc, list):
+        for item in doc:
+            _exclude(item, parts)
+        return
+    if not isinstance(doc, dict) or parts[0] not in doc:
+        return
+    if len(parts) == 1:
+        del doc[parts[0]]
+    else:
+        _exclude(doc[parts[0]], parts[1:])
+
+
+def _project(doc, projection):
+    if not projection:
+        return _copy(doc)
+    if not isinstance(projection, dict):
+        projection = dict((field, 1) for field in projection)
+    # {'$meta': ...} and such can't be done here, and don't decide between including and excluding:
+    plain = dict((field, bool(value)) for field, value in projection.iteritems() if not isinstance(value, dict))
+    include_id = plain.pop('_id', True)
+    if any(plain.itervalues()):
+        out = dict()
+        for field, included in plain.iteritems():
+            if included:
+                value = _include(doc, field.split('.'))
+                if value is not MISSING:
+                    _merge(out, value)
+        if include_id and '_id' in doc:
+            out['_id'] = doc['_id']
+        return out
+    out = _copy(doc)
+    for field in plain:
+        _exclude(out, field.split('.'))
+    if not include_id:
+        out.pop('_id', None)
+    return out
+
+
+# Updating
+
+def _is_update(document):
+    return any(key.startswith('$') for key in document)
+
+
+def _parent(doc, path, create=True):
+    """Returns (container, last key) for `path`, making embedded documents on the way if `create`."""
+    parts = path.split('.')
+    target = doc
+    for part in parts[:-1]:
+        if isinstance(target, list):
+            target = target[int(part)]
+            continue
+        if part not in target:
+            if not create:
+                return None, None
+            target[part] = dict()
+        target = target[part]
+    last = parts[-1]
+    if isinstance(target, list):
+        last = int(last)
+    return target, last
+
+
+def _get(container, key):
+    if isinstance(container, list):
+        return container[key] if key < len(container) else MISSING
+    return container.get(key, MISSING)
+
+
+def _set(container, key, value):
+    if isinstance(container, list):
+        while len(container) <= key:
+            container.append(None)
+    container[key] = value
+
+
+def _apply_update(doc, document, inserting=False):
+    if not _is_update(document):
+        new = _copy(document)
+        new['_id'] = doc['_id']
+        doc.clear()
+        doc.update(new)
+        return
+    for op, changes in document.iteritems():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, arg in changes.iteritems():
+            if path == '_id' and op in ('$set', '$unset', '$inc') and arg != doc.get('_id', MISSING):
+                raise OperationFailure("The _id field cannot be changed.")
+            if op in ('$set', '$setOnInsert'):
+                container, key = _parent(doc, path)
+                _set(container, key, _copy(arg))
+            elif op == '$unset':
+                container, key = _parent(doc, path, create=False)
+                if isinstance(container, dict):
+                    container.pop(key, None)
+                elif isinstance(container, list) and key < len(container):
+                    container[key] = None
+            elif op == '$inc':
+                container, key = _parent(doc, path)
+                current = _get(container, key)
+                _set(container, key, arg if current is MISSING else current + arg)
+            elif op in ('$push', '$addToSet'):
+                container, key = _parent(doc, path)
+                current = _get(container, key)
+                if current is MISSING:
+                    current = []
+                    _set(container, key, current)
+                if not isinstance(current, list):
+                    raise OperationFailure("Cannot apply {0} to non-array field {1}.".format(op, path))
+                items = arg['$each'] if isinstance(arg, dict) and '$each' in arg else [arg]
+                for item in _copy(items):
+                    if op == '$push' or item not in current:
+                        current.append(item)
+            elif op == '$pull':
+                container, key = _parent(doc, path, create=False)
+                current = _get(container, key) if container is not None else MISSING
+                if isinstance(current, list):
+                    if isinstance(arg, dict) and not _is_operator_dict(arg):
+                        keep = [item for item in current if not (isinstance(item, dict) and _matches(item, arg))]
+                    else:
+                        keep = [item for item in current if not _match_value([item], arg)]
+                    current[:] = keep
+            elif op == '$pop':
+                container, key = _parent(doc, path, create=False)
+                current = _get(container, key) if container is not None else MISSING
+                if isinstance(current, list) and current:
+                    current.pop(0 if arg < 0 else -1)
+            else:
+                raise NotImplementedError("{0} is not supported by the in-memory backend.".format(op))
+
+
+def _upsert_base(spec):
+    """The new document for an upsert: the plain equality parts of the query."""
+    doc = dict()
+    for key, cond in spec.iteritems():
+        if key.startswith('$') or _is_operator_dict(cond):
+            continue
+        container, last = _parent(doc, key)
+        _set(container, last, _copy(cond))
+    return doc
+
+
+# Indexes
+
+def _index_keys(key_or_list, direction=None):
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, direction or pymongo.ASCENDING)]
+    keys = []
+    for item in key_or_list:
+        if isinstance(item, basestring):
+            keys.append((item, pymongo.ASCENDING))
+        else:
+            keys.append((item[0], item[1]))
+    return keys
+
+
+def _index_name(keys):
+    return '_'.join('{0}_{1}'.format(key, direction) for key, direction in keys)
+
+
+class _Result(object):
+    """What pymongo 3's write methods return, near enough."""
+    def __init__(self, **kw):
+        self.acknowledged = True
+        self.__dict__.update(kw)
+
+
+class InMemoryCursor(object):
+    def __init__(self, collection, spec=None, projection=None, skip=0, limit=0, sort=None):
+        self.collection = collection
+        self.spec = spec or {}
+        self.projection = projection
+        self._skip = skip
+        self._limit = limit
+        self._sort = sort
+        self._results = None
+        self.alive = True
+
+    def __repr__(self):
+        return "<InMemoryCursor on {0}>".format(self.collection.full_name)
+
+    def _check_unstarted(self):
+        if self._results is not None:
+            raise pymongo.errors.InvalidOperation("cannot set options after executing query")
+
+    def sort(self, key_or_list, direction=None):
+        self._check_unstarted()
+        self._sort = _index_keys(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        self._check_unstarted()
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._check_unstarted()
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def max_time_ms(self, max_time_ms):
+        return self
+
+    def clone(self):
+        return InMemoryCursor(self.collection, self.spec, self.projection, self._skip, self._limit, self._sort)
+
+    def rewind(self):
+        self._results = None
+        self.alive = True
+        return self
+
+    def close(self):
+        self._results = iter([])
+        self.alive = False
+
+    def _all(self, with_limit_and_skip=True):
+        if (not self.spec and with_limit_and_skip and self._limit == 1 and not self._skip and self._sort
+                and len(self._sort) == 1 and self._sort[0][0] == '_id'):
+            # how save finds the next serial _id, don't sort everything for it:
+            pick = max if self._sort[0][1] == pymongo.DESCENDING else min
+            documents = self.collection._documents
+            return [documents[pick(documents, key=_sort_key)]] if documents else []
+        docs = self.collection._matching(self.spec)
+        for key, direction in reversed(self._sort or []):
+            docs.sort(key=lambda doc: _sort_key(next(iter(_lookup(doc, key)), None)),
+                      reverse=direction == pymongo.DESCENDING)
+        if with_limit_and_skip:
+            docs = docs[self._skip:]
+            if self._limit:
+                docs = docs[:abs(self._limit)]
+        return docs
+
+    def _run(self):
+        if self._results is None:
+            with self.collection._lock:
+                self._results = iter([_project(doc, self.projection) for doc in self._all()])
+        return self._results
+
+    def count(self, with_limit_and_skip=False):
+        with self.collection._lock:
+            return len(self._all(with_limit_and_skip))
+
+    def distinct(self, key):
+        values = []
+        with self.collection._lock:
+            for doc in self._all():
+                for value in _expand(_lookup(doc, key)):
+                    if not isinstance(value, list) and value not in values:
+                        values.append(_copy(value))
+        return values
+
+    def explain(self):
+        """
+        A plan shaped like MongoDB 3's, from the indexes declared: the `_id` lookup, a scan of the
+        first index on a field of the query, or a collection scan.
+        """
+        spec = self.spec if isinstance(self.spec, dict) else {'_id': self.spec}
+        with self.collection._lock:
+            returned = len(self._all())
+            total = len(self.collection._documents)
+            indexes = self.collection._indexes.items()
+            _id = spec.get('_id', MISSING)
+            if _id is not MISSING and not _is_operator_dict(_id):
+                plan, examined, keys = {'stage': 'IDHACK'}, returned, returned
+            else:
+                plan = None
+                for name, index in sorted(indexes):
+                    field = index['key'][0][0]
+                    if field in spec and name != '_id_':
+                        examined = keys = len(self.collection._matching({field: spec[field]}))
+                        plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': name,
+                                                                  'keyPattern': dict(index['key'])}}
+                        break
+                if plan is None:
+                    plan, examined, keys = {'stage': 'COLLSCAN', 'filter': spec}, total, 0
+            if self._sort:
+                plan = {'stage': 'SORT', 'sortPattern': dict(self._sort), 'inputStage': plan}
+        return {'queryPlanner': {'namespace': self.collection.full_name, 'parsedQuery': spec, 'winningPlan': plan},
+                'executionStats': {'nReturned': returned, 'totalDocsExamined': examined,
+                                   'totalKeysExamined': keys}}
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self._run())
+        except StopIteration:
+            self.alive = False
+            raise
+    __next__ = next
+
+    def __getitem__(self, index):
+        self._check_unstarted()
+        if isinstance(index, slice):
+            if index.step is not None:
+                raise IndexError("Cursor instances do not support slice steps")
+            start = index.start or 0
+            self._skip += start
+            if index.stop is not None:
+                self._limit = index.stop - start
+            return self
+        for doc in self.clone().skip(self._skip + index).limit(1):
+            return doc
+        raise IndexError("no such item for Cursor instance")
+
+
+class _BulkFind(object):
+    def __init__(self, bulk, spec):
+        self.bulk = bulk
+        self.spec = spec
+        self._upsert = False
+
+    def upsert(self):
+        self._upsert = True
+        return self
+
+    def _add(self, kind, *args):
+        self.bulk.ops.append((kind, self.spec, self._upsert) + args)
+
+    def replace_one(self, document):
+        self._add('update', document, False)
+
+    def update_one(self, document):
+        self._add('update', document, False)
+
+    def update(self, document):
+        self._add('update', document, True)
+
+    def remove_one(self):
+        self._add('remove', False)
+
+    def remove(self):
+        self._add('remove', True)
+
+
+class _Bulk(object):
+    """The pymongo 2 style bulk operation builder."""
+    def __init__(self, collection, ordered):
+        self.collection = collection
+        self.ordered = ordered
+        self.ops = []
+
+    def insert(self, document):
+        self.ops.append(('insert', document))
+
+    def find(self, spec):
+        return _BulkFind(self, spec)
+
+    def execute(self, write_concern=None):
+        result = dict(nInserted=0, nMatched=0, nModified=0, nRemoved=0, nUpserted=0, upserted=[],
+                      writeErrors=[], writeConcernErrors=[])
+        for i, op in enumerate(self.ops):
+            try:
+                if op[0] == 'insert':
+                    self.collection.insert(op[1])
+                    result['nInserted'] += 1
+                elif op[0] == 'update':
+                    kind, spec, upsert, document, multi = op
+                    status = self.collection.update(spec, document, upsert=upsert, multi=multi)
+                    if status.get('upserted', None) is not None:
+                        result['nUpserted'] += 1
+                        result['upserted'].append({'index': i, '_id': status['upserted']})
+                    else:
+                        result['nMatched'] += status['n']
+                        result['nModified'] += status['n']
+                else:
+                    kind, spec, upsert, multi = op
+                    result['nRemoved'] += self.collection.remove(spec, multi=multi)['n']
+            except DuplicateKeyError, msg:
+                result['writeErrors'].append(dict(index=i, code=11000, errmsg=unicode(msg), op=op[1]))
+                if self.ordered:
+                    break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return result
+
+
+class InMemoryCollection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '{0}.{1}'.format(database.name, name)
+        self.read_preference = None
+        self.options = dict()
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._documents = OrderedDict()  # _id -> document
+        self._indexes = {'_id_': dict(key=[('_id', pymongo.ASCENDING)])}
+        self._unique = dict()  # index name -> {key: _id}
+        self._exists = False
+
+    def __repr__(self):
+        return "InMemoryCollection({0!r})".format(self.full_name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        # sub-collections, like pymongo:
+        return self.database['{0}.{1}'.format(self.name, name)]
+
+    def __getitem__(self, name):
+        return self.database['{0}.{1}'.format(self.name, name)]
+
+    def with_options(self, **kw):
+        return self
+
+    def _matching(self, spec):
+        spec = spec or {}
+        if not isinstance(spec, dict):
+            spec = {'_id': spec}
+        _id = spec.get('_id', MISSING)
+        if _id is MISSING or isinstance(_id, RE_TYPE):
+            candidates = self._documents.itervalues()
+        elif isinstance(_id, dict) and set(_id) == set(['$in']):
+            candidates = [self._documents[key] for key in _id['$in'] if key in self._documents]
+        elif _is_operator_dict(_id):
+            candidates = self._documents.itervalues()
+        else:
+            candidates = [self._documents[_id]] if _id in self._documents else []
+        return [doc for doc in candidates if _matches(doc, spec)]
+
+    def _unique_key(self, doc, index):
+        values = [_lookup(doc, field) for field, direction in index['key']]
+        if index.get('sparse', False) and not any(values):
+            return None
+        # repr, as the values may be lists or dicts:
+        return repr(tuple(value[0] if value else None for value in values))
+
+    def _add_keys(self, doc):
+        """Checks `doc` against the unique indexes, then adds it to them."""
+        keys = []
+        for name, entries in self._unique.iteritems():
+            key = self._unique_key(doc, self._indexes[name])
+            if key is not None and entries.get(key, doc['_id']) != doc['_id']:
+                raise DuplicateKeyError("E11000 duplicate key error index: {0}.${1} dup key: {2}".format(
+                    self.full_name, name, key), 11000)
+            keys.append((entries, key))
+        for entries, key in keys:
+            if key is not None:
+                entries[key] = doc['_id']
+
+    def _remove_keys(self, doc):
+        for name, entries in self._unique.iteritems():
+            key = self._unique_key(doc, self._indexes[name])
+            if entries.get(key, None) == doc['_id']:
+                del entries[key]
+
+    def _insert_one(self, document):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        doc = _copy(document)
+        if doc['_id'] in self._documents:
+            raise DuplicateKeyError("E11000 duplicate key error index: {0}.$_id_ dup key: {1!r}".format(
+                self.full_name, doc['_id']), 11000)
+        self._add_keys(doc)
+        self._documents[doc['_id']] = doc
+        self._exists = True
+        return doc['_id']
+
+    def _update(self, spec, document, upsert=False, multi=False):
+        with self._lock:
+            docs = self._matching(spec)
+            if not multi:
+                docs = docs[:1]
+            for doc in docs:
+                backup = _copy(doc)
+                self._remove_keys(doc)
+                try:
+                    _apply_update(doc, document)
+                    self._add_keys(doc)
+                except Exception:
+                    doc.clear()
+                    doc.update(backup)
+                    self._add_keys(doc)
+                    raise
+            if docs or not upsert:
+                return dict(n=len(docs), updatedExisting=bool(docs), upserted=None, ok=1.0)
+            doc = _upsert_base(spec)
+            if not _is_update(document):
+                doc = dict(_copy(document), **dict((k, v) for k, v in doc.iteritems() if k == '_id'))
+            else:
+                doc.setdefault('_id', ObjectId())
+                _apply_update(doc, document, inserting=True)
+            _id = self._insert_one(doc)
+            return dict(n=1, updatedExisting=False, upserted=_id, ok=1.0)
+
+    # pymongo 2
+
+    def insert(self, doc_or_docs, manipulate=True, safe=None, check_keys=True, continue_on_error=False, **kw):
+        with self._lock:
+            if isinstance(doc_or_docs, dict):
+                return self._insert_one(doc_or_docs)
+            ids = []
+            for doc in doc_or_docs:
+                try:
+                    ids.append(self._insert_one(doc))
+                except DuplicateKeyError:
+                    if not continue_on_error:
+                        raise
+            return ids
+
+    def save(self, to_save, manipulate=True, safe=None, **kw):
+        if '_id' not in to_save:
+            return self.insert(to_save)
+        self._update({'_id': to_save['_id']}, to_save, upsert=True)
+        return to_save['_id']
+
+    def update(self, spec, document, upsert=False, manipulate=False, safe=None, multi=False, **kw):
+        return self._update(spec, document, upsert=upsert, multi=multi)
+
+    def remove(self, spec_or_id=None, safe=None, multi=True, **kw):
+        with self._lock:
+            docs = self._matching(spec_or_id)
+            if not multi:
+                docs = docs[:1]
+            for doc in docs:
+                self._remove_keys(doc)
+                del self._documents[doc['_id']]
+            return dict(n=len(docs), ok=1.0)
+
+    def initialize_ordered_bulk_op(self):
+        return _Bulk(self, True)
+
+    def initialize_unordered_bulk_op(self):
+        return _Bulk(self, False)
+
+    def ensure_index(self, key_or_list, cache_for=300, **kw):
+        return self.create_index(key_or_list, **kw)
+
+    # pymongo 3
+
+    def insert_one(self, document, **kw):
+        return _Result(inserted_id=self.insert(document))
+
+    def insert_many(self, documents, ordered=True, **kw):
+        return _Result(inserted_ids=self.insert(list(documents), continue_on_error=not ordered))
+
+    def replace_one(self, filter, replacement, upsert=False, **kw):
+        if _is_update(replacement):
+            raise ValueError("replacement can not include $ operators")
+        status = self._update(filter, replacement, upsert=upsert)
+        return _Result(matched_count=status['n'] if status['updatedExisting'] else 0,
+                       modified_count=status['n'] if status['updatedExisting'] else 0,
+                       upserted_id=status['upserted'])
+
+    def update_one(self, filter, update, upsert=False, **kw):
+        status = self._update(filter, update, upsert=upsert)
+        return _Result(matched_count=status['n'] if status['updatedExisting'] else 0,
+                       modified_count=status['n'] if status['updatedExisting'] else 0,
+                       upserted_id=status['upserted'])
+
+    def update_many(self, filter, update, upsert=False, **kw):
+        status = self._update(filter, update, upsert=upsert, multi=True)
+        return _Result(matched_count=status['n'] if status['updatedExisting'] else 0,
+                       modified_count=status['n'] if status['updatedExisting'] else 0,
+                       upserted_id=status['upserted'])
+
+    def delete_one(self, filter, **kw):
+        return _Result(deleted_count=self.remove(filter, multi=False)['n'])
+
+    def delete_many(self, filter, **kw):
+        return _Result(deleted_count=self.remove(filter)['n'])
+
+    def bulk_write(self, requests, ordered=True, **kw):
+        bulk = _Bulk(self, ordered)
+        for request in requests:
+            kind = type(request).__name__
+            if kind == 'InsertOne':
+                bulk.insert(request._doc)
+            elif kind in ('ReplaceOne', 'UpdateOne', 'UpdateMany'):
+                find = bulk.find(request._filter)
+                if request._upsert:
+                    find.upsert()
+                getattr(find, 'update' if kind == 'UpdateMany' else 'update_one')(request._doc)
+            elif kind in ('DeleteOne', 'DeleteMany'):
+                getattr(bulk.find(request._filter), 'remove' if kind == 'DeleteMany' else 'remove_one')()
+            else:
+                raise NotImplementedError("{0} is not supported by the in-memory backend.".format(kind))
+        result = bulk.execute()
+        return _Result(inserted_count=result['nInserted'], matched_count=result['nMatched'],
+                       modified_count=result['nModified'], deleted_count=result['nRemoved'],
+                       upserted_count=result['nUpserted'], bulk_api_result=result)
+
+    def count_documents(self, filter, **kw):
+        return self.find(filter, skip=kw.get('skip', 0), limit=kw.get('limit', 0)).count(True)
+
+    # both
+
+    def find(self, spec=None, fields=None, skip=0, limit=0, sort=None, projection=None, filter=None, **kw):
+        if filter is not None:
+            spec = filter
+        if projection is None:
+            projection = fields
+        if sort is not None:
+            sort = _index_keys(sort)
+        for unsupported in ('tailable', 'cursor_type', 'modifiers'):
+            if kw.get(unsupported, None):
+                raise NotImplementedError("{0} is not supported by the in-memory backend.".format(unsupported))
+        return InMemoryCursor(self, spec, projection, skip, limit, sort)
+
+    def find_one(self, spec_or_id=None, *args, **kw):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for doc in self.find(spec_or_id, *args, **kw).limit(1):
+            return doc
+        return None
+
+    def count(self, spec=None):
+        return self.find(spec).count()
+
+    def distinct(self, key):
+        return self.find().distinct(key)
+
+    def create_index(self, key_or_list, **kw):
+        keys = _index_keys(key_or_list)
+        name = kw.pop('name', None) or _index_name(keys)
+        with self._lock:
+            existing = self._indexes.get(name, None)
+            if existing is not None:
+                return name
+            index = dict(key=keys)
+            for option in ('unique', 'sparse', 'weights', 'default_language', 'language_override',
+                           'expireAfterSeconds'):
+                if option in kw:
+                    index[option] = kw[option]
+            if index.get('unique', False):
+                entries = dict()
+                for doc in self._documents.itervalues():
+                    key = self._unique_key(doc, index)
+                    if key in entries:
+                        raise DuplicateKeyError("E11000 duplicate key error index: {0}.${1} dup key: {2}".format(
+                            self.full_name, name, key), 11000)
+                    if key is not None:
+                        entries[key] = doc['_id']
+                self._unique[name] = entries
+            self._exists = True
+            self._indexes[name] = index
+        return name
+
+    def index_information(self):
+        with self._lock:
+            return _copy(self._indexes)
+
+    def drop_index(self, index_or_name):
+        name = index_or_name
+        if not isinstance(name, basestring):
+            name = _index_name(_index_keys(index_or_name))
+        with self._lock:
+            if name == '_id_' or name not in self._indexes:
+                raise OperationFailure("index not found with name [{0}]".format(name))
+            del self._indexes[name]
+            self._unique.pop(name, None)
+
+    def drop_indexes(self):
+        with self._lock:
+            self._indexes = {'_id_': self._indexes['_id_']}
+            self._unique = dict()
+
+    def drop(self):
+        # like with pymongo, this object stays usable and starts out empty:
+        with self._lock:
+            self._reset()
+
+
+class InMemoryDatabase(object):
+    def __init__(self, client, name):
+        self.client = self.connection = client
+        self.name = name
+        self._collections = dict()
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return "InMemoryDatabase({0!r})".format(self.name)
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = InMemoryCollection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def collection_names(self, include_system_collections=True):
+        with self._lock:
+            return sorted(name for name, collection in self._collections.iteritems() if collection._exists)
+    list_collection_names = collection_names
+
+    def create_collection(self, name, **options):
+        with self._lock:
+            collection = self[name]
+            if collection._exists:
+                raise CollectionInvalid("collection {0} already exists".format(name))
+            collection.options = options
+            collection._exists = True
+            return collection
+
+    def drop_collection(self, name_or_collection):
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        with self._lock:
+            if name in self._collections:
+                self._collections[name].drop()
+
+    def command(self, command, value=1, **kw):
+        if isinstance(command, dict):
+            kw.update(command)
+            command, value = next(iter(command.items()))
+        if command == 'ping':
+            return {'ok': 1.0}
+        if command == 'collMod':
+            with self._lock:
+                if value not in self.collection_names():
+                    error = OperationFailure("ns does not exist", 26)
+                    error.code = 26
+                    raise error
+                self._collections[value].options.update(kw)
+            return {'ok': 1.0}
+        raise NotImplementedError("The {0} command is not supported by the in-memory backend.".format(command))
+
+    def dereference(self, dbref):
+        if not isinstance(dbref, DBRef):
+            raise TypeError("cannot dereference a {0}".format(type(dbref)))
+        database = self
+        if dbref.database is not None and dbref.database != self.name:
+            database = self.client[dbref.database]
+        return database[dbref.collection].find_one({'_id': dbref.id})
+
+
+class InMemoryClient(object):
+    """
+    Holds any number of in-memory databases, like a `pymongo.MongoClient` does. Nothing is shared
+    between clients, or with other processes.
+    """
+    host = 'memory'
+    port = None
+
+    def __init__(self, *args, **kw):
+        self._databases = dict()
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return "InMemoryClient()"
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = InMemoryDatabase(self, name)
+            return self._databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def database_names(self):
+        with self._lock:
+            return sorted(name for name, database in self._databases.iteritems() if database.collection_names())
+    list_database_names = database_names
+
+    def drop_database(self, name_or_database):
+        name = getattr(name_or_database, 'name', name_or_database)
+        with self._lock:
+            database = self._databases.get(name, None)
+        if database is not None:
+            for collection_name in list(database._collections):
+                database.drop_collection(collection_name)
+
+    def close(self):
+        pass
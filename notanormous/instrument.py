@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+"""
+Which Document classes make the database load: every command sent for a class is attributed to the
+class and the Notanormous operation which sent it, and counted, timed and sized.
+
+    from notanormous import instrument
+    instrument.enable()
+    ...
+    for (classname, operation, command), s in sorted(instrument.stats().items()):
+        print classname, operation, command, s['count'], s['p99'], s['documents'], s['bytes']
+
+The operations are 'save', 'delete', 'refresh', 'refresh_many', 'refresh_stored_properties', 'find',
+'get_by_id', 'paginate', 'search', 'reference' (the reference getters), 'prefetch', 'write_behind',
+'export', 'import' and 'migrate'. The commands are the pymongo methods called, e.g. 'find', 'insert',
+'update'.
+
+For each (class, operation, command) there's a count, the number of errors, a latency histogram, the
+number of documents returned or written and their size in bytes, as BSON. A find is measured from the
+`find` call until its cursor is exhausted or closed, counting only the time spent waiting for pymongo,
+not the time the caller spends on each document.
+
+Sinks, added with `add_sink`, are called with a `CommandEvent` for every command, e.g. to forward them
+to statsd or a log. Reads are tagged with the read preference mode they were routed with, the same as
+routing listeners see (see `notanormous.connection`).
+
+While disabled (the default) Notanormous hands out collections unwrapped, so there's nothing to pay
+but one check per operation.
+"""
+
+from bisect import bisect_left
+import threading
+import time
+
+from bson import BSON
+
+__all__ = [
+    'CommandEvent',
+    'Histogram',
+    'add_sink',
+    'disable',
+    'enable',
+    'instrumented',
+    'remove_sink',
+    'reset',
+    'stats',
+]
+
+
+enabled = False
+measure_bytes = True
+
+SINKS = []
+
+# upper bounds of the histogram buckets, in seconds, there is one more for anything slower:
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_stats = dict()  # (classname, operation, command) -> _Stats
+_lock = threading.Lock()
+
+
+class Histogram(object):
+    """Counts of latencies per bucket, see `BUCKETS`."""
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        The upper bound of the bucket holding the `p`th percentile (0-100). Past the last bucket, the
+        slowest time seen.
+        """
+        if not self.count:
+            return None
+        wanted = self.count * p / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+
+class _Stats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.documents = 0
+        self.bytes = 0
+        self.histogram = Histogram()
+
+    def as_dict(self):
+        h = self.histogram
+        return dict(count=self.count, errors=self.errors, seconds=self.seconds, documents=self.documents,
+                    bytes=self.bytes, p50=h.percentile(50), p90=h.percentile(90), p99=h.percentile(99),
+                    max=h.max, histogram=zip(h.bounds + (None,), h.counts))
+
+
+class CommandEvent(object):
+    """
+    One database command, as passed to sinks. For reads, `query` is a dict with the 'filter' and the
+    'sort' (a list of (key, direction), or None).
+    """
+    __slots__ = ('document_class', 'operation', 'command', 'seconds', 'documents', 'bytes', 'error',
+                 'read_preference', 'query')
+
+    def __init__(self, document_class, operation, command, seconds, documents=0, bytes=0, error=None,
+                 read_preference=None, query=None):
+        self.document_class = document_class
+        self.operation = operation
+        self.command = command
+        self.seconds = seconds
+        self.documents = documents
+        self.bytes = bytes
+        self.error = error
+        self.read_preference = read_preference
+        self.query = query
+
+    def __repr__(self):
+        return "<CommandEvent {0}.{1} {2} {3:.6f}s>".format(self.document_class.__name__, self.operation,
+                                                           self.command, self.seconds)
+
+
+def enable(sink=None, bytes=True):
+    """
+    Starts recording. `bytes=False` skips measuring sizes, which means encoding every document to
+    BSON again.
+    """
+    global enabled, measure_bytes
+    if sink is not None:
+        add_sink(sink)
+    measure_bytes = bytes
+    enabled = True
+
+
+def disable():
+    """Stops recording. The stats so far are kept until `reset`."""
+    global enabled
+    enabled = False
+
+
+def add_sink(sink):
+    """`sink(event)` is called with a `CommandEvent` for every command, in the thread which sent it."""
+    if sink not in SINKS:
+        SINKS.append(sink)
+
+
+def remove_sink(sink):
+    if sink in SINKS:
+        SINKS.remove(sink)
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def stats(document_class=None, operation=None):
+    """
+    The stats so far, as {(classname, operation, command): dict} with keys 'count', 'errors',
+    'seconds' (in total), 'documents', 'bytes', 'p50', 'p90', 'p99', 'max' and 'histogram', a list of
+    (bucket upper bound, count), the last bound being None.
+    """
+    if document_class is not None and not isinstance(document_class, basestring):
+        document_class = document_class.__name__
+    with _lock:
+        return dict((key, s.as_dict()) for key, s in _stats.iteritems()
+                    if document_class in (None, key[0]) and operation in (None, key[1]))
+
+
+def record(event):
+    key = (event.document_class.__name__, event.operation, event.command)
+    with _lock:
+        s = _stats.get(key, None)
+        if s is None:
+            s = _stats[key] = _Stats()
+        s.count += 1
+        if event.error is not None:
+            s.errors += 1
+        s.seconds += event.seconds
+        s.documents += event.documents
+        s.bytes += event.bytes
+        s.histogram.add(event.seconds)
+    for sink in list(SINKS):
+        sink(event)
+
+
+def _size(doc):
+    if not measure_bytes or not isinstance(doc, dict):
+        return 0
+    try:
+        return len(BSON.encode(doc))
+    except Exception:
+        return 0
+
+
+def _sizes(docs):
+    if isinstance(docs, dict):
+        return 1, _size(docs)
+    docs = list(docs)
+    return len(docs), sum(_size(doc) for doc in docs)
+
+
+class _Timed(object):
+    """Times one call on a collection (or bulk operation) and records it."""
+    def __init__(self, proxy, command):
+        self.proxy = proxy
+        self.command = command
+
+    def __call__(self, *args, **kw):
+        proxy = self.proxy
+        attr = getattr(proxy._target, self.command)
+        start = time.time()
+        result = error = None
+        try:
+            result = attr(*args, **kw)
+            return result
+        except Exception, error:
+            raise
+        finally:
+            seconds = time.time() - start
+            documents, nbytes = proxy._measure(self.command, args, kw, result)
+            record(CommandEvent(proxy._document_class, proxy._operation, self.command, seconds, documents,
+                                nbytes, error, proxy._read_preference, proxy._query(self.command, args, kw)))
+
+
+class _Proxy(object):
+    def __init__(self, target, document_class, operation, read_preference=None):
+        self._target = target
+        self._document_class = document_class
+        self._operation = operation
+        self._read_preference = read_preference
+
+    def __getattr__(self, key):
+        if key == '_target':
+            raise AttributeError(key)
+        return getattr(self._target, key)
+
+    def _measure(self, command, args, kw, result):
+        return 0, 0
+
+    def _query(self, command, args, kw):
+        return None
+
+
+def _sort_keys(key_or_list, direction=None):
+    if key_or_list is None:
+        return None
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, direction or 1)]
+    return list(key_or_list)
+
+
+def _filter(args, kw):
+    spec = args[0] if args else kw.get('spec', kw.get('filter', kw.get('spec_or_id', None)))
+    if spec is None:
+        return {}
+    if not isinstance(spec, dict):
+        return {'_id': spec}
+    return spec
+
+
+class InstrumentedCollection(_Proxy):
+    """
+    Wraps a collection, recording the commands sent through it. Anything not listed here is passed
+    through as it is.
+    """
+    WRITES = ('insert', 'insert_one', 'insert_many', 'save', 'update', 'update_one', 'update_many',
+              'replace_one', 'remove', 'delete_one', 'delete_many', 'bulk_write')
+    READS = ('find_one', 'count', 'count_documents', 'distinct')
+
+    def __getattr__(self, key):
+        if key in self.WRITES or key in self.READS:
+            return _Timed(self, key)
+        return _Proxy.__getattr__(self, key)
+
+    def __repr__(self):
+        return "<InstrumentedCollection {0!r}>".format(self._target)
+
+    def _measure(self, command, args, kw, result):
+        if command == 'find_one':
+            return (1, _size(result)) if result is not None else (0, 0)
+        if command in ('insert', 'insert_one', 'insert_many', 'save') and args:
+            return _sizes(args[0])
+        if command in ('update', 'update_one', 'update_many', 'replace_one') and len(args) > 1:
+            return 1, _size(args[1])
+        return 0, 0
+
+    def _query(self, command, args, kw):
+        if command in self.READS:
+            return dict(filter=_filter(args, kw), sort=None)
+        return None
+
+    def find(self, *args, **kw):
+        start = time.time()
+        cursor = self._target.find(*args, **kw)
+        query = dict(filter=_filter(args, kw), sort=_sort_keys(kw.get('sort', None)))
+        return InstrumentedCursor(cursor, self._document_class, self._operation, self._read_preference,
+                                  time.time() - start, query)
+
+    def initialize_ordered_bulk_op(self):
+        return _InstrumentedBulk(self._target.initialize_ordered_bulk_op(), self._document_class,
+                                 self._operation, self._read_preference)
+
+    def initialize_unordered_bulk_op(self):
+        return _InstrumentedBulk(self._target.initialize_unordered_bulk_op(), self._document_class,
+                                 self._operation, self._read_preference)
+
+
+class _InstrumentedBulk(_Proxy):
+    def __init__(self, *args):
+        _Proxy.__init__(self, *args)
+        self._documents = 0
+        self._bytes = 0
+
+    def insert(self, document):
+        self._documents += 1
+        self._bytes += _size(document)
+        return self._target.insert(document)
+
+    def execute(self, *args, **kw):
+        return _Timed(self, 'execute')(*args, **kw)
+
+    def _measure(self, command, args, kw, result):
+        return self._documents, self._bytes
+
+
+class InstrumentedCursor(_Proxy):
+    """
+    Wraps a cursor, recording one 'find' when it's exhausted or closed: the time spent in pymongo, the
+    documents returned and their size.
+    """
+    def __init__(self, cursor, document_class, operation, read_preference=None, seconds=0.0, query=None):
+        _Proxy.__init__(self, cursor, document_class, operation, read_preference)
+        self._find_query = query or dict(filter={}, sort=None)
+        self._seconds = seconds
+        self._documents = 0
+        self._bytes = 0
+        self._done = False
+
+    def __repr__(self):
+        return "<InstrumentedCursor {0!r}>".format(self._target)
+
+    def __getattr__(self, key):
+        attr = _Proxy.__getattr__(self, key)
+        if not callable(attr):
+            return attr
+        def chained(*args, **kw):
+            result = attr(*args, **kw)
+            if key == 'sort':
+                self._find_query['sort'] = _sort_keys(*args, **kw)
+            # keep chaining through us:
+            if result is self._target:
+                return self
+            return result
+        return chained
+
+    def _query(self, command, args, kw):
+        return self._find_query
+
+    def _finish(self, error=None):
+        if self._done:
+            return
+        self._done = True
+        record(CommandEvent(self._document_class, self._operation, 'find', self._seconds, self._documents,
+                            self._bytes, error, self._read_preference, self._find_query))
+
+    def count(self, *args, **kw):
+        return _Timed(self, 'count')(*args, **kw)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            item = self._target.next()
+        except StopIteration:
+            self._seconds += time.time() - start
+            self._finish()
+            raise
+        except Exception, error:
+            self._seconds += time.time() - start
+            self._finish(error)
+            raise
+        self._seconds += time.time() - start
+        self._documents += 1
+        self._bytes += _size(item)
+        return item
+    __next__ = next
+
+    def __getitem__(self, index):
+        result = self._target[index]
+        if isinstance(index, slice):
+            return self
+        return result
+
+    def close(self):
+        self._target.close()
+        self._finish()
+
+    def __del__(self):
+        # a cursor which was only partly read still counts:
+        if self._documents and not self._done:
+            self._finish()
+
+
+def instrumented(document_class, collection, operation, read_preference=None):
+    """`collection`, recording what is sent through it for `operation` of `document_class`."""
+    return InstrumentedCollection(collection, document_class, operation, read_preference)
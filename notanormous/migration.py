@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""
+Schema migrations, one `__version__` at a time.
+
+Every Document stores the `__version__` of its class at `_data._version`. When you change a class in a
+way old documents don't fit, bump `__version__` and register a function taking a document from the old
+version to the next::
+
+    class Author(Document):
+        full_name = StringField()
+        __version__ = 2
+
+    @migration.migrates(Author, 1)
+    def split_name(data):
+        data['full_name'] = data.pop('name', None)
+
+Migrations work on the dict as it comes from MongoDB, before it becomes a Document, and change it in
+place or return a new one. A document several versions behind goes through each step in turn.
+
+They are applied lazily: a Document loaded at an old version is upgraded as it's loaded, and marked
+changed, so the next `save` writes the new version back. Embedded Documents are upgraded the same way,
+as their container loads.
+
+To upgrade the rest without waiting for them to be loaded, run a `Migrator`. It finds the documents of
+a class below its `__version__`, in `_id` order, and writes them back upgraded with one bulk write per
+chunk, optionally throttled. A document saved in the meantime is left as saved. With a checkpoint file
+it picks up where it stopped; without one, it starts again from the first old document, which is just
+as correct but scans further.
+
+Classes with no migrations registered load as they always did, whatever their version.
+"""
+
+import threading
+import time
+
+import pymongo
+
+__all__ = [
+    'MigrationError',
+    'Migrator',
+    'migrates',
+    'register',
+    'upgrade',
+]
+
+
+MIGRATIONS = dict()  # classname -> {from version: function}
+
+
+class MigrationError(Exception):
+    pass
+
+
+def register(document_class, from_version, func):
+    """Registers `func` to take documents of `document_class` from `from_version` to the next."""
+    steps = MIGRATIONS.setdefault(document_class.__name__, dict())
+    if from_version in steps:
+        raise ValueError("{0} already has a migration from version {1}: {2}.".format(
+            document_class.__name__, from_version, steps[from_version].__name__))
+    steps[from_version] = func
+    return func
+
+
+def migrates(document_class, from_version):
+    """Decorator for `register`."""
+    def decorator(func):
+        return register(document_class, from_version, func)
+    return decorator
+
+
+def stored_version(data):
+    """The version of a dict from MongoDB, 1 for documents from before versions were stored."""
+    version = data.get('_data', {}).get('_version', None)
+    if version is None:
+        return 1
+    return version
+
+
+def upgrade(document_class, data):
+    """
+    `data` (from MongoDB) upgraded to `document_class.__version__`, or None if there's nothing to do.
+    """
+    steps = MIGRATIONS.get(document_class.__name__, None)
+    if not steps:
+        return None
+    version = stored_version(data)
+    target = document_class.__version__
+    if version >= target:
+        return None
+    while version < target:
+        step = steps.get(version, None)
+        if step is None:
+            raise MigrationError("{0} has no migration from version {1} to {2}.".format(
+                document_class.__name__, version, version + 1))
+        result = step(data)
+        if result is not None:
+            data = result
+        version += 1
+        data.setdefault('_data', dict())['_version'] = version
+    return data
+
+
+def _outdated(document_class):
+    version = document_class.__version__
+    # None matches a missing version too:
+    return {'$or': [{'_data._version': {'$lt': version}}, {'_data._version': None}]}
+
+
+class Migrator(object):
+    """
+    Upgrades every document of `document_class` below its `__version__`, see the module docstring.
+
+    :param chunk: documents per read and bulk write.
+    :param pause: seconds to sleep between chunks.
+    :param rate: at most this many documents per second, on average.
+    :param checkpoint: path of a file recording the last `_id` done. The file is left in place when
+        the migration finishes, delete it to start over.
+    :param progress: called as `progress(migrated, scanned)` after each chunk.
+    """
+    def __init__(self, document_class, chunk=500, pause=0.0, rate=None, checkpoint=None, progress=None):
+        if not MIGRATIONS.get(document_class.__name__, None):
+            raise ValueError("{0} has no migrations.".format(document_class.__name__))
+        self.document_class = document_class
+        self.chunk = chunk
+        self.pause = pause
+        self.rate = rate
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.migrated = 0
+        self.scanned = 0
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run(self):
+        """Migrates until done or stopped. Returns the number of documents migrated."""
+        from notanormous.parallel import _load_checkpoint, _save_checkpoint
+        from notanormous.util import bulk_write
+        cls = self.document_class
+        coll = cls._collection('migrate')
+        state = _load_checkpoint(self.checkpoint)
+        last = state.get('last', None)
+        outdated = _outdated(cls)
+        started = time.time()
+        while not self._stop.is_set():
+            spec = outdated if last is None else {'$and': [outdated, {'_id': {'$gt': last}}]}
+            batch = list(coll.find(spec).sort('_id', pymongo.ASCENDING).limit(self.chunk))
+            if not batch:
+                break
+            replacements = []
+            for data in batch:
+                version = stored_version(data)
+                upgraded = upgrade(cls, data)
+                if upgraded is not None:
+                    # unless it was saved since:
+                    if version == 1:
+                        guard = {'_id': upgraded['_id'], '_data._version': {'$in': [1, None]}}
+                    else:
+                        guard = {'_id': upgraded['_id'], '_data._version': version}
+                    replacements.append((guard, upgraded))
+            # those saved since don't match their guard, and aren't counted:
+            migrated = bulk_write(coll, replacements=replacements)
+            last = batch[-1]['_id']
+            self.scanned += len(batch)
+            self.migrated += migrated
+            if self.checkpoint:
+                state['last'] = last
+                _save_checkpoint(self.checkpoint, state)
+            if self.progress:
+                self.progress(self.migrated, self.scanned)
+            wait = self.pause
+            if self.rate:
+                wait = max(wait, started + self.scanned / float(self.rate) - time.time())
+            if wait > 0:
+                self._stop.wait(wait)
+        return self.migrated
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception, msg:
+            self.error = msg
+
+    def start(self):
+        """Runs the migration in a background thread. Any exception ends up in `error`."""
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='notanormous-migrate-{0}'.format(
+            self.document_class.__name__))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops after the chunk in progress. `run` returns, and the background thread ends."""
+        self._stop.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.migrated
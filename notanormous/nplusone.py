@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+Finds N+1 queries: reference properties (`book.author`, `book.editors`, `author.book_set`) resolved
+one Document at a time in a loop, each with its own query.
+
+Wrap a request, a job or a test in `detect()`::
+
+    with nplusone.detect(threshold=5):
+        for book in Book.find().documents():
+            print book.author.name
+
+Every time a reference property has to query, the detector counts it against the property and the
+line of your code which used it. Past `threshold` queries from the same place, it reports once, with
+the place and what to do instead, e.g. `Document.prefetch(docs, 'author')` before the loop. Properties
+which find their Documents in the identity map don't query, and don't count.
+
+What a report does depends on `action`: 'warn' issues an `NPlusOneWarning` pointing at the line, 'raise'
+raises `NPlusOneError` (for tests), 'log' logs it to the 'notanormous.nplusone' logger, and a function
+is called with the `NPlusOne` report.
+
+`enable()` does the same for everything not inside a `detect` block, e.g. a whole development session.
+
+In production, `detect(sample=0.01)` only tracks one block in a hundred; the others cost a random
+number. Outside any detector, the cost is one check per query a reference property makes.
+"""
+
+from contextlib import contextmanager
+import logging
+import os
+import random
+import sys
+import threading
+import warnings
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+__all__ = [
+    'NPlusOne',
+    'NPlusOneError',
+    'NPlusOneWarning',
+    'Detector',
+    'detect',
+    'disable',
+    'enable',
+]
+
+
+log = logging.getLogger('notanormous.nplusone')
+
+ACTIONS = ('warn', 'raise', 'log')
+
+# the number of detectors in use anywhere, so Documents can skip all this when it's 0:
+active = 0
+_active_lock = threading.Lock()
+
+_session = None
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+
+class NPlusOneWarning(UserWarning):
+    pass
+
+
+class NPlusOneError(Exception):
+    pass
+
+
+class NPlusOne(object):
+    """A report: `prop` of `document_class` queried `count` times from `filename`:`lineno`."""
+    def __init__(self, document_class, prop, count, filename, lineno, function, suggestion):
+        self.document_class = document_class
+        self.prop = prop
+        self.count = count
+        self.filename = filename
+        self.lineno = lineno
+        self.function = function
+        self.suggestion = suggestion
+
+    @property
+    def message(self):
+        return "{0}.{1} queried {2} times from {3}:{4} in {5}(). {6}".format(
+            self.document_class.__name__, self.prop, self.count, self.filename, self.lineno, self.function,
+            self.suggestion)
+
+    def __repr__(self):
+        return "<NPlusOne {0}.{1} x{2} at {3}:{4}>".format(self.document_class.__name__, self.prop, self.count,
+                                                          self.filename, self.lineno)
+
+
+def _call_site():
+    """The innermost frame outside Notanormous, as (filename, line number, function)."""
+    frame = sys._getframe(1)
+    while frame is not None and os.path.dirname(os.path.abspath(frame.f_code.co_filename)) == _here:
+        frame = frame.f_back
+    if frame is None:
+        return '?', 0, '?'
+    return frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name
+
+
+def _suggestion(document_class, prop, reverse):
+    if reverse is not None:
+        return "Load them all at once with {0}.find({{'{1}': {{'$in': [...]}}}}) and group them.".format(
+            reverse.document_class.__name__, reverse.field_name)
+    return "Load them all at once with Document.prefetch(docs, '{0}') first.".format(prop)
+
+
+class Detector(object):
+    """Counts the queries of reference properties per property and call site, see `detect`."""
+    def __init__(self, threshold=5, action='warn'):
+        if action not in ACTIONS and not callable(action):
+            raise ValueError("action must be one of {0} or a function, not {1!r}.".format(', '.join(ACTIONS),
+                                                                                       action))
+        self.threshold = threshold
+        self.action = action
+        self.counts = dict()  # (classname, property, filename, line number) -> count
+        self.reports = []
+        self._lock = threading.Lock()
+
+    def resolving(self, document_class, name, reverse=None):
+        prop = name
+        if reverse is None:
+            # the property, rather than the field behind it:
+            for prop_name, field_name in document_class._reference_properties.iteritems():
+                if field_name == name:
+                    prop = prop_name
+                    break
+        filename, lineno, function = _call_site()
+        key = (document_class.__name__, prop, filename, lineno)
+        with self._lock:
+            count = self.counts[key] = self.counts.get(key, 0) + 1
+        if count == self.threshold + 1:
+            self.report(NPlusOne(document_class, prop, count, filename, lineno, function,
+                                 _suggestion(document_class, prop, reverse)))
+
+    def report(self, report):
+        self.reports.append(report)
+        if self.action == 'warn':
+            warnings.warn_explicit(report.message, NPlusOneWarning, report.filename, report.lineno)
+        elif self.action == 'raise':
+            raise NPlusOneError(report.message)
+        elif self.action == 'log':
+            log.warning(report.message)
+        else:
+            self.action(report)
+
+
+if contextvars is not None:
+    _current = contextvars.ContextVar('notanormous_nplusone', default=None)
+
+    def _get_scoped():
+        return _current.get()
+
+    def _set_scoped(value):
+        return _current.set(value)
+
+    def _reset_scoped(token):
+        _current.reset(token)
+else:
+    _local = threading.local()
+
+    def _get_scoped():
+        return getattr(_local, 'detector', None)
+
+    def _set_scoped(value):
+        previous = _get_scoped()
+        _local.detector = value
+        return previous
+
+    def _reset_scoped(previous):
+        _local.detector = previous
+
+
+def _activate(n):
+    global active
+    with _active_lock:
+        active += n
+
+
+@contextmanager
+def detect(threshold=5, action='warn', sample=1.0):
+    """
+    Detects N+1 queries inside the `with` block, reporting a reference property queried more than
+    `threshold` times from one place. Yields the `Detector`, or None if this block wasn't sampled.
+
+    :param sample: the fraction of blocks to track.
+    """
+    if sample < 1.0 and random.random() >= sample:
+        yield None
+        return
+    detector = Detector(threshold, action)
+    token = _set_scoped(detector)
+    _activate(1)
+    try:
+        yield detector
+    finally:
+        _activate(-1)
+        _reset_scoped(token)
+
+
+def enable(threshold=5, action='warn'):
+    """Detects N+1 queries everywhere outside `detect` blocks, until `disable`. Returns the `Detector`."""
+    global _session
+    detector = Detector(threshold, action)
+    if _session is None:
+        _activate(1)
+    _session = detector
+    return detector
+
+
+def disable():
+    global _session
+    if _session is not None:
+        _session = None
+        _activate(-1)
+
+
+def resolving(document_class, name, reverse=None):
+    """
+    Called by Documents before a reference property `name` (or the field behind it) of
+    `document_class` queries. `reverse` is the `ReverseReference`, if it's one of those.
+    """
+    detector = _get_scoped() or _session
+    if detector is not None:
+        detector.resolving(document_class, name, reverse)
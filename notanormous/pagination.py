@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+Keyset pagination, see `Document.paginate`::
+
+    page = Book.paginate({'author_id': 7}, order_by=['-published', 'title'], page_size=50)
+    for book in page:
+        ...
+    page = Book.paginate({'author_id': 7}, order_by=['-published', 'title'], page_size=50, after=page.next)
+
+Rather than skipping over the pages before it, each page asks for the documents sorted after the last
+one of the previous page, so a page deep in a large collection costs about the same as the first one.
+That needs an index on the query and the sort keys, e.g. `[('author_id', 1), ('published', -1),
+('title', 1)]` in `__index__`, otherwise every page sorts the whole match.
+
+The sort is made total by adding `_id`, ascending, unless it's already there, so documents which tie on
+the other keys still each appear exactly once. A `__serial_index__` class sorted by `_id` alone is the
+cheapest case of all, it only needs the `_id` index.
+
+`page.next` is an opaque token (URL-safe text) holding the sort keys of the last document, or None
+after the last page. It's only valid with the same `order_by`. Documents inserted or changed while
+paging turn up on the pages their keys belong to, nothing is skipped or repeated because of them.
+"""
+
+import base64
+
+from bson import BSON
+import pymongo
+
+__all__ = [
+    'Page',
+    'encode_token',
+    'decode_token',
+    'paginate',
+]
+
+
+class Page(object):
+    """One page of Documents, iterable, with the token for the next page in `next` (None if last)."""
+    def __init__(self, documents, next, order_by):
+        self.documents = documents
+        self.next = next
+        self.order_by = order_by
+
+    @property
+    def has_more(self):
+        return self.next is not None
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __getitem__(self, index):
+        return self.documents[index]
+
+    def __repr__(self):
+        return "<Page of {0} Documents{1}>".format(len(self.documents), '' if self.next else ', the last')
+
+
+def sort_keys(order_by):
+    """
+    `order_by` (a key, '-key' for descending, (key, direction), or a list of them) as a list of (key,
+    direction), ending with `_id`.
+    """
+    if order_by is None:
+        order_by = []
+    elif isinstance(order_by, basestring) or (isinstance(order_by, tuple) and len(order_by) == 2 and
+                                              isinstance(order_by[1], int)):
+        order_by = [order_by]
+    keys = []
+    for key in order_by:
+        if isinstance(key, basestring):
+            if key.startswith('-'):
+                key = (key[1:], pymongo.DESCENDING)
+            else:
+                key = (key, pymongo.ASCENDING)
+        key, direction = key
+        if direction not in (pymongo.ASCENDING, pymongo.DESCENDING):
+            raise ValueError("Can only paginate in ascending or descending order, not {0!r} for {1}.".format(
+                direction, key))
+        keys.append((key, direction))
+    if '_id' not in [k for k, d in keys]:
+        keys.append(('_id', pymongo.ASCENDING))
+    return keys
+
+
+def encode_token(keys, values):
+    data = BSON.encode({'o': [list(key) for key in keys], 'v': values})
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_token(token, keys):
+    """The sort values in `token`, which must be for the same sort `keys`."""
+    try:
+        token = str(token)
+        data = BSON(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))).decode()
+    except Exception:
+        raise ValueError("Not a pagination token: {0!r}.".format(token))
+    if [tuple(key) for key in data['o']] != keys:
+        raise ValueError("This pagination token is for another order: {0!r}.".format(data['o']))
+    return data['v']
+
+
+def _lookup(data, key):
+    for part in key.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return None
+        data = data[part]
+    return data
+
+
+def _after_key(key, direction, value):
+    """The condition on `key` for documents after `value`, or None if there are none."""
+    if direction == pymongo.ASCENDING:
+        # nulls sort first:
+        if value is None:
+            return {key: {'$ne': None}}
+        return {key: {'$gt': value}}
+    if value is None:
+        return None
+    return {'$or': [{key: {'$lt': value}}, {key: None}]}
+
+
+def after_query(keys, values):
+    """The query for documents sorted by `keys` after one with sort key `values`."""
+    clauses = []
+    for i, (key, direction) in enumerate(keys):
+        condition = _after_key(key, direction, values[i])
+        if condition is None:
+            continue
+        clause = dict((k, values[j]) for j, (k, d) in enumerate(keys[:i]))
+        clause.update(condition)
+        clauses.append(clause)
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'$or': clauses}
+
+
+def paginate(document_class, query=None, order_by=None, page_size=20, after=None, read_preference=None):
+    """See `Document.paginate`."""
+    cls = document_class
+    if page_size < 1:
+        raise ValueError("page_size must be at least 1, not {0!r}.".format(page_size))
+    keys = sort_keys(order_by)
+    spec = query or {}
+    if after is not None:
+        values = decode_token(after, keys)
+        condition = after_query(keys, values)
+        spec = {'$and': [spec, condition]} if spec else condition
+    fields = cls.fields_to_load()
+    if fields is not None:
+        # the token needs the sort keys, which may be stored properties:
+        fields = fields + [key for key, direction in keys if key.split('.')[0] not in fields]
+    coll = cls._read_collection('paginate', read_preference)
+    items = list(coll.find(spec, fields=fields).sort(keys).limit(page_size + 1))
+    token = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        token = encode_token(keys, [_lookup(last, key) for key, direction in keys])
+    from notanormous.document import _make_documents
+    return Page(_make_documents(items), token, keys)
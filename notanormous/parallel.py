@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run a function over every Document of a `__serial_index__` class, in parallel.
+
+Serial `_id`s are dense integers, so the id space is simply cut into ranges of `chunk` ids, and each
+range is loaded and processed by a worker process with its own MongoDB connection. See
+`Document.parallel_scan`.
+"""
+
+import multiprocessing
+import os
+import pickle
+
+import pymongo
+
+from notanormous.identity import identity_map
+from notanormous.inmemory import InMemoryDatabase
+from notanormous.util import bulk_write
+
+__all__ = [
+    'id_ranges',
+    'parallel_scan',
+    'touch',
+]
+
+
+def touch(doc):
+    """
+    Marks `doc` as changed, so `parallel_scan(touch, write_back=True)` re-saves every document, which
+    also recomputes its stored properties.
+    """
+    doc._dirty = True
+
+
+def id_ranges(low, high, chunk):
+    """
+    Returns [(start, end), ...] covering `low` to `high` inclusive, `chunk` ids at a time. `end` is
+    exclusive.
+    """
+    return [(start, min(start + chunk, high + 1)) for start in xrange(low, high + 1, chunk)]
+
+
+def _db_spec(db):
+    client = getattr(db, 'client', None) or db.connection
+    return client.host, client.port, db.name
+
+
+def _connect_spec(spec):
+    host, port, name = spec
+    return pymongo.MongoClient(host, port)[name]
+
+
+def _init_worker(connect, spec, clsname):
+    from notanormous.document import Document, DOCUMENT_MAP
+    if connect is not None:
+        db = connect()
+    else:
+        db = _connect_spec(spec)
+    cls = DOCUMENT_MAP[clsname]
+    # a class bound to its own database (see `notanormous.connection.bind`) keeps its binding:
+    if '_db' in cls.__dict__:
+        cls._db = db
+    else:
+        Document._db = db
+
+
+def _scan_range(task):
+    """
+    Runs in a worker: loads one range of ids and applies `func` to each Document.
+
+    Returns (start, end, result, number of documents, number written back).
+    """
+    clsname, start, end, query, func, reducer, write_back = task
+    from notanormous.document import DOCUMENT_MAP
+    cls = DOCUMENT_MAP[clsname]
+    spec = {'_id': {'$gte': start, '$lt': end}}
+    if query:
+        spec = {'$and': [query, spec]}
+    results = []
+    result = None
+    replacements = []
+    count = 0
+    # a map per range, so a worker's memory doesn't grow with the collection:
+    with identity_map():
+        for doc in cls.find(spec).documents():
+            count += 1
+            value = func(doc)
+            if value is not None:
+                if reducer is None:
+                    results.append(value)
+                elif result is None:
+                    result = value
+                else:
+                    result = reducer(result, value)
+            if write_back and doc._dirty:
+                replacements.append((doc._id, doc.to_mongodb()))
+    written = bulk_write(cls._collection(), replacements=replacements)
+    if reducer is None:
+        result = results
+    return start, end, result, count, written
+
+
+def _load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return dict(done=dict())
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _save_checkpoint(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+
+def _read_scan_log(path):
+    """
+    Reads a `parallel_scan` checkpoint: a header recording the scan, then one record per finished
+    range, appended as they finish. Returns (scan, {(start, end): result}, size of the readable part),
+    a record cut short by a crash being left out.
+    """
+    scan, done, size = None, dict(), 0
+    if not path or not os.path.exists(path):
+        return scan, done, size
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            except Exception:
+                # cut short
+                break
+            size = f.tell()
+            if isinstance(record, dict):
+                scan = record.get('scan', scan)
+                done.update(record.get('done', {}))
+            else:
+                key, result = record
+                done[key] = result
+    return scan, done, size
+
+
+def _open_scan_log(path, scan, size):
+    """Opens a checkpoint for appending after its readable part, writing the header if it's new."""
+    if os.path.exists(path):
+        f = open(path, 'r+b')
+        f.seek(size)
+        f.truncate()
+    else:
+        f = open(path, 'wb')
+    if not size:
+        pickle.dump(dict(scan=scan), f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+    return f
+
+
+def parallel_scan(document_class, func, workers=None, chunk=1000, query=None, reducer=None,
+                  write_back=False, progress=None, checkpoint=None, connect=None):
+    """
+    Applies `func` to every Document of `document_class` (matching `query`), spread over `workers`
+    processes, and returns the results.
+
+    :param func: called with each Document. Must be picklable, i.e. a module-level function.
+    :param workers: number of processes, default is one per CPU. 0 runs everything in this process.
+    :param chunk: number of ids per range.
+    :param reducer: `reducer(a, b)` combines two results, like the function given to `reduce`. Without
+        one, you get a list of all the results which weren't None, in `_id` order.
+    :param write_back: save Documents which `func` changed (their `_dirty` flag is set), with one bulk
+        write per range.
+    :param progress: called as `progress(ranges_done, ranges_total)` after each range.
+    :param checkpoint: path of a file recording finished ranges and their results. If the scan is
+        interrupted, calling it again with the same checkpoint picks up where it left off. The file
+        records the class, `query` and `chunk` too, and using it for another scan is a ValueError. Each
+        range's result is appended to it as the range finishes, so writing it doesn't get slower as
+        results pile up. The file is left in place when the scan finishes, delete it to start over.
+    :param connect: a picklable function returning the database for a worker process to use. By
+        default workers connect to the same host, port and database as `document_class`. With the
+        in-memory backend and no `connect`, everything runs in this process.
+    """
+    cls = document_class
+    if not cls.__serial_index__:
+        raise ValueError("parallel_scan needs dense integer _ids, and {0} does not use __serial_index__.".format(
+            cls.__name__))
+    coll = cls._collection()
+    first = list(coll.find(query or {}, fields=['_id']).sort('_id', pymongo.ASCENDING).limit(1))
+    if not first:
+        return None if reducer else []
+    last = list(coll.find(query or {}, fields=['_id']).sort('_id', pymongo.DESCENDING).limit(1))
+    ranges = id_ranges(first[0]['_id'], last[0]['_id'], chunk)
+    scan = (cls.__name__, query, chunk)
+    saved_scan, done, size = _read_scan_log(checkpoint)
+    if saved_scan is not None and saved_scan != scan:
+        raise ValueError("The checkpoint {0} is for a scan of {1} with query {2!r} and chunk {3}.".format(
+            checkpoint, *saved_scan))
+    # the last range grows when documents are added, and the first moves when it's deleted from, so
+    # ranges done are keyed by (start, end) and only the current ones count:
+    ranges_done = [key for key in ranges if key in done]
+    tasks = [(cls.__name__, start, end, query, func, reducer, write_back) for start, end in ranges
+             if (start, end) not in done]
+    total = len(ranges)
+    if progress:
+        progress(len(ranges_done), total)
+    if workers != 0 and connect is None and isinstance(cls._db, InMemoryDatabase):
+        # other processes can't see an in-memory database:
+        workers = 0
+    log = None
+    if checkpoint:
+        log = _open_scan_log(checkpoint, scan, size)
+    pool = None
+    try:
+        if workers == 0:
+            finished = (_scan_range(task) for task in tasks)
+        else:
+            pool = multiprocessing.Pool(workers, _init_worker, (connect, _db_spec(cls._db), cls.__name__))
+            finished = pool.imap_unordered(_scan_range, tasks)
+        for start, end, result, count, written in finished:
+            done[(start, end)] = result
+            ranges_done.append((start, end))
+            if log is not None:
+                pickle.dump(((start, end), result), log, pickle.HIGHEST_PROTOCOL)
+                log.flush()
+            if progress:
+                progress(len(ranges_done), total)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if log is not None:
+            log.close()
+    results = [done[key] for key in sorted(ranges_done)]
+    if reducer is None:
+        return [value for values in results for value in values]
+    results = [value for value in results if value is not None]
+    if not results:
+        return None
+    return reduce(reducer, results)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+Where the client-side CPU goes, per Document class and per field.
+
+    from notanormous import profiling
+    with profiling.profile() as p:
+        handle_request()
+    print p.report()
+
+While a profile is running, Documents time their work and count attribute reads:
+
+* 'encode': `to_mongodb`, per class and per field (the Field's converter plus embedded Documents and
+  lists), and the `cleanup_dict` of `_data` as field '_data'
+* 'decode': loading from MongoDB (`new_from_mongodb`), per class and per field
+* 'validate': `validation_errors`, per class and per field validator
+* 'identity': identity map lookups and additions, per class
+* 'getattr': reads of each field through `Document.__getattribute__`, counted but not timed, as
+  timing them would cost more than they do
+
+Times are inclusive: an embedded Document's encoding counts for its own class, and for the field and
+class containing it. Profiles see every thread. Nothing is recorded, and next to nothing is paid, while
+no profile is running.
+"""
+
+from contextlib import contextmanager
+import threading
+import timeit
+
+__all__ = [
+    'Profile',
+    'profile',
+]
+
+
+KINDS = ('encode', 'decode', 'validate', 'identity', 'getattr')
+
+active = False
+
+clock = timeit.default_timer
+
+_profiles = []
+_lock = threading.Lock()
+_getattribute = None  # Document.__getattribute__ while profiling
+
+
+class Profile(object):
+    """
+    The timings of a block of code: (kind, classname, field name or None) -> [calls, seconds].
+    """
+    def __init__(self):
+        self.timings = dict()
+        self.seconds = 0.0
+
+    def add(self, kind, classname, field_name, seconds):
+        timing = self.timings.get((kind, classname, field_name), None)
+        if timing is None:
+            timing = self.timings[(kind, classname, field_name)] = [0, 0.0]
+        timing[0] += 1
+        timing[1] += seconds
+
+    def classes(self, kind=None):
+        """[(seconds, calls, kind, classname), ...] for whole Documents, most expensive first."""
+        return sorted(((seconds, calls, k, classname) for (k, classname, field_name), (calls, seconds)
+                       in self.timings.iteritems() if field_name is None and kind in (None, k)), reverse=True)
+
+    def fields(self, kind=None):
+        """[(seconds, calls, kind, 'Class.field'), ...] most expensive first."""
+        return sorted(((seconds, calls, k, '{0}.{1}'.format(classname, field_name))
+                       for (k, classname, field_name), (calls, seconds) in self.timings.iteritems()
+                       if field_name is not None and kind in (None, k)), reverse=True)
+
+    def counts(self, kind='getattr'):
+        """{'Class.field': calls} for `kind`, e.g. how often each field was read."""
+        return dict(('{0}.{1}'.format(classname, field_name) if field_name else classname, calls)
+                    for (k, classname, field_name), (calls, seconds) in self.timings.iteritems() if k == kind)
+
+    def report(self, limit=10):
+        """The `limit` most expensive classes and fields, and the most read fields, as text."""
+        lines = ["Profiled {0:.1f} ms.".format(self.seconds * 1000), ""]
+        for title, rows in (("Classes", self.classes()), ("Fields", self.fields())):
+            lines.append("{0:<40} {1:<10} {2:>10} {3:>12} {4:>12}".format(title, 'kind', 'calls', 'total ms',
+                                                                          'per call us'))
+            for seconds, calls, kind, name in rows[:limit]:
+                lines.append("{0:<40} {1:<10} {2:>10} {3:>12.3f} {4:>12.2f}".format(
+                    name, kind, calls, seconds * 1000, seconds / calls * 1e6))
+            lines.append("")
+        reads = sorted(((calls, name) for name, calls in self.counts('getattr').iteritems()), reverse=True)
+        lines.append("{0:<40} {1:>10}".format("Most read fields", 'reads'))
+        for calls, name in reads[:limit]:
+            lines.append("{0:<40} {1:>10}".format(name, calls))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return "<Profile of {0} timings>".format(len(self.timings))
+
+
+def record(kind, document_class, field_name, start):
+    """Adds the time since `start` (from `clock()`) to the running profiles."""
+    seconds = clock() - start
+    classname = document_class.__name__
+    with _lock:
+        for p in _profiles:
+            p.add(kind, classname, field_name, seconds)
+
+
+def count(kind, document_class, field_name):
+    """Counts a call without timing it."""
+    classname = document_class.__name__
+    with _lock:
+        for p in _profiles:
+            p.add(kind, classname, field_name, 0.0)
+
+
+_object_getattribute = object.__getattribute__
+
+
+def _counting_getattribute(self, key):
+    if key in _object_getattribute(self, '_fields'):
+        count('getattr', _object_getattribute(self, '__class__'), key)
+    return _getattribute(self, key)
+
+
+def start(p):
+    global active, _getattribute
+    from notanormous.document import Document
+    with _lock:
+        if not _profiles:
+            _getattribute = Document.__dict__['__getattribute__']
+            Document.__getattribute__ = _counting_getattribute
+        _profiles.append(p)
+        active = True
+
+
+def stop(p):
+    global active
+    from notanormous.document import Document
+    with _lock:
+        _profiles.remove(p)
+        if not _profiles:
+            active = False
+            Document.__getattribute__ = _getattribute
+
+
+@contextmanager
+def profile():
+    """Profiles the `with` block, yielding the `Profile`."""
+    p = Profile()
+    started = clock()
+    start(p)
+    try:
+        yield p
+    finally:
+        stop(p)
+        p.seconds = clock() - started
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+Server-side validation: translate a Document class's fields into a MongoDB `$jsonSchema` and apply it
+to the collection with `collMod`.
+
+Once the schema is applied, MongoDB itself rejects bad writes, including ones from bulk loaders and
+other services which never run `is_valid`. Trusted writers can then use `save(validate=False)`.
+
+The schema is a little looser than `is_valid`: fields which aren't required may also be null or
+missing, and anything not defined as a field (stored properties, `_data` contents) is allowed.
+"""
+
+from pymongo.errors import OperationFailure
+
+from notanormous.fields import BooleanField, DateField, DateTimeField, DBRefField, DictField, \
+    EmbeddedDocumentField, FloatField, IntegerField, ListField, LocationField, ObjectIdField, \
+    OrderedDictField, StringField, TimeField, TupleField
+
+__all__ = [
+    'apply_json_schema',
+    'apply_json_schemas',
+    'json_schema',
+]
+
+
+ID_TYPES = ['objectId', 'int', 'long']
+
+
+def field_schema(field, level=1):
+    """
+    Returns the `$jsonSchema` for the value of one field.
+    """
+    if isinstance(field, type):
+        field = field()
+    schema = dict()
+    if isinstance(field, StringField):
+        schema['bsonType'] = ['string']
+        if field.max_length:
+            schema['maxLength'] = field.max_length
+        if field.choice_values is not None:
+            values = sorted(field.choice_values)
+            # an empty string is always allowed, same as is_valid:
+            if u'' not in values:
+                values.append(u'')
+            if not field.required:
+                values.append(None)
+            schema['enum'] = values
+    elif isinstance(field, IntegerField):
+        schema['bsonType'] = ['int', 'long']
+    elif isinstance(field, FloatField):
+        schema['bsonType'] = ['double']
+    elif isinstance(field, BooleanField):
+        schema['bsonType'] = ['bool']
+    elif isinstance(field, (DateTimeField, DateField, TimeField)):
+        schema['bsonType'] = ['date']
+    elif isinstance(field, ObjectIdField):
+        schema['bsonType'] = list(ID_TYPES)
+    elif isinstance(field, DBRefField):
+        schema['bsonType'] = ['object']
+        schema['required'] = ['$ref', '$id']
+    elif isinstance(field, EmbeddedDocumentField):
+        target_class = field.get_target_class()
+        if isinstance(target_class, basestring):
+            from notanormous.document import DOCUMENT_MAP
+            target_class = DOCUMENT_MAP[target_class]
+        schema = json_schema(target_class, level=level + 1)
+        schema['bsonType'] = ['object']
+    elif isinstance(field, LocationField):
+        schema['bsonType'] = ['object']
+        schema['required'] = ['type', 'coordinates']
+        schema['properties'] = {
+            'type': {'enum': ['Point']},
+            'coordinates': {'bsonType': 'array', 'minItems': 2, 'maxItems': 2,
+                            'items': {'bsonType': ['double', 'int', 'long']}},
+        }
+    elif isinstance(field, (ListField, TupleField)):
+        schema['bsonType'] = ['array']
+        if getattr(field, 'field', None) is not None:
+            schema['items'] = field_schema(field.field, level)
+    elif isinstance(field, (DictField, OrderedDictField)):
+        schema['bsonType'] = ['object']
+    if not field.required and 'bsonType' in schema:
+        schema['bsonType'].append('null')
+    return schema
+
+
+def json_schema(document_class, level=1):
+    """
+    Returns the `$jsonSchema` for `document_class`, as a dict.
+    """
+    if level > 20:
+        raise Exception("Over 20 levels deep? You need to re-think your document structure, weirdo.")
+    properties = dict()
+    required = ['_data']
+    for field_name, field in document_class._fields.iteritems():
+        if field_name == '_id':
+            continue
+        properties[field_name] = field_schema(field, level)
+        if field.required:
+            required.append(field_name)
+    properties['_data'] = {
+        'bsonType': 'object',
+        'required': ['_classname'],
+        'properties': {'_classname': {'enum': [document_class.__name__]}},
+    }
+    if not document_class.__embed_only__:
+        properties['_id'] = {'bsonType': list(ID_TYPES)}
+    return {
+        'bsonType': 'object',
+        'required': sorted(required),
+        'properties': properties,
+    }
+
+
+def apply_json_schema(document_class, validation_level='moderate', validation_action='error'):
+    """
+    Applies `document_class`'s `$jsonSchema` to its collection, creating the collection if need be.
+
+    :param validation_level: 'moderate' (the default) leaves existing invalid documents alone until
+        they are updated, 'strict' checks every insert and update.
+    :param validation_action: 'error' rejects invalid writes, 'warn' only logs them on the server.
+    """
+    db = document_class._db
+    name = document_class.__collection__
+    validator = {'$jsonSchema': json_schema(document_class)}
+    try:
+        db.command('collMod', name, validator=validator, validationLevel=validation_level,
+                   validationAction=validation_action)
+    except OperationFailure, msg:
+        # NamespaceNotFound
+        if getattr(msg, 'code', None) != 26:
+            raise
+        db.create_collection(name, validator=validator, validationLevel=validation_level,
+                             validationAction=validation_action)
+
+
+def apply_json_schemas(document_classes=None, **kw):
+    """
+    Applies the `$jsonSchema` of every Document class (or just `document_classes`), skipping
+    embed-only ones. Takes the same keyword arguments as `apply_json_schema`.
+    """
+    if document_classes is None:
+        from notanormous.document import DOCUMENTS
+        document_classes = DOCUMENTS
+    for document_class in document_classes:
+        if document_class.__embed_only__:
+            continue
+        apply_json_schema(document_class, **kw)
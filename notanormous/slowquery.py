@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+"""
+Catches slow queries, explains them, and suggests indexes.
+
+    log = slowquery.SlowQueryLog(threshold=0.1)
+    log.start()
+    ...
+    log.stop()
+    log.print_advice()
+
+While started, every query from `Document.find`, `get_by_id`, `paginate` and the reference getters
+taking longer than `threshold` seconds is captured (see `notanormous.instrument`, which this enables).
+Queries are grouped by class, shape and sort. The shape is the query with the values left out, so
+`{'author_id': 7}` and `{'author_id': 8}` are the same. The first capture of each shape is re-run with
+`explain()`, and the plan summarized: its stages, whether it scanned the whole collection (COLLSCAN),
+and the documents and keys examined against those returned.
+
+The advisor suggests, for each shape which scanned the collection or examined many more documents than
+it returned, an index with the fields compared for equality, then the sort, then the ranges. Indexes
+the class already declares in `__index__` (or its indexed references) which serve the query are left
+out. Suggestions are written in `__index__` syntax, ready to paste.
+
+Explaining runs the query again, in the thread which ran it. `sample` captures only a fraction of slow
+queries, to keep that down in production.
+"""
+
+from __future__ import print_function
+
+from collections import OrderedDict
+import random
+import sys
+import threading
+
+import pymongo
+
+from notanormous import instrument
+
+__all__ = [
+    'IndexSuggestion',
+    'SlowQuery',
+    'SlowQueryLog',
+    'plan_summary',
+    'query_shape',
+]
+
+
+OPERATIONS = ('find', 'get_by_id', 'paginate', 'reference')
+
+EQUALITY_OPERATORS = ('$eq', '$in')
+
+# examining more than this many documents per document returned is worth an index:
+EXAMINED_RATIO = 10
+
+
+def query_shape(spec):
+    """`spec` with every value replaced by 1, keeping the fields and operators."""
+    if isinstance(spec, dict):
+        shape = dict()
+        for key, value in spec.iteritems():
+            if key in ('$and', '$or', '$nor') and isinstance(value, list):
+                shape[key] = [query_shape(item) for item in value]
+            elif isinstance(value, dict) and value and all(k.startswith('$') for k in value):
+                shape[key] = query_shape(value)
+            elif key == '$elemMatch':
+                shape[key] = query_shape(value)
+            else:
+                shape[key] = 1
+        return shape
+    return 1
+
+
+def _shape_key(shape):
+    if isinstance(shape, dict):
+        return tuple(sorted((key, _shape_key(value)) for key, value in shape.iteritems()))
+    if isinstance(shape, list):
+        return tuple(_shape_key(item) for item in shape)
+    return shape
+
+
+def _stages(plan):
+    """The stages of a MongoDB 3+ plan, outermost first."""
+    stages = []
+    todo = [plan]
+    while todo:
+        stage = todo.pop(0)
+        if not stage:
+            continue
+        stages.append(stage)
+        todo.append(stage.get('inputStage', None))
+        todo.extend(stage.get('inputStages', []))
+    return stages
+
+
+def plan_summary(explain):
+    """
+    Summarizes what `cursor.explain()` returned, from MongoDB 3+ or older, as a dict of 'stages' (their
+    names, outermost first), 'indexes' used, 'collscan', 'docs_examined', 'keys_examined' and
+    'returned'.
+    """
+    if 'queryPlanner' in explain:
+        stages = _stages(explain['queryPlanner'].get('winningPlan', {}))
+        execution = explain.get('executionStats', {})
+        names = [stage['stage'] for stage in stages]
+        return dict(stages=names, indexes=[stage['indexName'] for stage in stages if 'indexName' in stage],
+                    collscan='COLLSCAN' in names, docs_examined=execution.get('totalDocsExamined', None),
+                    keys_examined=execution.get('totalKeysExamined', None),
+                    returned=execution.get('nReturned', None))
+    # MongoDB 2.x:
+    cursor = explain.get('cursor', '')
+    indexes = [cursor.split(' ', 1)[1]] if cursor.startswith('BtreeCursor ') else []
+    return dict(stages=[cursor], indexes=indexes, collscan=cursor == 'BasicCursor',
+                docs_examined=explain.get('nscannedObjects', None), keys_examined=explain.get('nscanned', None),
+                returned=explain.get('n', None))
+
+
+class SlowQuery(object):
+    """The captures of one query shape of one class."""
+    def __init__(self, document_class, operation, filter, sort):
+        self.document_class = document_class
+        self.operation = operation
+        self.filter = filter  # the first one captured
+        self.sort = sort
+        self.shape = query_shape(filter)
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.plan = None
+        self.explain_error = None
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def needs_index(self):
+        plan = self.plan
+        if plan is None:
+            return True
+        if plan['collscan']:
+            return True
+        examined, returned = plan['docs_examined'], plan['returned']
+        return examined is not None and examined > max(returned or 0, 1) * EXAMINED_RATIO
+
+    def __repr__(self):
+        return "<SlowQuery {0} {1!r} sort={2!r} x{3}>".format(self.document_class.__name__, self.shape, self.sort,
+                                                             self.count)
+
+
+class IndexSuggestion(object):
+    def __init__(self, document_class, keys, queries):
+        self.document_class = document_class
+        self.keys = keys
+        self.queries = queries
+
+    @property
+    def spec(self):
+        """The index as it would go in `__index__`."""
+        if len(self.keys) == 1 and self.keys[0][1] == pymongo.ASCENDING:
+            return self.keys[0][0]
+        return list(self.keys)
+
+    def __repr__(self):
+        return "<IndexSuggestion {0}: {1!r}>".format(self.document_class.__name__, self.spec)
+
+
+def _query_fields(spec, equality, ranges):
+    for key, cond in spec.iteritems():
+        if key == '$and':
+            for sub in cond:
+                _query_fields(sub, equality, ranges)
+        elif key.startswith('$'):
+            # $or and the like need an index per branch, which is beyond this advisor
+            continue
+        elif isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond):
+            if all(op in EQUALITY_OPERATORS for op in cond):
+                equality.append(key)
+            else:
+                ranges.append(key)
+        else:
+            equality.append(key)
+
+
+def suggest_keys(spec, sort=None):
+    """
+    The index keys for a query: equality fields, then the sort, then the ranges. None if `_id` is
+    enough.
+    """
+    equality, ranges = [], []
+    _query_fields(spec, equality, ranges)
+    if '_id' in equality:
+        return None
+    keys = [(field, pymongo.ASCENDING) for field in sorted(set(equality))]
+    for field, direction in sort or []:
+        if field not in [key for key, d in keys]:
+            keys.append((field, direction))
+    for field in sorted(set(ranges)):
+        if field not in [key for key, d in keys]:
+            keys.append((field, pymongo.ASCENDING))
+    if not keys or keys[0][0] == '_id':
+        return None
+    return keys
+
+
+def declared_indexes(document_class):
+    """The keys of each index `document_class` declares, `_id` included."""
+    indexes = [[('_id', pymongo.ASCENDING)]]
+    for spec in document_class._index_specs():
+        if isinstance(spec, basestring):
+            indexes.append([(spec, pymongo.ASCENDING)])
+        elif isinstance(spec[0], (list, tuple)):
+            indexes.append([tuple(key) for key in spec])
+        else:
+            indexes.append([tuple(spec)])
+    return indexes
+
+
+def _serves(index, keys, equality_count):
+    """Whether `index` does the job of `keys`, whose first `equality_count` fields are equalities."""
+    fields = [field for field, direction in index]
+    wanted = [field for field, direction in keys]
+    if fields[:len(wanted)] == wanted:
+        return True
+    # the equality fields may come in any order:
+    return equality_count > 0 and set(fields[:equality_count]) == set(wanted[:equality_count]) and \
+        fields[equality_count:len(wanted)] == wanted[equality_count:]
+
+
+class SlowQueryLog(object):
+    """
+    A sink for `notanormous.instrument` collecting slow queries, see the module docstring.
+
+    :param threshold: seconds a query must take to be captured.
+    :param sample: the fraction of slow queries to capture.
+    :param operations: the Notanormous operations to watch.
+    :param explain: re-run the first query of each shape with `explain()`.
+    """
+    def __init__(self, threshold=0.1, sample=1.0, operations=OPERATIONS, explain=True):
+        self.threshold = threshold
+        self.sample = sample
+        self.operations = operations
+        self.explain = explain
+        self.queries = OrderedDict()  # (classname, shape, sort) -> SlowQuery
+        self._lock = threading.Lock()
+        self._enabled = False
+
+    def start(self):
+        if not instrument.enabled:
+            instrument.enable(bytes=False)
+            self._enabled = True
+        instrument.add_sink(self)
+        return self
+
+    def stop(self):
+        instrument.remove_sink(self)
+        if self._enabled:
+            instrument.disable()
+            self._enabled = False
+
+    def __call__(self, event):
+        if event.query is None or event.error is not None or event.operation not in self.operations or \
+                event.seconds < self.threshold:
+            return
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return
+        query = event.query
+        sort = query['sort'] and tuple(tuple(key) for key in query['sort'])
+        key = (event.document_class.__name__, _shape_key(query_shape(query['filter'])), sort)
+        with self._lock:
+            slow = self.queries.get(key, None)
+            new = slow is None
+            if new:
+                slow = self.queries[key] = SlowQuery(event.document_class, event.operation, query['filter'],
+                                                     query['sort'])
+            slow.add(event.seconds)
+        if new and self.explain:
+            self._explain(slow)
+
+    def _explain(self, slow):
+        try:
+            cursor = slow.document_class._collection().find(slow.filter)
+            if slow.sort:
+                cursor = cursor.sort(slow.sort)
+            slow.plan = plan_summary(cursor.explain())
+        except Exception, msg:
+            slow.explain_error = msg
+
+    def advise(self):
+        """A list of `IndexSuggestion`s, with the queries each would serve."""
+        wanted = OrderedDict()  # (class, keys) -> [SlowQuery]
+        for slow in self.queries.values():
+            if not slow.needs_index:
+                continue
+            keys = suggest_keys(slow.filter, slow.sort)
+            if keys is None:
+                continue
+            equality = []
+            _query_fields(slow.filter, equality, [])
+            equality_count = len(set(equality))
+            if any(_serves(index, keys, equality_count) for index in declared_indexes(slow.document_class)):
+                continue
+            wanted.setdefault((slow.document_class, tuple(keys)), []).append(slow)
+        suggestions = []
+        for (cls, keys), queries in wanted.iteritems():
+            # an index whose keys start with these serves these queries too:
+            longer = [other for other_cls, other in wanted if other_cls is cls and other != keys and
+                      other[:len(keys)] == keys]
+            if longer:
+                wanted[(cls, longer[0])].extend(queries)
+                continue
+            suggestions.append(IndexSuggestion(cls, list(keys), queries))
+        return suggestions
+
+    def print_advice(self, out=sys.stdout):
+        """Prints the slow queries, and the suggested indexes."""
+        for slow in sorted(self.queries.values(), key=lambda slow: -slow.seconds):
+            plan = slow.plan
+            detail = ''
+            if plan is not None:
+                detail = " {0}, examined {1} for {2}".format('/'.join(plan['stages']), plan['docs_examined'],
+                                                              plan['returned'])
+            print("{0} {1} {2!r} sort={3!r}: {4} slow, {5:.1f} ms max{6}".format(
+                slow.document_class.__name__, slow.operation, slow.shape, slow.sort, slow.count, slow.max * 1000,
+                detail), file=out)
+        suggestions = self.advise()
+        if not suggestions:
+            print("No indexes to suggest.", file=out)
+        for suggestion in suggestions:
+            print("{0}: add to __index__: {1!r}  # for {2} slow queries".format(
+                suggestion.document_class.__name__, suggestion.spec, sum(q.count for q in suggestion.queries)),
+                file=out)
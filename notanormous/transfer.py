@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming export and import of a Document class's collection, for backups and seeding environments.
+See `Document.export` and `Document.import_`.
+
+Documents are read from a cursor and written to the file one at a time, and read back in batches which
+are inserted in bulk, so memory use doesn't grow with the collection. No Documents are made, the stored
+dicts are copied as they are, `_id`, `_data` (with `_classname` and `_version`) and stored properties
+included.
+
+Two formats:
+
+* 'bson': BSON documents one after the other, the same as `mongodump` writes, so `mongorestore` can
+  read an uncompressed export.
+* 'jsonl': one MongoDB Extended JSON document per line, readable and diffable.
+
+Files are gzipped by default. Imports notice by themselves whether a file is gzipped, and which format
+it's in.
+"""
+
+import gzip
+import os
+import struct
+import threading
+from multiprocessing.pool import ThreadPool
+
+from bson import BSON
+from bson import json_util
+
+from notanormous.util import bulk_write
+
+__all__ = [
+    'export',
+    'import_',
+    'read_file',
+]
+
+
+FORMATS = ('bson', 'jsonl')
+
+# the type codes a BSON document's first element can have, or 0 for an empty document:
+BSON_TYPES = frozenset(range(0x00, 0x14) + [0x7f, 0xff])
+
+
+def _format(path, format):
+    if format is None:
+        root, extension = os.path.splitext(path)
+        if extension == '.gz':
+            extension = os.path.splitext(root)[1]
+        format = 'jsonl' if extension in ('.jsonl', '.json') else 'bson'
+    if format not in FORMATS:
+        raise ValueError("format must be one of {0}, not {1!r}.".format(', '.join(FORMATS), format))
+    return format
+
+
+def _sniff_format(head):
+    """
+    The format of a file starting with `head`, its first (uncompressed) bytes. A line of JSON starts
+    with '{' and carries on in printable characters. BSON starts with the document's size, which may
+    well be '{', but its fifth byte is a type code, and those aren't printable.
+    """
+    if head[:1] != '{':
+        return 'bson'
+    if len(head) < 5 or ord(head[4]) not in BSON_TYPES:
+        return 'jsonl'
+    return 'bson'
+
+
+def _open(path, mode, compress):
+    if compress:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _is_gzipped(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == '\x1f\x8b'
+
+
+def export(document_class, path, query=None, format='bson', compress=True, batch_size=1000):
+    """
+    Writes the stored documents of `document_class` matching `query` to `path`. Returns the number
+    written.
+    """
+    format = _format(path, format)
+    cursor = document_class._collection('export').find(query or {}).batch_size(batch_size)
+    count = 0
+    with _open(path, 'wb', compress) as f:
+        for item in cursor:
+            if format == 'bson':
+                f.write(BSON.encode(item))
+            else:
+                f.write(json_util.dumps(item))
+                f.write('\n')
+            count += 1
+    return count
+
+
+def read_file(path, format=None):
+    """
+    Yields the documents in an exported file, one at a time, as dicts. Without a `format`, it's told
+    from the first bytes of the file.
+    """
+    if format is not None:
+        format = _format(path, format)
+    with _open(path, 'rb', _is_gzipped(path)) as f:
+        if format is None:
+            format = _sniff_format(f.read(5))
+            f.seek(0)
+        if format == 'jsonl':
+            for line in f:
+                if line.strip():
+                    yield json_util.loads(line)
+            return
+        while True:
+            head = f.read(4)
+            if not head:
+                return
+            if len(head) < 4:
+                raise ValueError("{0} ends in the middle of a document.".format(path))
+            size = struct.unpack('<i', head)[0]
+            body = f.read(size - 4)
+            if len(body) < size - 4:
+                raise ValueError("{0} ends in the middle of a document.".format(path))
+            yield BSON(head + body).decode()
+
+
+def _batches(document_class, items, batch):
+    clsname = document_class.__name__
+    chunk = []
+    for item in items:
+        classname = item.get('_data', {}).get('_classname', None)
+        if classname != clsname:
+            raise ValueError("Cannot import a {0} as a {1}: {2!r}".format(classname, clsname, item.get('_id', None)))
+        chunk.append(item)
+        if len(chunk) >= batch:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_(document_class, path, batch=1000, format=None, workers=None):
+    """
+    Inserts the documents exported to `path` into `document_class`'s collection, `batch` at a time.
+    Returns the number inserted.
+
+    :param workers: insert batches in this many threads at once. At most twice as many batches as
+        workers are read ahead, so memory use stays bounded.
+    """
+    collection = document_class._collection('import')
+    batches = _batches(document_class, read_file(path, format), batch)
+    if not workers:
+        return sum(bulk_write(collection, inserts=chunk) for chunk in batches)
+    pool = ThreadPool(workers)
+    slots = threading.BoundedSemaphore(workers * 2)
+    failed = []
+    def insert(chunk):
+        try:
+            return bulk_write(collection, inserts=chunk)
+        except Exception:
+            failed.append(True)
+            raise
+        finally:
+            slots.release()
+    results = []
+    try:
+        for chunk in batches:
+            slots.acquire()
+            # stop reading once a batch fails, get() below raises its error:
+            if failed:
+                slots.release()
+                break
+            results.append(pool.apply_async(insert, (chunk,)))
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    return sum(result.get() for result in results)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checks that URLs actually work, for `WebURLField(verify=True)`.
+
+URLs are checked with HEAD requests (falling back to GET for servers which don't allow HEAD), with a
+timeout, in a bounded pool of threads. Results are cached, working URLs for `ttl` seconds and broken
+ones for `negative_ttl` seconds, so saving the same Document again doesn't check again.
+
+`Document.is_valid` checks all of a Document's verified URL fields at once, so a Document with several
+of them waits for the slowest one rather than for all of them in a row.
+
+`WebURLField(verify='deferred')` keeps checking off the save path altogether: new URLs are checked in
+the background and the value is accepted, but a URL already known to be broken is rejected.
+
+Fields use `default_verifier` unless given their own. Use `configure` to change its settings.
+"""
+
+import httplib
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from urllib2 import HTTPError, Request, URLError, urlopen
+
+__all__ = [
+    'URLVerifier',
+    'configure',
+    'default_verifier',
+    'verify_fields',
+]
+
+
+class _Request(Request):
+    def __init__(self, url, method, *args, **kw):
+        Request.__init__(self, url, *args, **kw)
+        self.method = method
+
+    def get_method(self):
+        return self.method
+
+
+class URLVerifier(object):
+    """
+    :param timeout: seconds to wait for each server.
+    :param ttl: seconds to remember that a URL works.
+    :param negative_ttl: seconds to remember that a URL is broken.
+    :param max_workers: most URLs to check at the same time.
+    :param cache_size: most URLs to remember, expired ones are forgotten first.
+    """
+    def __init__(self, timeout=5, ttl=3600, negative_ttl=300, max_workers=8, cache_size=10000):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_workers = max_workers
+        self.cache_size = cache_size
+        self._cache = dict()  # url -> (ok, expires)
+        self._pending = dict()  # url -> AsyncResult, for deferred checks
+        self._lock = threading.Lock()
+        self._pool = None
+        self.requests = 0
+
+    def __repr__(self):
+        return "<URLVerifier with {0} URLs cached>".format(len(self._cache))
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_workers)
+            return self._pool
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+
+    def cached(self, url):
+        """`True` or `False` if the answer for `url` is cached, otherwise None."""
+        entry = self._cache.get(url, None)
+        if entry is None:
+            return None
+        ok, expires = entry
+        if expires < time.time():
+            return None
+        return ok
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _remember(self, url, ok):
+        now = time.time()
+        with self._lock:
+            if len(self._cache) >= self.cache_size:
+                for key in [key for key, (_, expires) in self._cache.iteritems() if expires < now]:
+                    del self._cache[key]
+                if len(self._cache) >= self.cache_size:
+                    self._cache.clear()
+            self._cache[url] = (ok, now + (self.ttl if ok else self.negative_ttl))
+        return ok
+
+    def _request(self, url, timeout, method='HEAD'):
+        with self._lock:
+            self.requests += 1
+        try:
+            urlopen(_Request(url, method), timeout=timeout).close()
+            return True
+        except HTTPError, err:
+            # Method Not Allowed or Not Implemented:
+            if method == 'HEAD' and err.code in (405, 501):
+                return self._request(url, timeout, 'GET')
+            return err.code < 400
+        except (URLError, httplib.HTTPException, socket.error, ValueError):
+            return False
+
+    def _check(self, url, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        return self._remember(url, self._request(url, timeout))
+
+    def check(self, url, timeout=None):
+        """`True` if `url` works."""
+        ok = self.cached(url)
+        if ok is None:
+            ok = self._check(url, timeout)
+        return ok
+
+    def check_many(self, urls, timeout=None):
+        """
+        Checks `urls` concurrently, returning a dict of url -> `True` if it works.
+        """
+        results = dict()
+        unknown = []
+        for url in urls:
+            ok = self.cached(url)
+            if ok is None:
+                if url not in unknown:
+                    unknown.append(url)
+            else:
+                results[url] = ok
+        if len(unknown) == 1:
+            results[unknown[0]] = self._check(unknown[0], timeout)
+        elif unknown:
+            oks = self._get_pool().map(lambda url: self._check(url, timeout), unknown)
+            results.update(zip(unknown, oks))
+        return results
+
+    def check_later(self, url, timeout=None, callback=None):
+        """
+        Checks `url` in the background, unless it's cached or already being checked. `callback` is
+        called as `callback(url, ok)` once the answer is known.
+        """
+        if self.cached(url) is not None:
+            return
+        with self._lock:
+            if url in self._pending:
+                return
+            self._pending[url] = None
+        def done(ok):
+            with self._lock:
+                self._pending.pop(url, None)
+            if callback is not None:
+                callback(url, ok)
+        result = self._get_pool().apply_async(self._check, (url, timeout), callback=done)
+        with self._lock:
+            # unless it's done already:
+            if url in self._pending:
+                self._pending[url] = result
+
+    def wait(self, timeout=None):
+        """Waits for the background checks started so far."""
+        with self._lock:
+            pending = list(self._pending.values())
+        for result in pending:
+            if result is not None:
+                result.wait(timeout)
+
+
+default_verifier = URLVerifier()
+
+
+def configure(**kw):
+    """Changes the settings of `default_verifier`, see `URLVerifier`."""
+    for key, value in kw.iteritems():
+        if not hasattr(default_verifier, key) or key.startswith('_'):
+            raise ValueError("URLVerifier has no setting {0}.".format(key))
+        setattr(default_verifier, key, value)
+    if 'max_workers' in kw:
+        default_verifier.close()
+
+
+def verify_fields(fields_values):
+    """
+    Checks the values of several `WebURLField(verify=True)` fields concurrently, given a list of
+    (field, value), so that validating each field afterwards finds its answer cached.
+    """
+    groups = dict()
+    for field, value in fields_values:
+        if value and isinstance(value, basestring) and field.is_well_formed(value):
+            groups.setdefault((field.get_verifier(), field.verify_timeout), []).append(value)
+    for (verifier, timeout), urls in groups.iteritems():
+        verifier.check_many(urls, timeout)
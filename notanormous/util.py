@@ -2,7 +2,7 @@
 
 import time
 
-__all__ = ['make_embeddable', 'clean_output', 'cached_property']
+__all__ = ['make_embeddable', 'clean_output', 'cached_property', 'bulk_write']
 
 
 ___debone_toplevel___ = ('_id', 'metadata')
@@ -160,3 +160,56 @@ def clean_output(data, *fields):
             data[k] = new_list
 
 
+def _spec(_id):
+    if isinstance(_id, dict):
+        return _id
+    return {'_id': _id}
+
+
+def _written(result, sent):
+    """Documents inserted plus documents matched by the replacements, from a bulk write's result."""
+    if not getattr(result, 'acknowledged', True):
+        return sent
+    if isinstance(result, dict):
+        # pymongo 2:
+        inserted, matched = result.get('nInserted', None), result.get('nMatched', None)
+    else:
+        inserted, matched = getattr(result, 'inserted_count', None), getattr(result, 'matched_count', None)
+    if inserted is None or matched is None:
+        return sent
+    return inserted + matched
+
+
+def bulk_write(collection, inserts=(), replacements=(), ordered=False):
+    """
+    Inserts documents, and replaces documents by `_id`, in as few round trips as pymongo allows, using
+    whichever bulk API the installed pymongo has.
+    
+    :param inserts: list of dicts to insert.
+    :param replacements: list of (_id, dict) to replace. The `_id` may be a query instead, to replace
+        the document only if it still matches.
+    
+    Returns the number of documents inserted or replaced, which leaves out replacements whose query
+    matched nothing. If the server doesn't say (unacknowledged writes), the number of operations sent.
+    """
+    count = len(inserts) + len(replacements)
+    if not count:
+        return 0
+    try:
+        from pymongo import InsertOne, ReplaceOne
+    except ImportError:
+        # pymongo 2
+        InsertOne = ReplaceOne = None
+    if InsertOne is not None and hasattr(collection, 'bulk_write'):
+        ops = [InsertOne(doc) for doc in inserts]
+        ops.extend(ReplaceOne(_spec(_id), doc) for _id, doc in replacements)
+        return _written(collection.bulk_write(ops, ordered=ordered), count)
+    if ordered:
+        bulk = collection.initialize_ordered_bulk_op()
+    else:
+        bulk = collection.initialize_unordered_bulk_op()
+    for doc in inserts:
+        bulk.insert(doc)
+    for _id, doc in replacements:
+        bulk.find(_spec(_id)).replace_one(doc)
+    return _written(bulk.execute(), count)
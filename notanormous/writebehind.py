@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+"""
+Write-behind for fire-and-forget saves, e.g. for telemetry-style Document classes.
+
+Set `__write_behind__ = True` on a Document class (or a dict of `WriteBehindQueue` options) and
+`save(safe=False)` no longer talks to MongoDB at all: the Document is validated and serialized, given an
+`_id` from a counter kept in this process, and the write is queued. A background thread drains the
+queue into bulk writes whenever `batch_size` writes are waiting or `flush_interval` seconds have passed.
+Several saves of the same Document in one batch are merged into a single write.
+
+`save()` with `safe=True` (the default), `delete()` and `Document.flush_writes()` first wait for the
+queued writes of that class, so they see everything saved before them. Queues are flushed when the
+process exits.
+
+The `_id` counter starts from the highest `_id` in the collection when the queue is created, and once
+a class has a queue, `save(safe=True)` takes new `_id`s from it too. So only one process should insert
+write-behind Documents of a class. A clash shows up as a `DuplicateKeyError`
+passed to `on_error`.
+"""
+
+import atexit
+from collections import OrderedDict
+import logging
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import threading
+import time
+
+import pymongo
+from pymongo.errors import BulkWriteError
+
+from notanormous.util import bulk_write
+
+__all__ = [
+    'WriteBehindFull',
+    'WriteBehindQueue',
+    'flush_all',
+    'write_behind_queue',
+]
+
+
+INSERT = 'insert'
+REPLACE = 'replace'
+
+_STOP = object()
+
+log = logging.getLogger('notanormous.writebehind')
+
+_queues = dict()  # classname -> WriteBehindQueue
+_queues_lock = threading.Lock()
+
+
+class WriteBehindFull(Exception):
+    pass
+
+
+class _Flush(object):
+    def __init__(self):
+        self.event = threading.Event()
+
+
+def log_error(exc, outputs):
+    log.error("Write-behind could not write %d documents: %r", len(outputs), exc)
+
+
+class WriteBehindQueue(object):
+    """
+    Queues the writes of one Document class and writes them in bulk from a background thread.
+
+    :param batch_size: write as soon as this many writes are waiting.
+    :param flush_interval: seconds a write may wait for a batch to fill up.
+    :param max_queue: most writes to hold before `save` applies backpressure. 0 means no limit.
+    :param block: when the queue is full, `save` waits for room (up to `timeout` seconds). If `False`,
+        or the timeout passes, it raises `WriteBehindFull` instead.
+    :param on_error: called in the background thread as `on_error(exception, outputs)` when a bulk
+        write fails, `outputs` being the dicts which were to be written. By default it logs an error to
+        the 'notanormous.writebehind' logger.
+    """
+    def __init__(self, document_class, batch_size=500, flush_interval=1.0, max_queue=10000, block=True,
+                 timeout=None, on_error=None):
+        self.document_class = document_class
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.timeout = timeout
+        self.on_error = on_error or log_error
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_id = None
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    def __repr__(self):
+        return "<WriteBehindQueue of {0}, {1} waiting>".format(self.document_class.__name__, self.depth)
+
+    @property
+    def depth(self):
+        """Number of writes waiting (approximately)."""
+        return self._queue.qsize()
+
+    def stats(self):
+        """
+        Counters for monitoring: `depth` (writes waiting), `max_depth`, `enqueued`, `written` (sent to
+        MongoDB, after merging), `batches`, `errors` (writes lost to failed batches) and `rejected`
+        (saves refused with `WriteBehindFull`).
+        """
+        return dict(depth=self.depth, max_depth=self.max_depth, enqueued=self.enqueued,
+                    written=self.written, batches=self.batches, errors=self.errors, rejected=self.rejected)
+
+    def next_id(self):
+        with self._lock:
+            if self._last_id is None:
+                last = list(self.document_class._collection().find(fields=['_id'])
+                            .sort('_id', pymongo.DESCENDING).limit(1))
+                self._last_id = last[0]['_id'] if last else 0
+            self._last_id += 1
+            return self._last_id
+
+    def put(self, kind, output):
+        """
+        Queues a write. `kind` is 'insert' or 'replace', `output` is the dict to write, with an `_id`.
+        """
+        self._start()
+        try:
+            self._queue.put((kind, output), self.block, self.timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise WriteBehindFull("{0} writes waiting for {1} already.".format(
+                self.depth, self.document_class.__name__))
+        with self._lock:
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, self.depth)
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything queued so far is written. Returns `False` if `timeout` passed first.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return self._queue.empty()
+        marker = _Flush()
+        self._queue.put(marker)
+        return marker.event.wait(timeout) is not False
+
+    def close(self, timeout=None):
+        """Writes whatever is queued and stops the background thread."""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='notanormous-write-behind-{0}'.format(
+                self.document_class.__name__))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = []
+            markers = []
+            stop = False
+            item = self._queue.get()
+            deadline = time.time() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stop = True
+                    break
+                if isinstance(item, _Flush):
+                    markers.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(True, remaining)
+                except queue.Empty:
+                    break
+            self._write(batch)
+            for marker in markers:
+                marker.event.set()
+            if stop:
+                return
+
+    def _write(self, batch):
+        if not batch:
+            return
+        # the last save of each Document wins, and a Document inserted in this batch stays an insert:
+        merged = OrderedDict()
+        for kind, output in batch:
+            previous = merged.get(output['_id'], None)
+            if previous is not None and previous[0] == INSERT:
+                kind = INSERT
+            merged[output['_id']] = (kind, output)
+        inserts = [out for k, out in merged.itervalues() if k == INSERT]
+        replacements = [(_id, out) for _id, (k, out) in merged.iteritems() if k == REPLACE]
+        outputs = inserts + [out for _id, out in replacements]
+        written = len(outputs)
+        try:
+            bulk_write(self.document_class._collection('write_behind'), inserts, replacements)
+            failed = []
+        except BulkWriteError, msg:
+            # the batch is unordered, so only the writes named in the error failed:
+            error = msg
+            failed = [outputs[e['index']] for e in msg.details.get('writeErrors', [])] or outputs
+        except Exception, msg:
+            error = msg
+            failed = outputs
+        with self._lock:
+            self.written += written - len(failed)
+            self.errors += len(failed)
+            self.batches += 1
+        if failed:
+            try:
+                self.on_error(error, failed)
+            except Exception, msg:
+                log_error(msg, failed)
+
+
+def write_behind_queue(document_class, create=True):
+    """
+    The queue for `document_class`, made from its `__write_behind__` options the first time. Returns
+    None if it has no queue yet and `create` is `False`.
+    """
+    name = document_class.__name__
+    q = _queues.get(name, None)
+    if q is not None or not create:
+        return q
+    with _queues_lock:
+        if name not in _queues:
+            options = document_class.__write_behind__
+            if not isinstance(options, dict):
+                options = dict()
+            _queues[name] = WriteBehindQueue(document_class, **options)
+        return _queues[name]
+
+
+def flush_all(timeout=None):
+    """Waits until every queued write of every class is written."""
+    return all([q.flush(timeout) for q in list(_queues.values())])
+
+
+@atexit.register
+def _close_all():
+    for q in list(_queues.values()):
+        q.close()
@@ -13,12 +13,16 @@ setup(name='Notanormous',
       author_email='ic@isaaccsandl.com',
       url='',
       license='GPL v3.0',
-      packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+      packages=find_packages(exclude=['ez_setup', 'examples', 'tests', 'benchmarks']),
       include_package_data=True,
       zip_safe=False,
       install_requires=[
         'pymongo>=2.7.2',
       ],
+      extras_require={
+        'async': ['futures; python_version < "3"'],
+        'numpy': ['numpy'],
+      },
       entry_points="""
       # -*- Entry points: -*-
       """,
@@ -1,20 +1,51 @@
 # -*- coding: utf-8 -*-
 
+import BaseHTTPServer
+import copy
 import datetime
+import logging
+import operator
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
 from pprint import pprint, pformat
-from unittest import TestCase
+from StringIO import StringIO
+from unittest import SkipTest, TestCase
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from bson.errors import InvalidDocument
+from bson.objectid import ObjectId
+from pymongo import GEOSPHERE
 from pymongo.database import DBRef
 from notanormous.document import Document, DOCUMENTS, _make_document as make_document, \
                                  _make_documents as make_documents, \
                                  sort_dicts_by_id_list
 from notanormous.fields import *
-from notanormous.util import cached_property
+from notanormous import connection as nconnection, footprint, instrument, migration, nplusone, profiling, \
+    slowquery, transfer
+from notanormous.identity import identity_map, OPEN_DOCUMENTS
+from notanormous.inmemory import InMemoryClient
+from notanormous.parallel import id_ranges
+from notanormous.schema import json_schema
+from notanormous.urlcheck import URLVerifier
+from notanormous.util import bulk_write, cached_property
+from notanormous.writebehind import log_error, write_behind_queue
 
 from pymongo.connection import Connection
-from pymongo.errors import ConnectionFailure
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError
 
-connection = Connection('localhost')
+# NOTANORMOUS_TEST_BACKEND=memory runs the tests without a mongod:
+IN_MEMORY = os.environ.get('NOTANORMOUS_TEST_BACKEND') == 'memory'
+if IN_MEMORY:
+    connection = InMemoryClient()
+else:
+    connection = Connection('localhost')
 db = connection['notanormous_tests']
 Document._db = db
 
@@ -70,9 +101,92 @@ class Something(Document):
         self.times_added_coords = self.times_added_coords + 1
         return t
 
+class Author(Document):
+    name               = StringField()
+    __serial_index__   = True
+
+class Book(Document):
+    title              = StringField()
+    author_id          = ObjectIdField('Author', index=True)
+    editor_ids         = ListField(ObjectIdField('Author', related_name='edited_books'))
+    __serial_index__   = True
+
+class Shop(Document):
+    name               = StringField()
+    location           = LocationField(index=True)
+    __serial_index__   = True
+
+class Article(Document):
+    title              = StringField(searchable=True, search_weight=10)
+    body               = StringField(searchable=True)
+    things             = EmbeddedDocumentField(EmbedMe)
+    __serial_index__   = True
+
+class Reading(Document):
+    sensor             = StringField()
+    value              = FloatField()
+    __serial_index__   = True
+    __write_behind__   = dict(batch_size=3, flush_interval=0.05)
+
+class Report(Document):
+    title              = StringField()
+    author_id          = ObjectIdField('Author')
+    __serial_index__   = True
+    __read_preference__ = 'secondaryPreferred'
+
+class Shift(Document):
+    starts             = TimeField()
+    tags               = ListField(StringField())
+    ref                = ObjectIdField()
+    __serial_index__   = True
+
+class Member(Document):
+    full_name          = StringField()
+    __serial_index__   = True
+    __version__        = 3
+
+@migration.migrates(Member, 1)
+def member_full_name(data):
+    data['full_name'] = data.pop('name', None)
+
+@migration.migrates(Member, 2)
+def member_strip(data):
+    return dict(data, full_name=data['full_name'].strip())
+
+URL_VERIFIER = URLVerifier(timeout=2)
+BROKEN_URLS = []
+
+class Link(Document):
+    home               = WebURLField(verify=True, verifier=URL_VERIFIER)
+    docs               = WebURLField(verify=True, verifier=URL_VERIFIER)
+    feed               = WebURLField(verify='deferred', verifier=URL_VERIFIER, on_invalid=BROKEN_URLS.append)
+    __serial_index__   = True
+
+class URLHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    hits = []
+    def respond(self):
+        self.hits.append((self.command, self.path))
+        if self.path == '/missing':
+            self.send_response(404)
+        elif self.path == '/nohead' and self.command == 'HEAD':
+            self.send_response(405)
+        else:
+            self.send_response(200)
+        self.end_headers()
+    do_HEAD = do_GET = respond
+    def log_message(self, *args):
+        pass
+
+def coord_sum(coord):
+    return coord.x + coord.y
+
+def double_x(coord):
+    coord.x *= 2
+
 
 def droptestdb():
     connection.drop_database('notanormous_tests')
+    connection.drop_database('notanormous_tests_other')
 
 class TestDocuments(TestCase):
     def test_documents(self):
@@ -279,3 +393,723 @@ class TestDocuments(TestCase):
         assert s.xdates[1] == some_other_date
         droptestdb()
     
+    
+    def test_reverse_references(self):
+        droptestdb()
+        assert 'author_id' in Book._index_specs()
+        assert 'editor_ids' not in Book._index_specs()
+        author = Author(name=u'Tim').save()
+        editor = Author(name=u'Brian').save()
+        b1 = Book(title=u'Holy Grail', author_id=author._id, editor_ids=[editor._id]).save()
+        b2 = Book(title=u'Life of Brian', author_id=author._id).save()
+        Book(title=u'Meaning of Life', author_id=editor._id).save()
+        assert 'author_id_1' in Book._collection().index_information()
+        books = list(author.book_set)
+        assert len(books) == 2
+        # already open, so we get the very same instances back:
+        assert b1 in books and b2 in books
+        assert [b._id for b in editor.edited_books] == [b1._id]
+        unsaved = Author(name=u'Unsaved').book_set
+        assert unsaved.count() == 0 and list(unsaved.sort('title', 1)) == []
+        droptestdb()
+    
+    def test_location_field(self):
+        if IN_MEMORY:
+            raise SkipTest("geospatial queries need a mongod")
+        droptestdb()
+        field = Shop._fields['location']
+        assert field.to_mongodb({'lat': 51.5, 'lon': -0.12}) == {'type': 'Point', 'coordinates': [-0.12, 51.5]}
+        assert field.to_mongodb((2.35, 48.85)) == {'type': 'Point', 'coordinates': [2.35, 48.85]}
+        assert field.is_valid({'type': 'Point', 'coordinates': [200, 0]}) is False
+        assert field.is_valid({'lat': 'north'}) is False
+        assert Shop(name=u'x', location=(0, 0)).is_valid() is True
+        assert ('location', GEOSPHERE) in Shop._index_specs()
+        london = Shop(name=u'London', location={'lat': 51.5074, 'lon': -0.1278}).save()
+        paris = Shop(name=u'Paris', location=(2.3522, 48.8566)).save()
+        Shop(name=u'Sydney', location=(151.2093, -33.8688)).save()
+        near_paris = list(Shop.near((2.35, 48.85), max_distance=500000))
+        assert near_paris == [paris, london]
+        channel = {'type': 'Polygon', 'coordinates': [[[-1, 50], [3, 50], [3, 52], [-1, 52], [-1, 50]]]}
+        assert [s.name for s in Shop.within(channel)] == [u'London']
+        droptestdb()
+    
+    def test_text_search(self):
+        if IN_MEMORY:
+            raise SkipTest("text search needs a mongod")
+        droptestdb()
+        assert Article._text_weights() == {'title': 10, 'body': 1}
+        Article(title=u'Spam', body=u'Lovely spam, wonderful spam.').save()
+        Article(title=u'Eggs', body=u'Eggs, bacon and spam.').save()
+        Article(title=u'Shrubbery', body=u'One that looks nice, and not too expensive.').save()
+        results = Article.search(u'spam')
+        assert [a.title for a in results] == [u'Spam', u'Eggs']
+        assert results[0].search_score > results[1].search_score
+        assert 'search_score' not in results[0].to_mongodb()['_data']
+        assert len(Article.search(u'spam', limit=1)) == 1
+        droptestdb()
+    
+    def test_json_schema(self):
+        schema = json_schema(Something)
+        props = schema['properties']
+        assert schema['required'] == ['_data']
+        assert props['name']['bsonType'] == ['string', 'null']
+        assert props['choicy']['enum'] == [u'a', u'b', u'', None]
+        assert props['created']['bsonType'] == ['date', 'null']
+        assert props['things']['properties']['thing2']['maxLength'] == 16
+        assert props['things']['required'] == ['_data', 'thing1']
+        assert props['coords']['items']['properties']['x']['bsonType'] == ['int', 'long', 'null']
+        assert props['words']['items']['bsonType'] == ['string', 'null']
+        assert props['_data']['properties']['_classname'] == {'enum': ['Something']}
+        assert json_schema(SomeDoc)['required'] == ['_data', 'title']
+    
+    def test_validation_errors(self):
+        x = Something(name=u'x', choicy=u'c', things=EmbedMe(thing1=u'a', thing2=u'x' * 20),
+                      manythings=[EmbedMe(thing1=u'b', thing2=u'y' * 20)])
+        paths = [path for path, message in x.validation_errors()]
+        # everything is reported, including fields after the embedded document:
+        assert paths == ['choicy', 'manythings.0.thing2', 'things.thing2']
+        try:
+            x.is_valid()
+            assert 0/0
+        except ValidationError, err:
+            assert len(err.errors) == 3
+        ok = Something(name=u'ok', choicy=u'a').to_mongodb()
+        bad = dict(ok, choicy=u'z', things={'thing1': u'a', 'thing2': u'x' * 20, '_data': {}})
+        failures = Something.validate_many([ok, bad, Something(name=u'fine')])
+        assert failures == [(1, [('choicy', u"u'z' is not one of the choices."),
+                                 (u'things.thing2', u'longer than 16 characters.')])]
+        # raw values of the wrong type are reported, not raised:
+        failures = Shift.validate_many([{'_id': 1, 'tags': None}, {'_id': 2, 'starts': '12:00', 'tags': []}])
+        assert [(i, [path for path, message in errors]) for i, errors in failures] == [(0, ['tags']), (1, ['starts'])]
+    
+    def test_async(self):
+        droptestdb()
+        futures = [Coord(x=i, y=i).asave() for i in range(3)]
+        coords = [f.result() for f in futures]
+        assert sorted(c._id for c in coords) == [1, 2, 3]
+        assert Coord.aget_by_id(coords[0]._id).result() is coords[0]
+        cursor = Coord.afind({'x': {'$gte': 1}}, sort=[('x', 1)])
+        assert [c.x for c in cursor.to_list().result()] == [1, 2]
+        coords[0].adelete().result()
+        assert Coord.find().count() == 2
+        author = Author(name=u'a').save()
+        report = Report(title=u'r', author_id=author._id).save()
+        assert report.aref('author').result() is author
+        assert author.aref('report_set').result() == [report]
+        try:
+            report.aref('title')
+            assert 0/0
+        except ValueError:
+            pass
+        # a clash on another unique index isn't retried with the next _id:
+        collection = Shift._collection()
+        collection.create_index('ref', unique=True)
+        ref = ObjectId()
+        Shift(ref=ref).save()
+        inserts = []
+        insert = collection.__class__.insert
+        collection.__class__.insert = lambda self, *args, **kw: inserts.append(1) or insert(self, *args, **kw)
+        try:
+            Shift(ref=ref).asave().result()
+            assert 0/0
+        except DuplicateKeyError:
+            pass
+        finally:
+            collection.__class__.insert = insert
+        assert len(inserts) == 1
+        droptestdb()
+    
+    def test_identity_maps(self):
+        droptestdb()
+        c = Coord(x=1, y=2).save()
+        assert Coord.get_by_id(c._id) is c
+        with identity_map() as imap:
+            mine = Coord.get_by_id(c._id)
+            assert mine is not c
+            assert Coord.get_by_id(c._id) is mine
+            assert imap.get('Coord', c._id) is mine
+            # a new scope can fall back to a shared parent:
+            with identity_map(parent=imap):
+                assert Coord.get_by_id(c._id) is mine
+                other = Coord(x=5, y=5).save()
+            assert imap.get('Coord', other._id) is None
+            # and work handed to other threads uses the caller's map:
+            assert Coord.aget_by_id(c._id).result() is mine
+        assert OPEN_DOCUMENTS['Coord'][c._id] is c
+        droptestdb()
+    
+    def test_parallel_scan(self):
+        droptestdb()
+        assert id_ranges(1, 25, 10) == [(1, 11), (11, 21), (21, 26)]
+        for i in range(25):
+            Coord(x=i, y=1).save()
+        progress = []
+        total = Coord.parallel_scan(coord_sum, workers=2, chunk=10, reducer=operator.add,
+                                    progress=lambda done, total: progress.append((done, total)))
+        assert total == sum(range(25)) + 25
+        assert progress[-1] == (3, 3)
+        assert Coord.parallel_scan(coord_sum, workers=2, chunk=7, query={'x': {'$lt': 3}}) == [1, 2, 3]
+        tmp = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(tmp, 'coords')
+            assert Coord.parallel_scan(coord_sum, workers=2, chunk=10, reducer=operator.add,
+                                       checkpoint=checkpoint) == total
+            # a record cut short by a crash is scanned again:
+            with open(checkpoint, 'r+b') as f:
+                f.seek(-3, os.SEEK_END)
+                f.truncate()
+            # only the last range, which grew, is scanned again:
+            Coord(x=100, y=1).save()
+            progress = []
+            assert Coord.parallel_scan(coord_sum, workers=2, chunk=10, reducer=operator.add, checkpoint=checkpoint,
+                                       progress=lambda done, total: progress.append((done, total))) == total + 101
+            assert progress == [(2, 3), (3, 3)]
+            try:
+                Coord.parallel_scan(coord_sum, workers=2, chunk=5, checkpoint=checkpoint)
+                assert 0/0
+            except ValueError:
+                pass
+        finally:
+            shutil.rmtree(tmp)
+        Coord._collection().remove({'x': 100})
+        Coord.parallel_scan(double_x, workers=2, chunk=10, write_back=True)
+        assert sorted(c['x'] for c in Coord.find()) == [i * 2 for i in range(25)]
+        droptestdb()
+    
+    def test_pickling(self):
+        droptestdb()
+        x = Something(name=u'Sir Robin', words=[u'run', u'away'], things=EmbedMe(thing1=u'a'),
+                      manythings=[EmbedMe(thing1=u'b')])
+        x['bravery'] = 0
+        x.save()
+        data = pickle.dumps(x, pickle.HIGHEST_PROTOCOL)
+        assert 'EmbeddedDocumentField' not in data
+        y = pickle.loads(data)
+        assert y is not x
+        assert y.__class__ is Something
+        assert (y._id, y.name, y.words, y['bravery']) == (x._id, x.name, x.words, 0)
+        assert y.things.thing1 == u'a' and y.things._container is y
+        assert y.manythings[0].thing1 == u'b'
+        assert y.created == x.created.replace(microsecond=x.created.microsecond // 1000 * 1000)
+        assert y._dirty == x._dirty
+        # copies don't go through BSON, so keep microseconds and values BSON can't hold:
+        x['spares'] = set([u'lance'])
+        x['note'] = None
+        x['when'] = datetime.date(2020, 1, 2)
+        for z in (copy.copy(x), copy.deepcopy(x)):
+            assert z is not x and z.__class__ is Something
+            assert (z._id, z.created, z['spares']) == (x._id, x.created, set([u'lance']))
+            assert z._data == x._data and z._data is not x._data
+            assert z._data['when'] == datetime.date(2020, 1, 2) and 'note' in z._data
+            assert z.manythings[0] is not x.manythings[0] and z.manythings[0].thing1 == u'b'
+        w = copy.deepcopy(y)
+        assert w.things._container is w and w.manythings[0]._container is w
+        try:
+            pickle.dumps(x, pickle.HIGHEST_PROTOCOL)
+            assert 0/0
+        except InvalidDocument:
+            pass
+        droptestdb()
+    
+    def test_write_behind(self):
+        droptestdb()
+        first = Reading(sensor=u'a', value=0.0).save()
+        readings = [Reading(sensor=u'a', value=float(i)).save(safe=False) for i in range(10)]
+        assert [r._id for r in readings] == range(first._id + 1, first._id + 11)
+        readings[0].value = 99.0
+        readings[0].save(safe=False)
+        assert Reading.flush_writes(5)
+        assert Reading.find().count() == 11
+        assert Reading._collection().find_one({'_id': readings[0]._id})['value'] == 99.0
+        writer = write_behind_queue(Reading)
+        stats = writer.stats()
+        assert stats['enqueued'] == 11 and stats['depth'] == 0 and stats['errors'] == 0
+        assert stats['written'] <= 11
+        # a safe save waits for the queue, and keeps the _id counter ahead of it:
+        x = Reading(sensor=u'b', value=1.0).save(safe=False)
+        y = Reading(sensor=u'b', value=2.0).save()
+        assert y._id == x._id + 1
+        assert Reading(sensor=u'b').save(safe=False)._id == y._id + 1
+        # even an _id taken by another thread after the safe save's flush:
+        taken = writer.next_id()
+        assert Reading(sensor=u'b').save()._id == taken + 1
+        # failed writes go to on_error:
+        assert Reading.flush_writes(5)
+        failed = []
+        writer.on_error = lambda exc, outputs: failed.append(outputs)
+        writer._last_id = first._id - 1
+        Reading(sensor=u'c').save(safe=False)
+        assert Reading.flush_writes(5)
+        assert len(failed) == 1 and writer.stats()['errors'] == 1
+        # by default they are logged:
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logging.getLogger('notanormous.writebehind').addHandler(handler)
+        try:
+            writer.on_error = log_error
+            writer._last_id = first._id - 1
+            Reading(sensor=u'd').save(safe=False)
+            assert Reading.flush_writes(5)
+        finally:
+            logging.getLogger('notanormous.writebehind').removeHandler(handler)
+        assert [record.levelname for record in records] == ['ERROR']
+        writer.close()
+        droptestdb()
+    
+    def test_read_routing(self):
+        droptestdb()
+        other = connection['notanormous_tests_other']
+        nconnection.bind(Report, other)
+        routes = []
+        listener = lambda cls, operation, mode: routes.append((cls.__name__, operation, mode))
+        nconnection.add_routing_listener(listener)
+        try:
+            author = Author(name=u'Spam').save()
+            report = Report(title=u'sales', author_id=author._id).save()
+            assert other.report.find().count() == 1 and db.report.find().count() == 0
+            with identity_map():
+                assert Report.get_by_id(report._id).title == u'sales'
+                assert Author.find(read_preference='nearest').count() == 1
+            with identity_map(), nconnection.read_preference('secondary'):
+                assert Report.get_by_id(report._id).author.name == u'Spam'
+                assert len(list(Report.find(read_preference='primary'))) == 1
+            assert routes == [('Report', 'get_by_id', 'secondaryPreferred'),
+                              ('Author', 'find', 'nearest'),
+                              ('Report', 'get_by_id', 'secondary'),
+                              ('Author', 'reference', 'secondary'),
+                              ('Report', 'find', 'primary')]
+            try:
+                Report.find(read_preference='secondaries')
+                assert 0/0
+            except ValueError:
+                pass
+        finally:
+            nconnection.remove_routing_listener(listener)
+            nconnection.unbind(Report)
+        # unbinding restores the read preference too, and takes class names like bind:
+        nconnection.bind('Report', other, read_preference='nearest')
+        nconnection.bind(Author, read_preference='secondary')
+        nconnection.unbind('Report')
+        nconnection.unbind(Author)
+        assert Report.__read_preference__ == 'secondaryPreferred' and '_db' not in Report.__dict__
+        assert Author.__read_preference__ is None and '__read_preference__' not in Author.__dict__
+        droptestdb()
+    
+    def test_url_verification(self):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), URLHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            base = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+            link = Link(home=base + '/ok', docs=base + '/nohead', feed=base + '/missing')
+            # the deferred check doesn't hold up validation:
+            assert link.is_valid()
+            URL_VERIFIER.wait(5)
+            assert sorted(URLHandler.hits) == [('GET', '/nohead'), ('HEAD', '/missing'), ('HEAD', '/nohead'),
+                                               ('HEAD', '/ok')]
+            assert BROKEN_URLS == [base + '/missing']
+            # now it's known to be broken:
+            assert [path for path, message in link.validation_errors()] == ['feed']
+            link.feed = u''
+            link.docs = base + '/missing'
+            requests = URL_VERIFIER.requests
+            assert [path for path, message in link.validation_errors()] == ['docs']
+            # everything came from the cache:
+            assert URL_VERIFIER.requests == requests
+            link.docs = 'ftp://127.0.0.1/ok'
+            assert [path for path, message in link.validation_errors()] == ['docs']
+        finally:
+            server.shutdown()
+            server.server_close()
+            URL_VERIFIER.close()
+    
+    def test_to_columns(self):
+        if numpy is None:
+            raise SkipTest("needs numpy")
+        droptestdb()
+        for i in range(5):
+            Coord(x=i, y=i * 2).save()
+        cols = Coord.find({'x': {'$gte': 1}}, fields=['x', 'y'], sort=[('x', 1)]).to_columns(['_id', 'x', 'y'])
+        assert list(cols) == ['_id', 'x', 'y']
+        assert cols['x'].dtype == numpy.int64 and list(cols['x']) == [1, 2, 3, 4]
+        assert (cols['y'] == cols['x'] * 2).all()
+        x = Something(name=u'x', things=EmbedMe(thing1=u'a')).save()
+        Something(name=u'y').save()
+        cols = Something.find(sort=[('name', 1)]).to_columns(['created', 'things.thing1', 'choicy'])
+        assert cols['created'].dtype == numpy.dtype('datetime64[ms]')
+        assert cols['created'][0] == numpy.datetime64(x.created.replace(microsecond=x.created.microsecond // 1000 * 1000))
+        assert list(cols['things.thing1']) == [u'a', None]
+        # an int column can't have gaps:
+        Coord(x=9).save()
+        try:
+            Coord.find().to_columns(['y'])
+            assert 0/0
+        except ValueError:
+            pass
+        assert numpy.isnan(Coord.find().to_columns(['y'], dtypes={'y': 'float64'})['y'][-1])
+        # references to anything but serial ids are ObjectIds:
+        ref = ObjectId()
+        Shift(ref=ref).save()
+        cols = Shift.find().to_columns(['_id', 'ref'])
+        assert cols['_id'].dtype == numpy.int64 and cols['ref'].dtype == object and list(cols['ref']) == [ref]
+        assert Report.find().to_columns(['author_id'])['author_id'].dtype == numpy.int64
+        droptestdb()
+    
+    def test_export_import(self):
+        droptestdb()
+        for i in range(25):
+            SomeDoc(title=u'doc {0}'.format(i), xdates=[datetime.date(2020, 1, i + 1)]).save()
+        before = sorted(SomeDoc._collection().find(), key=lambda d: d['_id'])
+        tmp = tempfile.mkdtemp()
+        try:
+            for name, format, compress, workers in [('all.bson.gz', 'bson', True, None),
+                                                     ('all.jsonl', 'jsonl', False, 3),
+                                                     # the format is told from the contents, not the name:
+                                                     ('all.dump', 'jsonl', True, None)]:
+                path = os.path.join(tmp, name)
+                assert SomeDoc.export(path, format=format, compress=compress) == 25
+                SomeDoc._collection().remove()
+                assert SomeDoc.import_(path, batch=4, workers=workers) == 25
+                after = sorted(SomeDoc._collection().find(), key=lambda d: d['_id'])
+                assert after == before
+                assert after[0]['_data']['_classname'] == 'SomeDoc' and after[0]['stuff']
+            # a BSON document 123 bytes long starts with '{' too:
+            assert transfer._sniff_format('{\x00\x00\x00\x02') == 'bson'
+            path = os.path.join(tmp, 'some.bson')
+            assert SomeDoc.export(path, query={'_id': {'$lte': 5}}, compress=False) == 5
+            # the file is for SomeDocs only:
+            try:
+                Coord.import_(path)
+                assert 0/0
+            except ValueError:
+                pass
+        finally:
+            shutil.rmtree(tmp)
+        droptestdb()
+    
+    def test_refresh_many(self):
+        droptestdb()
+        a, b, c = [Something(name=name).save() for name in (u'a', u'b', u'c')]
+        coord = Coord(x=1, y=1).save()
+        coll = Something._collection()
+        coll.update({'_id': a._id}, {'$set': {'name': u'A'}})
+        Coord._collection().update({'_id': coord._id}, {'$set': {'x': 5}})
+        coll.remove({'_id': b._id})
+        assert Something.refresh_many([a, b, c, coord]) == [b]
+        assert (a.name, c.name, coord.x) == (u'A', u'c', 5)
+        assert Something.get_by_id(a._id) is a
+        assert OPEN_DOCUMENTS['Something'].get(b._id) is None
+        # a change without a new modification time is skipped:
+        coll.update({'_id': c._id}, {'$set': {'name': u'C'}})
+        assert Something.refresh_many([a, c], skip_unchanged=True) == []
+        assert c.name == u'c'
+        coll.update({'_id': c._id}, {'$set': {'name': u'C', 'mod': datetime.datetime.now()}})
+        Something.refresh_many([a, c], skip_unchanged=True)
+        assert c.name == u'C'
+        # saving keeps the modification time it stored, so nothing is reloaded:
+        c.save()
+        time.sleep(0.05)
+        c.save()
+        finds = []
+        find = coll.__class__.find
+        coll.__class__.find = lambda self, *args, **kw: finds.append(1) or find(self, *args, **kw)
+        try:
+            assert Something.refresh_many([c], skip_unchanged=True) == []
+        finally:
+            coll.__class__.find = find
+        assert len(finds) == 1
+        droptestdb()
+    
+    def test_inmemory_backend(self):
+        coll = InMemoryClient()['notanormous_tests']['things']
+        coll.insert([{'_id': 1, 'n': 1, 'tags': [u'a', u'b'], 'sub': {'x': 1}},
+                     {'_id': 2, 'n': 5, 'tags': [u'b'], 'sub': {'x': 2}},
+                     {'_id': 3, 'n': 3, 'items': [{'k': 1}, {'k': 2}]}])
+        ids = lambda spec: sorted(d['_id'] for d in coll.find(spec))
+        assert ids({'n': {'$gte': 3}}) == [2, 3]
+        assert ids({'tags': u'b'}) == [1, 2]
+        assert ids({'tags': {'$all': [u'a', u'b']}}) == [1]
+        assert ids({'sub.x': {'$in': [2, 7]}}) == [2]
+        assert ids({'items.k': 2}) == [3]
+        assert ids({'tags': {'$exists': False}}) == [3]
+        assert ids({'$or': [{'n': 1}, {'n': {'$gt': 4}}], 'n': {'$ne': 5}}) == [1]
+        assert [d['_id'] for d in coll.find().sort('n', -1).skip(1).limit(1)] == [3]
+        assert coll.find({'n': {'$lt': 4}}).count() == 2
+        assert coll.find_one(2, fields=['n']) == {'_id': 2, 'n': 5}
+        coll.update({'_id': 1}, {'$inc': {'n': 2}, '$push': {'tags': u'c'}, '$set': {'sub.y': 3}})
+        assert coll.find_one(1) == {'_id': 1, 'n': 3, 'tags': [u'a', u'b', u'c'], 'sub': {'x': 1, 'y': 3}}
+        # stored documents are copies:
+        coll.find_one(1)['n'] = 100
+        assert coll.find_one(1)['n'] == 3
+        coll.update({'n': 3}, {'$set': {'three': True}}, multi=True)
+        assert ids({'three': True}) == [1, 3]
+        coll.create_index('name', unique=True, sparse=True)
+        coll.insert({'_id': 4, 'name': u'x'})
+        try:
+            coll.insert({'_id': 5, 'name': u'x'})
+            assert 0/0
+        except DuplicateKeyError:
+            pass
+        bulk = coll.initialize_unordered_bulk_op()
+        bulk.insert({'_id': 6, 'name': u'y'})
+        bulk.insert({'_id': 1})
+        try:
+            bulk.execute()
+            assert 0/0
+        except BulkWriteError, err:
+            assert [e['index'] for e in err.details['writeErrors']] == [1]
+        assert ids({'name': {'$exists': True}}) == [4, 6]
+        coll.remove({'n': {'$gte': 3}})
+        assert ids({}) == [4, 6]
+        ref = DBRef('things', 4)
+        assert coll.database.dereference(ref)['name'] == u'x'
+        # and Documents work on it, references included:
+        memory = InMemoryClient()['notanormous_tests']
+        nconnection.bind(Author, memory)
+        nconnection.bind(Book, memory)
+        try:
+            author = Author(name=u'Terry').save()
+            book = Book(title=u'Holy Grail', author_id=author._id).save()
+            assert Book.find({'author_id': author._id}).count() == 1
+            assert Book.get_by_id(book._id) is book
+            assert list(author.book_set) == [book]
+            assert 'author_id_1' in memory.book.index_information()
+        finally:
+            nconnection.unbind(Author)
+            nconnection.unbind(Book)
+    
+    def test_instrumentation(self):
+        droptestdb()
+        events = []
+        instrument.reset()
+        instrument.enable(sink=events.append)
+        try:
+            author = Author(name=u'Michael').save()
+            report = Report(title=u'Spam', author_id=author._id).save()
+            with identity_map():
+                assert Report.get_by_id(report._id).author.name == u'Michael'
+            assert len(list(Report.find({'title': u'Spam'}))) == 1
+            report.refresh()
+            report.delete()
+        finally:
+            instrument.disable()
+            instrument.remove_sink(events.append)
+        stats = instrument.stats()
+        assert stats[('Report', 'save', 'insert')]['count'] == 1
+        assert stats[('Report', 'save', 'insert')]['bytes'] > 0
+        assert stats[('Report', 'get_by_id', 'find_one')]['documents'] == 1
+        assert stats[('Author', 'reference', 'find_one')]['count'] == 1
+        found = stats[('Report', 'find', 'find')]
+        assert (found['count'], found['documents'], found['errors']) == (1, 1, 0)
+        assert found['p50'] <= found['p99'] <= found['max']
+        assert sum(count for bound, count in found['histogram']) == 1
+        assert ('Report', 'refresh', 'find_one') in stats and ('Report', 'delete', 'remove') in stats
+        assert set(key[1] for key in instrument.stats(Report)) == set(
+            ['save', 'refresh_stored_properties', 'get_by_id', 'find', 'refresh', 'delete'])
+        assert [e.read_preference for e in events if e.operation == 'find'] == ['secondaryPreferred']
+        # and nothing is recorded any more:
+        count = len(events)
+        Report.get_by_id(report._id + 1)
+        assert len(events) == count
+        assert isinstance(Report._collection('find'), Report._collection().__class__)
+        instrument.reset()
+        droptestdb()
+    
+    def test_nplusone(self):
+        droptestdb()
+        authors = [Author(name=u'Author {0}'.format(i)).save() for i in range(4)]
+        for author in authors:
+            Report(title=author.name, author_id=author._id).save()
+        def names():
+            with identity_map():
+                return [report.author.name for report in Report.find().documents()]
+        reports = []
+        with nplusone.detect(threshold=2, action=reports.append) as detector:
+            assert len(names()) == 4
+            # prefetched, nothing to report:
+            with identity_map():
+                found = list(Report.find().documents())
+                assert len(Document.prefetch(found, 'author')) == 4
+                assert [report.author.name for report in found] == [a.name for a in authors]
+            for author in authors:
+                list(author.report_set)
+        assert [(r.document_class, r.prop, r.count) for r in reports] == [(Report, 'author', 3),
+                                                                       (Author, 'report_set', 3)]
+        assert reports[0].filename.startswith(os.path.splitext(__file__)[0]) and reports[0].function == 'names'
+        assert "Document.prefetch(docs, 'author')" in reports[0].message
+        try:
+            with nplusone.detect(threshold=3, action='raise'):
+                names()
+            assert 0/0
+        except nplusone.NPlusOneError:
+            pass
+        with nplusone.detect(sample=0.0) as detector:
+            assert detector is None and nplusone.active == 0
+            names()
+        assert nplusone.active == 0
+        droptestdb()
+    
+    def test_profiling(self):
+        droptestdb()
+        x = Something(name=u'x', things=EmbedMe(thing1=u'a'), manythings=[EmbedMe(thing1=u'b')])
+        getattribute = Document.__dict__['__getattribute__']
+        with profiling.profile() as p:
+            x.save()
+            assert x.name == u'x'
+            with identity_map():
+                Something.get_by_id(x._id)
+        assert Document.__dict__['__getattribute__'] is getattribute and not profiling.active
+        classes = dict(((kind, name), calls) for seconds, calls, kind, name in p.classes())
+        assert classes[('encode', 'Something')] >= 1 and classes[('encode', 'EmbedMe')] >= 2
+        assert classes[('decode', 'Something')] == 1 and classes[('validate', 'Something')] == 1
+        assert ('identity', 'Something') in classes
+        fields = [name for seconds, calls, kind, name in p.fields('encode')]
+        assert 'Something.manythings' in fields and 'Something._data' in fields
+        assert 'Something.name' in [name for seconds, calls, kind, name in p.fields('decode')]
+        assert p.counts()['Something.name'] >= 1
+        report = p.report(limit=3)
+        assert 'Something.' in report and 'Most read fields' in report
+        # nothing is recorded afterwards:
+        x.to_mongodb()
+        assert sum(calls for seconds, calls, kind, name in p.classes('encode')) == \
+            sum(calls for (kind, name), calls in classes.items() if kind == 'encode')
+        droptestdb()
+
+    def test_slow_queries(self):
+        droptestdb()
+        for i in range(20):
+            Coord(x=i, y=i % 3).save()
+        log = slowquery.SlowQueryLog(threshold=0).start()
+        try:
+            list(Coord.find({'x': {'$gt': 3}}).sort('y'))
+            list(Coord.find({'x': {'$gt': 10}}).sort('y'))
+            list(Coord.find({'x': 5}))
+            Coord.get_by_id(Coord.find().next()['_id'])
+        finally:
+            log.stop()
+        assert not instrument.enabled
+        assert slowquery.query_shape({'x': {'$gt': 3}, '$or': [{'y': 1}]}) == {'x': {'$gt': 1}, '$or': [{'y': 1}]}
+        shapes = [(q.shape, q.sort, q.count) for q in log.queries.values()]
+        assert ({'x': {'$gt': 1}}, [('y', 1)], 2) in shapes and ({'x': 1}, None, 1) in shapes
+        ranged = [q for q in log.queries.values() if q.sort][0]
+        # backends which can't explain leave the plan out, and are advised all the same:
+        assert ranged.plan is None or (ranged.plan['collscan'] and ranged.plan['returned'] == 16)
+        specs = [s.spec for s in log.advise()]
+        assert specs == [[('y', 1), ('x', 1)], 'x'], specs
+        out = StringIO()
+        log.print_advice(out)
+        assert "Coord: add to __index__: [('y', 1), ('x', 1)]" in out.getvalue()
+        instrument.reset()
+        droptestdb()
+
+    def test_footprint(self):
+        droptestdb()
+        for i in range(10):
+            Something(name=u'x' * (i * 100), manythings=[EmbedMe(thing1=u'y' * 1000)]).save()
+        with identity_map() as imap:
+            first = footprint.snapshot(imap)
+            assert first.count == 0
+            docs = Something.find().documents()
+            big = [doc for doc in docs if len(doc.name) == 900][0]
+            big['notes'] = u'z' * 5000
+            # growth is against the last snapshot of the same map:
+            with identity_map() as other:
+                list(Something.find().documents())
+                footprint.snapshot(other)
+            snap = footprint.snapshot(imap)
+            s = snap.classes['Something']
+            assert s['count'] == s['measured'] == 10 and not snap.sampled
+            assert s['embedded'] > 10000 and s['data'] > 5000 and s['fields'] > 4500
+            assert snap.largest[0][1:] == ('Something', big._id)
+            assert snap.growth['Something'] == dict(count=10, total=s['total'])
+            sizes = footprint.document_size(big)
+            assert sizes['total'] == sum(sizes[part] for part in footprint.PARTS)
+            estimate = footprint.snapshot(imap, sample=3)
+            assert estimate.sampled and estimate.classes['Something']['measured'] == 3
+            assert estimate.classes['Something']['count'] == 10 and estimate.growth['Something']['count'] == 0
+            assert 'Something' in snap.report()
+        # a Document already counted inside another isn't measured again:
+        with identity_map() as imap:
+            a, b = Coord(x=1, y=1).save(), Coord(x=2, y=2).save()
+            a['other'], b['other'] = b, a
+            coords = footprint.snapshot(imap).classes['Coord']
+            assert coords['count'] == 2 and coords['measured'] == 1
+        droptestdb()
+
+    def test_migrations(self):
+        droptestdb()
+        coll = Member._collection()
+        coll.insert([{'_id': i, 'name': u' m{0} '.format(i), '_data': {'_classname': 'Member', '_version': 1}}
+                     for i in range(1, 8)])
+        coll.insert({'_id': 8, 'name': u'old', '_data': {'_classname': 'Member'}})
+        coll.insert({'_id': 9, 'full_name': u' new ', '_data': {'_classname': 'Member', '_version': 3}})
+        with identity_map():
+            m = Member.get_by_id(1)
+            assert m.full_name == u'm1' and m._data['_version'] == 3 and m._dirty
+            m.save()
+            assert not Member.get_by_id(9)._dirty
+        assert coll.find_one(1)['_data']['_version'] == 3 and 'name' not in coll.find_one(1)
+        tmp = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(tmp, 'members')
+            first = migration.Migrator(Member, chunk=2, checkpoint=checkpoint,
+                                       progress=lambda migrated, scanned: first.stop())
+            assert first.run() == 2
+            second = migration.Migrator(Member, chunk=2, checkpoint=checkpoint, rate=1000).start()
+            assert second.join(5) == 5 and second.error is None
+        finally:
+            shutil.rmtree(tmp)
+        names = dict((data['_id'], data['full_name']) for data in coll.find())
+        assert names == dict([(i, u'm{0}'.format(i)) for i in range(1, 8)] + [(8, u'old'), (9, u' new ')])
+        assert set(data['_data']['_version'] for data in coll.find()) == set([3])
+        # a guarded replacement of a document saved since doesn't count:
+        assert bulk_write(coll, replacements=[({'_id': 1, '_data._version': 1}, {'full_name': u'x'})]) == 0
+        # refreshing upgrades too, and marks the Document for saving:
+        with identity_map():
+            m = Member.get_by_id(9)
+            for refresh in (m.refresh, lambda: Member.refresh_many([m])):
+                coll.update({'_id': 9}, {'name': u' old ', '_data': {'_classname': 'Member', '_version': 1}})
+                m._dirty = False
+                refresh()
+                assert m.full_name == u'old' and m._dirty
+        try:
+            migration.register(Member, 2, member_strip)
+            assert 0/0
+        except ValueError:
+            pass
+        droptestdb()
+
+    def test_paginate(self):
+        droptestdb()
+        for i in range(23):
+            Coord(x=i % 4, y=i).save()
+        # by _id:
+        seen = []
+        page = Coord.paginate(page_size=10)
+        while True:
+            seen.extend(c._id for c in page)
+            if not page.has_more:
+                break
+            page = Coord.paginate(page_size=10, after=page.next)
+        assert seen == range(1, 24)
+        # compound keys with ties, broken by _id:
+        seen = []
+        token = None
+        pages = 0
+        while True:
+            page = Coord.paginate({'y': {'$ne': 7}}, order_by=['-x', 'y'], page_size=4, after=token)
+            pages += 1
+            seen.extend((c.x, c.y) for c in page)
+            token = page.next
+            if token is None:
+                break
+        assert pages == 6 and len(page) == 2
+        assert seen == sorted(((i % 4, i) for i in range(23) if i != 7), key=lambda (x, y): (-x, y))
+        try:
+            Coord.paginate(order_by='x', after=Coord.paginate(order_by='y', page_size=2).next)
+            assert 0/0
+        except ValueError:
+            pass
+        droptestdb()